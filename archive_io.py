@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    archive_io
+    ------------
+    Lecture directe des images dans les archives zip/tar des livraisons de
+    chantier, sans extraction sur disque, par les systèmes de fichiers
+    virtuels de GDAL (/vsizip/, /vsitar/).
+    Un chemin qui traverse une archive s'écrit comme un chemin de
+    répertoire, par exemple `D:/livraison/chantier.zip/RGB/nom-RVB.jp2`;
+    les chemins hors archive sont traités par glob.glob et cv2.imread comme
+    avant.
+
+    Les fonctions utiles sont:
+        split_archive: archive et chemin interne d'un chemin
+        to_vsi: chemin GDAL /vsizip/ ou /vsitar/ d'un chemin
+        list_files: glob.glob compatible avec les archives
+        read_image: cv2.imread(file,cv2.IMREAD_UNCHANGED) compatible avec
+                    les archives, bandes dans l'ordre [b,g,r(,...)], avec
+                    lecture optionnelle d'une fenêtre par GDAL
+"""
+
+import glob
+import fnmatch
+import numpy as np
+import cv2
+from osgeo import gdal
+
+
+#archive extensions and GDAL virtual file systems, longest first
+_ARCHIVES = [('.tar.gz','/vsitar/'),('.tgz','/vsitar/'),('.tar','/vsitar/'),
+             ('.zip','/vsizip/')]
+#members of the archives already listed
+_MEMBERS = {}
+
+
+def split_archive(path):
+    '''archive part and internal part of a path
+    args:
+        path: file or pattern, e.g. 'chantier.zip/RGB/*.jp2'
+    return:
+        (archive,inner,vsi) e.g. ('chantier.zip','RGB/*.jp2','/vsizip/'),
+        None if the path does not go through an archive
+    '''
+    parts = path.replace("\\","/").split('/')
+    for i in range(len(parts)):
+        head = '/'.join(parts[0:i+1])
+        for ext,vsi in _ARCHIVES:
+            if head.lower().endswith(ext):
+                return head,'/'.join(parts[i+1:]),vsi
+    return None
+
+
+def to_vsi(path):
+    '''GDAL path of a file, /vsizip/ or /vsitar/ inside an archive'''
+    split = split_archive(path)
+    if split is None:
+        return path
+    archive,inner,vsi = split
+    return vsi+archive+('/'+inner if inner!='' else '')
+
+
+def _members(archive,vsi):
+    '''files of an archive, listed once'''
+    if archive not in _MEMBERS:
+        members = gdal.ReadDirRecursive(vsi+archive) or []
+        _MEMBERS[archive] = [m for m in members if not m.endswith('/')]
+    return _MEMBERS[archive]
+
+
+def list_files(pattern):
+    '''files matching a pattern, as glob.glob, inside archives too
+    args:
+        pattern: glob pattern, may go through an archive
+    return:
+        list of files, written as pattern (archive/inner path)
+    '''
+    split = split_archive(pattern)
+    if split is None:
+        return glob.glob(pattern)
+    archive,inner,vsi = split
+    depth = inner.count('/')
+    return sorted([archive+'/'+m for m in _members(archive,vsi)
+                   if m.count('/')==depth and fnmatch.fnmatch(m,inner)])
+
+
+def read_image(file,window=None):
+    '''image array as cv2.imread(file,cv2.IMREAD_UNCHANGED)
+    Files inside an archive, and windows, are decoded by GDAL, the first 3
+    bands are reordered to [b,g,r] as opencv does.
+    args:
+        file: image file, may go through an archive
+        window: (xoff,yoff,xsize,ysize) in pixels to read only a part of
+                the image, None for the whole image
+    return:
+        image array [ny,nx] or [ny,nx,bands], None if unreadable
+    '''
+    if split_archive(file) is None and window is None:
+        return cv2.imread(file,cv2.IMREAD_UNCHANGED)
+    ds = gdal.Open(to_vsi(file))
+    if ds is None:
+        return None
+    img = ds.ReadAsArray() if window is None else ds.ReadAsArray(*window)
+    if img.ndim==2:
+        return img
+    order = [2,1,0]+list(range(3,img.shape[0])) if img.shape[0]>=3 \
+        else list(range(img.shape[0]))
+    return np.ascontiguousarray(img[order].transpose(1,2,0))
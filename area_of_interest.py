@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    area_of_interest
+    ------------
+    Restriction des traitements à une zone d'intérêt (emprise du projet):
+    rectangle `xmin,ymin,xmax,ymax` ou polygones d'un fichier GeoJSON ou
+    GeoPackage, dans le système de coordonnées des images.
+    Les images qui ne recoupent pas la zone sont ignorées, seule la fenêtre
+    de l'image qui recoupe la zone est lue, et seuls les pixels dans la
+    zone comptent dans les histogrammes et les masques.
+
+    Les images doivent être orientées nord avec un géoréférencement; sinon
+    l'image entière est traitée.
+
+    Les fonctions utiles sont:
+        read_aoi: lecture de la zone d'intérêt
+        aoi_window: fenêtre d'une image qui recoupe la zone
+        aoi_mask: pixels d'une fenêtre dans les polygones de la zone
+        window_georef: géoréférencement d'une fenêtre
+        window_slices: partie d'un tableau image dans une fenêtre
+"""
+
+import os
+import json
+import numpy as np
+import footprints as fp
+
+
+def _geojson_polygons(geom):
+    '''list of polygons [exterior,hole1,...] of a GeoJSON geometry'''
+    if geom is None:
+        return []
+    if geom['type']=='Polygon':
+        return [geom['coordinates']]
+    if geom['type']=='MultiPolygon':
+        return list(geom['coordinates'])
+    if geom['type']=='GeometryCollection':
+        return [p for g in geom['geometries'] for p in _geojson_polygons(g)]
+    return []
+
+
+def _read_polygons(file):
+    '''polygons of a GeoJSON file, or of any OGR vector file (GeoPackage)'''
+    if os.path.splitext(file)[1].lower() in ['.geojson','.json']:
+        with open(file) as f:
+            data = json.load(f)
+        if data['type']=='FeatureCollection':
+            geoms = [feat['geometry'] for feat in data['features']]
+        elif data['type']=='Feature':
+            geoms = [data['geometry']]
+        else:
+            geoms = [data]
+    else:
+        from osgeo import ogr
+        ds = ogr.Open(file)
+        if ds is None:
+            return None
+        geoms = []
+        for i in range(ds.GetLayerCount()):
+            for feat in ds.GetLayer(i):
+                geom = feat.GetGeometryRef()
+                if geom is not None:
+                    geoms.append(json.loads(geom.ExportToJson()))
+    return [p for g in geoms for p in _geojson_polygons(g)]
+
+
+def read_aoi(aoi):
+    '''area of interest
+    args:
+        aoi: 'xmin,ymin,xmax,ymax', or a GeoJSON or GeoPackage file
+    return:
+        dict {'bbox':(xmin,ymin,xmax,ymax),'polygons': list of polygons,
+        each a list of rings [[x,y],...], None for a bbox}, None if the
+        area can't be read
+    '''
+    if not os.path.exists(aoi):
+        try:
+            xmin,ymin,xmax,ymax = [float(v) for v in aoi.split(',')]
+        except ValueError:
+            print('area of interest must be xmin,ymin,xmax,ymax or a file')
+            return None
+        return {'bbox':(xmin,ymin,xmax,ymax),'polygons':None}
+    polygons = _read_polygons(aoi)
+    if not polygons:
+        print('no polygon found in',aoi)
+        return None
+    xy = np.concatenate([np.asarray(p[0],dtype=float)[:,0:2]
+                         for p in polygons])
+    bbox = (xy[:,0].min(),xy[:,1].min(),xy[:,0].max(),xy[:,1].max())
+    return {'bbox':bbox,'polygons':polygons}
+
+
+def aoi_window(aoi,geo_tsf,nx,ny):
+    '''pixel window of an image intersecting the area of interest
+    args:
+        aoi: read_aoi() output
+        geo_tsf,nx,ny: geotransform and size of the image
+    return:
+        (xoff,yoff,xsize,ysize), None if the image doesn't intersect the
+        area. The whole image if it is rotated or not georeferenced.
+    '''
+    box = fp.geo_footprint(geo_tsf,nx,ny)
+    if box is None:
+        return (0,0,nx,ny)
+    xmin = max(box[0],aoi['bbox'][0])
+    ymin = max(box[1],aoi['bbox'][1])
+    xmax = min(box[2],aoi['bbox'][2])
+    ymax = min(box[3],aoi['bbox'][3])
+    if xmin>=xmax or ymin>=ymax:
+        return None
+    cols = sorted([(xmin-geo_tsf[0])/geo_tsf[1],(xmax-geo_tsf[0])/geo_tsf[1]])
+    rows = sorted([(ymin-geo_tsf[3])/geo_tsf[5],(ymax-geo_tsf[3])/geo_tsf[5]])
+    xoff = max(0,int(np.floor(cols[0])))
+    yoff = max(0,int(np.floor(rows[0])))
+    xend = min(nx,int(np.ceil(cols[1])))
+    yend = min(ny,int(np.ceil(rows[1])))
+    if xend<=xoff or yend<=yoff:
+        return None
+    return (xoff,yoff,xend-xoff,yend-yoff)
+
+
+def _fill_rings(rings,shape):
+    '''even-odd fill of rings in pixel coordinates (pixel centers at
+    integer positions), exact scanline crossings so that neighbour windows
+    give the same pixels'''
+    ny,nx = shape
+    rows,xs = [],[]
+    for ring in rings:
+        x0,y0 = ring[:,0],ring[:,1]
+        x1,y1 = np.roll(x0,-1),np.roll(y0,-1)
+        for xa,ya,xb,yb in zip(x0,y0,x1,y1):
+            if ya==yb:
+                continue
+            #rows r with min(ya,yb)<=r<max(ya,yb)
+            r = np.arange(max(0,int(np.ceil(min(ya,yb)))),
+                          min(ny,int(np.ceil(max(ya,yb)))))
+            rows.append(r)
+            xs.append(xa+(r-ya)*(xb-xa)/(yb-ya))
+    mask = np.zeros((ny,nx+1),dtype=np.int32)
+    if len(rows)==0:
+        return mask[:,0:nx]>0
+    rows,xs = np.concatenate(rows),np.concatenate(xs)
+    order = np.lexsort((xs,rows))
+    rows,xs = rows[order],xs[order]
+    #consecutive crossings of a row bound an inside span
+    cols = np.clip(np.ceil(xs),0,nx).astype(int)
+    np.add.at(mask,(rows[0::2],cols[0::2]),1)
+    np.add.at(mask,(rows[1::2],cols[1::2]),-1)
+    return np.cumsum(mask,axis=1)[:,0:nx]>0
+
+
+def aoi_mask(aoi,geo_tsf,window,sub=1):
+    '''pixels of a window inside the polygons of the area of interest
+    args:
+        aoi: read_aoi() output
+        geo_tsf: geotransform of the image
+        window: (xoff,yoff,xsize,ysize), aoi_window() output
+        sub: sub-sampling interval of the window pixels
+    return:
+        boolean array of the sub-sampled window, None for a bbox area or a
+        not georeferenced image (all pixels inside)
+    '''
+    if aoi['polygons'] is None or fp.geo_footprint(geo_tsf,1,1) is None:
+        return None
+    xoff,yoff,xsize,ysize = window
+    shape = (-(-ysize//sub),-(-xsize//sub))
+    def to_pixels(ring):
+        #position of a point in the sub-sampled pixels of the window
+        xy = np.asarray(ring,dtype=float)[:,0:2]
+        c = ((xy[:,0]-geo_tsf[0])/geo_tsf[1]-0.5-xoff)/sub
+        r = ((xy[:,1]-geo_tsf[3])/geo_tsf[5]-0.5-yoff)/sub
+        return np.stack([c,r],axis=1)
+    mask = np.zeros(shape,dtype=bool)
+    for polygon in aoi['polygons']:
+        #holes are the inner rings of the even-odd fill
+        mask |= _fill_rings([to_pixels(ring) for ring in polygon],shape)
+    return mask
+
+
+def window_georef(georef,window):
+    '''(geo_tsf,geo_proj) of a window of an image'''
+    geo_tsf,geo_proj = georef
+    if window is None:
+        return georef
+    xoff,yoff = window[0:2]
+    gt = list(geo_tsf)
+    gt[0] = geo_tsf[0]+xoff*geo_tsf[1]+yoff*geo_tsf[2]
+    gt[3] = geo_tsf[3]+xoff*geo_tsf[4]+yoff*geo_tsf[5]
+    return tuple(gt),geo_proj
+
+
+def window_slices(window):
+    '''(row slice,col slice) of a window in the image array'''
+    xoff,yoff,xsize,ysize = window
+    return slice(yoff,yoff+ysize),slice(xoff,xoff+xsize)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    benchmark
+    ------------
+    Mesure du temps de calcul des masques d'ombre sur des images
+    synthétiques, pour comparer les différents chemins de calcul, et effet
+    de la teinte approchée (hue='fast') sur les seuils et les masques.
+
+    python .\benchmark.py size=4000 bits=8 repeat=3 workers=4
+
+    Args:
+    - `size`= taille des images carrées synthétiques en pixels, défaut=4000
+    - `bits`= profondeur de couleur, 8 ou 16, défaut=8
+    - `repeat`= nombre de répétitions, le meilleur temps est retenu, défaut=3
+    - `workers`= nombre de threads pour le traitement par bandes, défaut=4
+"""
+
+import os
+import time
+import numpy as np
+import shadow_mask as sm
+import shadow_kernels as sk
+import shadow_strips as ss
+
+
+def synthetic_bgrn(size,bits,seed=0):
+    '''random bgrn image with a darker (shadow) half
+    args:
+        size: image size in pixels
+        bits: color depth, 8 or 16
+    return:
+        bgrn: bgrn image array, uint8 or uint16
+    '''
+    rng = np.random.default_rng(seed)
+    if bits==8:
+        dtype,pmax = np.uint8,sm._PMAX8
+    else:
+        dtype,pmax = np.uint16,sm._PMAX16
+    bgrn = rng.random((size,size,4))*pmax
+    bgrn[:size//2] *= 0.3
+    return bgrn.astype(dtype)
+
+
+def best_time(func,repeat):
+    '''best wall time of repeat calls of func, and its last result'''
+    t_best = np.inf
+    for k in range(repeat):
+        start = time.time()
+        res = func()
+        t_best = min(t_best,time.time()-start)
+    return t_best,res
+
+
+def bench_backends(bgrn,bits,repeat):
+    '''time of numpy and numba backends for the mask functions'''
+    bgr = bgrn[:,:,0:3]
+    th = [sm.global_thresholding_bgr([bgr[0::10,0::10]],bits)]
+    th += [0.2,0.3]
+    th_ng = [sm.global_thresholding_nagao([bgrn[0::10,0::10]],bits),0.2,0.3]
+    cases = [('shadow_mask_bgr',
+              lambda backend: sm.shadow_mask_bgr(bgr,th[0],bits,
+                                                 backend=backend)),
+             ('shadow_mask_bgrn tsai',
+              lambda backend: sm.shadow_mask_bgrn(bgrn,th,bits,'tsai',
+                                                  backend=backend)),
+             ('shadow_mask_bgrn nagao',
+              lambda backend: sm.shadow_mask_bgrn(bgrn,th_ng,bits,'nagao',
+                                                  backend=backend))]
+    for name,func in cases:
+        t_np,mask_np = best_time(lambda: func('numpy'),repeat)
+        print('{:<24s} numpy: {:8.3f} s'.format(name,t_np))
+        if not sk.HAS_NUMBA:
+            continue
+        func('numba') #jit compilation
+        t_nb,mask_nb = best_time(lambda: func('numba'),repeat)
+        diff = np.sum(np.asarray(mask_np,dtype=bool)!=mask_nb)
+        print('{:<24s} numba: {:8.3f} s, speedup x{:.1f}, {} pixels differ'
+              .format(name,t_nb,t_np/t_nb,diff))
+
+
+def bench_strips(bgrn,bits,repeat,workers):
+    '''time of the strip executor against the sequential numpy functions'''
+    bgr = bgrn[:,:,0:3]
+    th = sm.global_thresholding_bgrn([bgrn[0::10,0::10]],bits,'tsai')
+    cases = [('shadow_mask_bgr',
+              lambda: sm.shadow_mask_bgr(bgr,th[0],bits),
+              lambda: ss.shadow_mask_bgr(bgr,th[0],bits,workers=workers)),
+             ('shadow_mask_bgrn tsai',
+              lambda: sm.shadow_mask_bgrn(bgrn,th,bits,'tsai'),
+              lambda: ss.shadow_mask_bgrn(bgrn,th,bits,'tsai',
+                                          workers=workers)),
+             ('global_thresholding_bgr',
+              lambda: sm.global_thresholding_bgr([bgr[0::4,0::4]],bits),
+              lambda: ss.global_thresholding_bgr([bgr[0::4,0::4]],bits,
+                                                 workers=workers))]
+    for name,func_seq,func_strips in cases:
+        t_seq,res_seq = best_time(func_seq,repeat)
+        t_str,res_str = best_time(func_strips,repeat)
+        same = np.array_equal(np.asarray(res_seq,dtype=float),
+                              np.asarray(res_str,dtype=float))
+        print('{:<24s} strips x{}: {:8.3f} s, speedup x{:.1f}, identical: {}'
+              .format(name,workers,t_str,t_seq/t_str,same))
+
+
+def bench_hue(bgrn,bits,repeat):
+    '''time and effect of the fast approximate hue on the thresholds and
+    masks of the tsai06 method (rgb)'''
+    bgr = bgrn[:,:,0:3]
+    sub_list = [bgr[0::4,0::4]]
+    t_ex,r_ex = best_time(lambda: sm.hsi_ratio(bgr,bits),repeat)
+    t_fa,r_fa = best_time(lambda: sm.hsi_ratio(bgr,bits,hue='fast'),repeat)
+    #hue undefined (V1=V2=0): r=2g and 2b=r+g, rounding noise in hsi_ratio
+    b,g,r = [bgr[:,:,k].astype(int) for k in range(3)]
+    undefined = (r==2*g)&(2*b==r+g)
+    err = np.max(np.abs(r_ex-r_fa)[~undefined])
+    print('{:<24s} fast hue: {:8.3f} s, speedup x{:.1f}, max ratio error {:.2e}'
+          ', {} pixels with undefined hue'.format('hsi_ratio',t_fa,t_ex/t_fa,
+                                                  err,np.sum(undefined)))
+    th_ex = sm.global_thresholding_bgr(sub_list,bits)
+    th_fa = sm.global_thresholding_bgr(sub_list,bits,hue='fast')
+    print('{:<24s} threshold exact {} fast {}'.format(
+        'global_thresholding_bgr',th_ex,th_fa))
+    backends = ['numpy','numba'] if sk.HAS_NUMBA else ['numpy']
+    for backend in backends:
+        func = lambda hue: sm.shadow_mask_bgr(bgr,th_ex,bits,backend=backend,
+                                              hue=hue)
+        func('fast') #jit compilation
+        t_ex,mask_ex = best_time(lambda: func('exact'),repeat)
+        t_fa,mask_fa = best_time(lambda: func('fast'),repeat)
+        diff = np.sum(mask_ex!=mask_fa)
+        print('{:<24s} {} fast hue: {:8.3f} s, speedup x{:.1f}, {} pixels '
+              'differ'.format('shadow_mask_bgr',backend,t_fa,t_ex/t_fa,diff))
+
+
+def main(**kwargs):
+    '''
+        Description
+    args:
+        Description
+    returns:
+        Description
+    '''
+    size = int(kwargs.get('size',4000))
+    bits = int(kwargs.get('bits',8))
+    repeat = int(kwargs.get('repeat',3))
+    workers = int(kwargs.get('workers',4))
+    print('image size = ',size)
+    print('color deep = ',bits)
+    print('numba available =',sk.HAS_NUMBA)
+    bgrn = synthetic_bgrn(size,bits)
+    bench_backends(bgrn,bits,repeat)
+    bench_strips(bgrn,bits,repeat,workers)
+    bench_hue(bgrn,bits,repeat)
+
+
+if __name__ == '__main__':
+    main(**dict([arg.split('=') for arg in os.sys.argv[1:]]))
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    chantier_catalog
+    ------------
+    Catalogue (index SQLite) des images d'un chantier. Le répertoire est
+    parcouru une seule fois: couples RVB/PIR, dimensions, nombre de bandes,
+    profondeur de couleur, taille de bloc et géoréférencement sont
+    enregistrés. Le seuillage global et la création des masques lisent
+    ensuite le catalogue au lieu de refaire glob.glob et l'appariement des
+    noms, et un fichier PIR manquant ou de dimension différente est détecté
+    avant le traitement.
+    Les préfixes et extensions du parcours sont enregistrés par répertoire
+    (table scans), un répertoire parcouru avec d'autres motifs est parcouru
+    à nouveau, de même si des images ont été ajoutées, supprimées ou
+    modifiées (liste des fichiers et dates de modification). La valeur
+    nodata des images est enregistrée pour nodata='auto' (catalog_nodata).
+
+    Les fonctions utiles sont:
+        build_catalog: parcours d'un répertoire et écriture du catalogue
+        read_catalog: lecture des images d'un répertoire dans le catalogue
+        raster_info: dimensions, bandes, profondeur, blocs et géoréférencement
+                     d'une image (lecture de l'en-tête seulement)
+        check_catalog: vérification des couples RVB/PIR et de la profondeur
+                       de couleur
+        file_nodata: valeur nodata d'une image, donnée ou lue dans ses
+                     métadonnées
+        catalog_nodata: valeurs nodata des images d'un répertoire du 
+                        catalogue
+"""
+
+import os
+import glob
+import sqlite3
+from osgeo import gdal
+import archive_io as aio
+
+
+_COLUMNS = ['root','name','file_rgb','file_nir','nx','ny','bands','bits',
+            'block_x','block_y','geo_tsf','geo_proj','nir_nx','nir_ny',
+            'error','nodata','mtime','nir_mtime']
+
+
+def _strip_ext(basename,ext):
+    '''image name without its extension key'''
+    if '*' in ext:
+        return os.path.splitext(basename)[0]
+    return basename[:-len(ext)]
+
+
+def raster_info(file):
+    '''dimensions, band count, bit depth, block size, georef and nodata
+    value of a raster
+    return:
+        dict, None if the file can't be opened by GDAL
+    '''
+    ds = gdal.Open(aio.to_vsi(file))
+    if ds is None:
+        return None
+    band = ds.GetRasterBand(1)
+    block_x,block_y = band.GetBlockSize()
+    return {'nx':ds.RasterXSize,
+            'ny':ds.RasterYSize,
+            'bands':ds.RasterCount,
+            'bits':gdal.GetDataTypeSize(band.DataType),
+            'block_x':block_x,
+            'block_y':block_y,
+            'geo_tsf':','.join([repr(v) for v in ds.GetGeoTransform()]),
+            'geo_proj':ds.GetProjection(),
+            'nodata':band.GetNoDataValue()}
+
+
+def file_nodata(file,nodata,known=None):
+    '''nodata value of an image
+    args:
+        file: image file
+        nodata: None, a value, or 'auto' for the nodata value of the file
+                metadata (None if the file has none)
+        known: {file:nodata} of the catalog (catalog_nodata), a file in 
+               known is not opened
+    return:
+        nodata value or None
+    '''
+    if nodata!='auto':
+        return nodata
+    if known is not None and file in known:
+        return known[file]
+    info = raster_info(file)
+    return None if info is None else info['nodata']
+
+
+def _mtime(file):
+    '''modification time of a file, of its archive for a file in an
+    archive, None if it does not exist'''
+    split = aio.split_archive(file)
+    path = file if split is None else split[0]
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+def _connect(db):
+    con = sqlite3.connect(db)
+    columns = [c[1] for c in con.execute('PRAGMA table_info(images)')]
+    if columns and columns!=_COLUMNS:
+        #catalog of an older version, the directories are scanned again
+        con.execute('DROP TABLE images')
+        con.execute('DROP TABLE IF EXISTS scans')
+    con.execute('CREATE TABLE IF NOT EXISTS images ('
+                'root TEXT, name TEXT, file_rgb TEXT, file_nir TEXT, '
+                'nx INTEGER, ny INTEGER, bands INTEGER, bits INTEGER, '
+                'block_x INTEGER, block_y INTEGER, geo_tsf TEXT, '
+                'geo_proj TEXT, nir_nx INTEGER, nir_ny INTEGER, error TEXT, '
+                'nodata REAL, mtime REAL, nir_mtime REAL, '
+                'PRIMARY KEY (root,name))')
+    con.execute('CREATE TABLE IF NOT EXISTS scans ('
+                'root TEXT PRIMARY KEY, pref_rgb TEXT, ext_rgb TEXT, '
+                'pref_nir TEXT, ext_nir TEXT)')
+    return con
+
+
+def build_catalog(db,src_path,pref_rgb='',ext_rgb='.*',pref_nir=None,
+                  ext_nir=None,rebuild=False):
+    '''scan a chantier directory once and store its images in the catalog
+    args:
+        db: catalog file (SQLite)
+        src_path: input directory, the same as the `input` of the scripts.
+                  RVB images in src_path, or in src_path/RGB with the PIR
+                  images in src_path/IR if pref_nir or ext_nir is given
+        pref_rgb, ext_rgb: prefix and extension of RVB images
+        pref_nir, ext_nir: prefix and extension of PIR images, None for
+                           RVB only chantier
+        rebuild: scan again a directory already in the catalog. A
+                 directory scanned with other prefixes or extensions, or
+                 whose images were added, removed or modified, is always
+                 scanned again
+    return:
+        n: number of images of src_path in the catalog
+    '''
+    with_nir = pref_nir is not None or ext_nir is not None
+    if with_nir:
+        pref_nir = pref_nir or ''
+        ext_nir = ext_nir or '.*'
+        src_path_rgb = os.path.join(src_path,'RGB')
+        src_path_nir = os.path.join(src_path,'IR')
+    else:
+        src_path_rgb = src_path
+    scan = (pref_rgb,ext_rgb,pref_nir,ext_nir)
+    pattern = os.path.join(src_path_rgb,pref_rgb+'*'+ext_rgb)
+    flist_rgb = sorted([f.replace("\\","/") for f in aio.list_files(pattern)])
+    con = _connect(db)
+    n = con.execute('SELECT COUNT(*) FROM images WHERE root=?',
+                    (src_path,)).fetchone()[0]
+    last_scan = con.execute('SELECT pref_rgb,ext_rgb,pref_nir,ext_nir '
+                            'FROM scans WHERE root=?',(src_path,)).fetchone()
+    if n>0 and not rebuild and last_scan==scan:
+        if not _changed(con,src_path,flist_rgb):
+            con.close()
+            return n
+        print('images of',src_path,'added, removed or modified, the '
+              'catalog is updated')
+    con.execute('DELETE FROM images WHERE root=?',(src_path,))
+    con.execute('INSERT OR REPLACE INTO scans VALUES (?,?,?,?,?)',
+                (src_path,)+scan)
+    rows = []
+    for file_rgb in flist_rgb:
+        basename = os.path.basename(file_rgb)
+        name = _strip_ext(basename,ext_rgb)
+        row = dict.fromkeys(_COLUMNS)
+        row.update({'root':src_path,'name':name,'file_rgb':file_rgb,
+                    'mtime':_mtime(file_rgb)})
+        info = raster_info(file_rgb)
+        if info is None:
+            row['error'] = 'rgb image unreadable'
+            rows.append(row)
+            continue
+        row.update(info)
+        if with_nir:
+            key = name[len(pref_rgb):]
+            if '*' in ext_nir:
+                found = aio.list_files(os.path.join(src_path_nir,
+                                               pref_nir+key+ext_nir))
+                file_nir = found[0] if found else ''
+            else:
+                file_nir = os.path.join(src_path_nir,pref_nir+key+ext_nir)
+            file_nir = file_nir.replace("\\","/")
+            row['file_nir'] = file_nir
+            row['nir_mtime'] = _mtime(file_nir) if file_nir!='' else None
+            info_nir = raster_info(file_nir) if file_nir!='' else None
+            if info_nir is None:
+                row['error'] = 'nir image missing or unreadable'
+            else:
+                row['nir_nx'] = info_nir['nx']
+                row['nir_ny'] = info_nir['ny']
+                if (info_nir['nx'],info_nir['ny'])!=(info['nx'],info['ny']):
+                    row['error'] = 'rgb and nir dimensions differ'
+        rows.append(row)
+    con.executemany('INSERT INTO images VALUES ('+
+                    ','.join(['?']*len(_COLUMNS))+')',
+                    [[row[c] for c in _COLUMNS] for row in rows])
+    con.commit()
+    con.close()
+    return len(rows)
+
+
+def _changed(con,src_path,flist_rgb):
+    '''True if the images of a directory differ from the catalog: files
+    added or removed, or modification time changed'''
+    rows = con.execute('SELECT file_rgb,file_nir,mtime,nir_mtime FROM images '
+                       'WHERE root=? ORDER BY file_rgb',(src_path,)).fetchall()
+    if [r[0] for r in rows]!=flist_rgb:
+        return True
+    for file_rgb,file_nir,mtime,nir_mtime in rows:
+        if _mtime(file_rgb)!=mtime:
+            return True
+        if file_nir and _mtime(file_nir)!=nir_mtime:
+            return True
+    return False
+
+
+def read_catalog(db,src_path):
+    '''images of a directory in the catalog, sorted by name
+    args:
+        db: catalog file
+        src_path: input directory given to build_catalog
+    return:
+        list of dict, keys are the catalog columns, geo_tsf is a tuple
+    '''
+    con = _connect(db)
+    cur = con.execute('SELECT '+','.join(_COLUMNS)+' FROM images '
+                      'WHERE root=? ORDER BY name',(src_path,))
+    entries = []
+    for values in cur.fetchall():
+        entry = dict(zip(_COLUMNS,values))
+        if entry['geo_tsf']:
+            entry['geo_tsf'] = tuple(float(v)
+                                     for v in entry['geo_tsf'].split(','))
+        entries.append(entry)
+    con.close()
+    return entries
+
+
+def catalog_nodata(db,src_path):
+    '''nodata values of the images of a directory in the catalog
+    return:
+        dict {file_rgb:nodata}, for file_nodata
+    '''
+    return {e['file_rgb']:e['nodata'] for e in read_catalog(db,src_path)}
+
+
+def check_catalog(entries,bits=None):
+    '''errors of the catalog entries
+    args:
+        entries: read_catalog() output
+        bits: expected color depth, not checked if None
+    return:
+        list of error messages, empty if all images can be processed
+    '''
+    errors = []
+    for entry in entries:
+        if entry['error']:
+            errors.append(entry['name']+': '+entry['error'])
+        elif bits is not None and entry['bits']!=bits:
+            errors.append(entry['name']+': color depth is '+
+                          str(entry['bits'])+' bits')
+    return errors
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    compact_mask
+    ------------
+    Format compact des masques d'ombre binaires: chaque ligne du masque est
+    compressée sur 1 bit par pixel (np.packbits), soit 8 fois moins que le
+    masque 8 bits 0/255, puis enregistrée dans un fichier .npz compressé
+    avec le géoréférencement.
+    Les opérations ensemblistes et les comptages de surface se font
+    directement sur les octets compressés, sans décompresser le masque.
+
+    Convention: bit à 1 = pixel d'ombre (mask==1 de shadow_mask), alors que
+    le masque tif enregistre l'ombre à 0.
+
+    Les fonctions utiles sont:
+        pack_mask: masque booléen -> masque compact
+        unpack_mask: masque compact -> masque booléen
+        save_mask, read_mask: écriture et lecture d'un fichier .npz
+        mask_and, mask_or, mask_xor, mask_not: opérations ensemblistes
+        mask_area: nombre de pixels à 1
+"""
+
+import numpy as np
+
+
+#number of bits at 1 of each byte value
+_POPCOUNT = np.array([bin(v).count('1') for v in range(256)],dtype=np.uint8)
+
+
+def pack_mask(mask):
+    '''bit-packed rows of a binary mask
+    args:
+        mask: 2d mask array, shadow pixels are 1 (or True)
+    return:
+        packed: dict {'bits': 2d uint8 array [ny,ceil(nx/8)], 'shape': (ny,nx)}
+    '''
+    mask = np.asarray(mask)
+    return {'bits':np.packbits(mask!=0,axis=1),'shape':mask.shape[0:2]}
+
+
+def unpack_mask(packed):
+    '''boolean mask of a packed mask'''
+    ny,nx = packed['shape']
+    return np.unpackbits(packed['bits'],axis=1,count=nx).astype(bool)
+
+
+def save_mask(file,mask,geo_tsf=None,geo_proj=''):
+    '''save a mask in the compact format
+    args:
+        file: output file, .npz
+        mask: 2d mask array, or packed mask
+        geo_tsf: GDAL geotransform, optional
+        geo_proj: GDAL projection (wkt), optional
+    '''
+    packed = mask if isinstance(mask,dict) else pack_mask(mask)
+    if geo_tsf is None:
+        geo_tsf = []
+    np.savez_compressed(file,bits=packed['bits'],
+                        shape=np.array(packed['shape']),
+                        geo_tsf=np.array(geo_tsf,dtype=float),
+                        geo_proj=np.array(geo_proj))
+
+
+def read_mask(file):
+    '''read a compact mask file
+    return:
+        packed: packed mask, with 'geo_tsf' and 'geo_proj' keys
+    '''
+    with np.load(file) as data:
+        geo_tsf = tuple(float(v) for v in data['geo_tsf'])
+        return {'bits':data['bits'],
+                'shape':tuple(int(v) for v in data['shape']),
+                'geo_tsf':geo_tsf if len(geo_tsf)==6 else None,
+                'geo_proj':str(data['geo_proj'])}
+
+
+def _check_shape(p1,p2):
+    if tuple(p1['shape'])!=tuple(p2['shape']):
+        raise ValueError('masks must have the same dimension')
+
+
+def mask_and(p1,p2):
+    '''pixels at 1 in both masks'''
+    _check_shape(p1,p2)
+    return {'bits':p1['bits']&p2['bits'],'shape':p1['shape']}
+
+
+def mask_or(p1,p2):
+    '''pixels at 1 in one of the masks'''
+    _check_shape(p1,p2)
+    return {'bits':p1['bits']|p2['bits'],'shape':p1['shape']}
+
+
+def mask_xor(p1,p2):
+    '''pixels different in the two masks'''
+    _check_shape(p1,p2)
+    return {'bits':p1['bits']^p2['bits'],'shape':p1['shape']}
+
+
+def mask_not(p):
+    '''inverse mask, padding bits of the last byte of a row stay at 0'''
+    nx = p['shape'][1]
+    pad = np.packbits(np.ones((1,nx),dtype=bool),axis=1)
+    return {'bits':~p['bits']&pad,'shape':p['shape']}
+
+
+def mask_area(p):
+    '''number of pixels at 1'''
+    return int(_POPCOUNT[p['bits']].sum(dtype=np.int64))
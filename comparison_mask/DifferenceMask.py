@@ -4,10 +4,18 @@ Created on Friday October 08 2021
 """
 
 # This script compares differences on two different shadow masks
+# Masks in the compact format (.npz, see compact_mask.py) are compared
+# directly on their bit-packed rows, run from the repository root:
+# python -m comparison_mask.DifferenceMask mask_ref mask_test
 
 import os
 import cv2
 import numpy as np
+try:
+    import compact_mask as cm
+    HAS_COMPACT = True
+except ImportError:
+    HAS_COMPACT = False
 
 
 ### Read the two images masks to compare
@@ -16,6 +24,16 @@ def read_images(src_path_ref,src_path_test):
     mask_test = cv2.imread(src_path_test, 0) # The mask to test with the reference mask
     return mask_ref, mask_test
 
+### Read a mask in compact form, 8 bits masks are packed (shadow pixels are 0)
+### None if the 8 bits mask is composed of more than 2 values
+def read_packed(src_path):
+    if src_path.endswith('.npz'):
+        return cm.read_mask(src_path)
+    mask = cv2.imread(src_path, 0)
+    if np.sum(mask==0) + np.sum(mask==255) != mask.size:
+        return None
+    return cm.pack_mask(mask==0)
+
 ### Dimensions of the image masks
 def dimensions(mask_ref,mask_test):
     height_ref = mask_ref.shape[0]
@@ -38,6 +56,32 @@ def statistics_calculation(mask_ref,mask_test):
     false_noshadow = np.sum(np.logical_and(mask_ref==0,mask_test==255))      #pixel in shadow for reference and not shadow for test mask
     return shadow_mref, noshadow_mref, shadow_mtest, noshadow_mtest, true_shadow, true_noshadow, false_shadow, false_noshadow
 
+### statistics on compact masks, bits at 1 are shadow pixels
+def statistics_calculation_packed(packed_ref,packed_test):
+    total_pixels = packed_ref['shape'][0]*packed_ref['shape'][1]
+    shadow_mref = cm.mask_area(packed_ref)
+    noshadow_mref = total_pixels-shadow_mref
+    shadow_mtest = cm.mask_area(packed_test)
+    noshadow_mtest = total_pixels-shadow_mtest
+    true_shadow = cm.mask_area(cm.mask_and(packed_ref,packed_test))
+    false_shadow = shadow_mtest-true_shadow
+    false_noshadow = shadow_mref-true_shadow
+    true_noshadow = total_pixels-cm.mask_area(cm.mask_or(packed_ref,packed_test))
+    return shadow_mref, noshadow_mref, shadow_mtest, noshadow_mtest, true_shadow, true_noshadow, false_shadow, false_noshadow
+
+### Display of the statistics
+def display(shadow_mref, noshadow_mref, shadow_mtest, noshadow_mtest, true_shadow, true_noshadow, false_shadow, false_noshadow):
+    print('PIXEL NUMBERS :  \nReference shadow pixels :', shadow_mref,'\nReference no shadow pixels :', noshadow_mref,'\nPrediction shadow pixels :', shadow_mtest,'\nPrediction no shadow pixels :' ,noshadow_mtest)
+    print('True shadow pixels : ', true_shadow, '\nFalse shadow pixels :', false_shadow, '\nTrue no shadow pixels :', true_noshadow, '\nFalse shadow pixels :', false_noshadow)
+    print('well predicted numbers: True shadow + True no shadow =',true_shadow+true_noshadow)
+
+    # Ratios calculation and display
+    accuracy_shadow, accuracy_noshadow, miss_rate = ratios(true_shadow,true_noshadow,shadow_mref,noshadow_mref)
+    print('PERCENTAGES :')
+    print('accuracy shadow = '+'{:<5.3f}%'.format(accuracy_shadow*100))
+    print('accuracy no shadow = '+'{:<5.3f}%'.format(accuracy_noshadow*100))
+    print('miss rate = '+'{:<5.3f}%'.format(miss_rate*100))
+
 ### Ratios calculation
 def ratios(true_shadow,true_noshadow,shadow_mref,noshadow_mref):
     accuracy_shadow = true_shadow/shadow_mref
@@ -50,6 +94,23 @@ if __name__ == '__main__':
     # Give the path and read images
     src_path_ref = os.sys.argv[1]
     src_path_test = os.sys.argv[2]
+    if src_path_ref.endswith('.npz') or src_path_test.endswith('.npz'):
+        # Compact masks, compared without decoding to 8 bits
+        if not HAS_COMPACT:
+            print('compact_mask.py not found, run from the repository root: '
+                  'python -m comparison_mask.DifferenceMask')
+            os.sys.exit()
+        packed_ref = read_packed(src_path_ref)
+        packed_test = read_packed(src_path_test)
+        if packed_ref is None:
+            print('The reference mask is composed of more than 2 values')
+        elif packed_test is None:
+            print('The test mask is composed of more than 2 values')
+        elif tuple(packed_ref['shape']) != tuple(packed_test['shape']):
+            print('Error, not the same dimension for the masks')
+        else:
+            display(*statistics_calculation_packed(packed_ref, packed_test))
+        os.sys.exit()
     mask_ref, mask_test=read_images(src_path_ref,src_path_test)
 
     total_pixels_ref, total_pixels_test = dimensions(mask_ref,mask_test)
@@ -62,16 +123,7 @@ if __name__ == '__main__':
             print('The test mask is composed of more than 2 values')
         else :
             # Statistics calculation and display
-            print('PIXEL NUMBERS :  \nReference shadow pixels :', shadow_mref,'\nReference no shadow pixels :', noshadow_mref,'\nPrediction shadow pixels :', shadow_mtest,'\nPrediction no shadow pixels :' ,noshadow_mtest)
-            print('True shadow pixels : ', true_shadow, '\nFalse shadow pixels :', false_shadow, '\nTrue no shadow pixels :', true_noshadow, '\nFalse shadow pixels :', false_noshadow)
-            print('well predicted numbers: True shadow + True no shadow =',true_shadow+true_noshadow)
-
-            # Ratios calculation and display
-            accuracy_shadow, accuracy_noshadow, miss_rate = ratios(true_shadow,true_noshadow,shadow_mref,noshadow_mref)
-            print('PERCENTAGES :')
-            print('accuracy shadow = '+'{:<5.3f}%'.format(accuracy_shadow*100))
-            print('accuracy no shadow = '+'{:<5.3f}%'.format(accuracy_noshadow*100))
-            print('miss rate = '+'{:<5.3f}%'.format(miss_rate*100))
+            display(shadow_mref, noshadow_mref, shadow_mtest, noshadow_mtest, true_shadow, true_noshadow, false_shadow, false_noshadow)
     
     # If it's not the same dimension, masks can't be compared
     else:
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    equivalence
+    ------------
+    Vérification de l'équivalence des chemins de calcul optimisés avec les
+    fonctions NumPy de référence de shadow_mask: seuils globaux et masques.
+    Chaque moteur est comparé à la référence sur des images synthétiques
+    et, si `input` est donné, sur des images réelles. Les masques d'un
+    moteur sont calculés avec les seuils de référence, pour mesurer
+    séparément l'écart des seuils et l'écart des masques.
+
+    python .\equivalence.py input=\InputImage ext_rgb=-RVB.jp2 ext_nir=-PIR.jp2 bits=8 sub=10 th_tol=0 pix_tol=0 engines=numba,strips
+
+    Args:
+    - `input`= répertoire d'images réelles, optionnel. Si le répertoire
+               contient les sous-répertoires `RGB` et `IR`, les couples
+               RVB/PIR sont utilisés (comme shadow_mask_rgb_nir.py), sinon
+               les images RVB du répertoire.
+    - `pref_rgb`, `pref_nir`, `ext_rgb`, `ext_nir`= comme
+               shadow_mask_rgb_nir.py, `ext_rgb` sert d'extension pour un
+               répertoire RVB seul. défaut=.*
+    - `bits`= profondeur de couleur, 8 ou 16, défaut=8
+    - `sub`= sous-échantillonnage des images pour le seuillage, défaut=10
+    - `size`= taille des images synthétiques, 0 pour ne pas les utiliser,
+              défaut=1000
+    - `th_tol`= écart absolu toléré sur les seuils, défaut=0
+    - `pix_tol`= proportion de pixels différents tolérée, défaut=0
+    - `engines`= liste des moteurs à vérifier séparés par des virgules,
+                 défaut=tous les moteurs exacts disponibles (`chunks`: 
+                 évaluation par blocs Dask, si dask est installé;
+                 `index_cache`: masques du cache des indices quantifiés
+                 sur 16 bits). Les moteurs 
+                 approchés (`fast_hue`, `numba_fast_hue`: teinte approchée
+                 hue='fast') ne sont vérifiés que s'ils sont nommés, avec
+                 des tolérances adaptées (par exemple th_tol=1 
+                 pix_tol=0.001)
+
+    Avec le moteur `pyramid`, les seuils des histogrammes uniformes (sans
+    séparation Otsu) sont aussi vérifiés: ils doivent être ceux du niveau
+    parent de la pyramide.
+
+    Le script se termine avec le code 1 si un écart dépasse la tolérance.
+"""
+
+import os
+import tempfile
+import numpy as np
+import shadow_mask as sm
+import shadow_kernels as sk
+import shadow_strips as ss
+import shadow_chunks as sc
+import benchmark as bm
+import index_cache as ic
+
+
+#reference functions, an engine replaces some of them
+REFERENCE = {
+    'threshold_bgr': lambda bgr_list,bits,hsteq:
+        sm.global_thresholding_bgr(bgr_list,bits,hsteq=hsteq),
+    'threshold_bgrn': lambda bgrn_list,bits,method,hsteq:
+        sm.global_thresholding_bgrn(bgrn_list,bits,method,hsteq=hsteq),
+    'mask_bgr': lambda bgr,th,bits,hsteq:
+        sm.shadow_mask_bgr(bgr,th,bits,hsteq=hsteq),
+    'mask_bgrn': lambda bgrn,th,bits,method,hsteq:
+        sm.shadow_mask_bgrn(bgrn,th,bits,method,hsteq=hsteq),
+    }
+
+ENGINES = {}
+#engines giving approximate results, only checked when named in engines
+APPROXIMATE = []
+
+
+def register_engine(name,approximate=False,**funcs):
+    '''add an engine to check
+    args:
+        name: engine name
+        approximate: True if the engine is not expected to match the 
+                     reference exactly, not checked by default
+        funcs: functions replacing the REFERENCE functions of same key,
+               with the same arguments
+    '''
+    for key in funcs:
+        if key not in REFERENCE:
+            raise ValueError('unknown function '+key)
+    ENGINES[name] = funcs
+    if approximate:
+        APPROXIMATE.append(name)
+
+
+if sk.HAS_NUMBA:
+    register_engine('numba',
+        mask_bgr=lambda bgr,th,bits,hsteq:
+            sm.shadow_mask_bgr(bgr,th,bits,hsteq=hsteq,backend='numba'),
+        mask_bgrn=lambda bgrn,th,bits,method,hsteq:
+            sm.shadow_mask_bgrn(bgrn,th,bits,method,hsteq=hsteq,
+                                backend='numba'))
+
+register_engine('strips',
+    threshold_bgr=lambda bgr_list,bits,hsteq:
+        ss.global_thresholding_bgr(bgr_list,bits,hsteq=hsteq),
+    threshold_bgrn=lambda bgrn_list,bits,method,hsteq:
+        ss.global_thresholding_bgrn(bgrn_list,bits,method,hsteq=hsteq),
+    mask_bgr=lambda bgr,th,bits,hsteq:
+        ss.shadow_mask_bgr(bgr,th,bits,hsteq=hsteq,strip=37),
+    mask_bgrn=lambda bgrn,th,bits,method,hsteq:
+        ss.shadow_mask_bgrn(bgrn,th,bits,method,hsteq=hsteq,strip=37))
+
+register_engine('pyramid',
+    threshold_bgr=lambda bgr_list,bits,hsteq:
+        sm.global_thresholding_bgr_pyramid(bgr_list,bits,64,
+                                           hsteq=hsteq)['chantier'])
+
+register_engine('fast_hue',approximate=True,
+    threshold_bgr=lambda bgr_list,bits,hsteq:
+        sm.global_thresholding_bgr(bgr_list,bits,hsteq=hsteq,hue='fast'),
+    mask_bgr=lambda bgr,th,bits,hsteq:
+        sm.shadow_mask_bgr(bgr,th,bits,hsteq=hsteq,hue='fast'))
+
+if sc.HAS_DASK:
+    register_engine('chunks',
+        threshold_bgr=lambda bgr_list,bits,hsteq:
+            sc.global_thresholding_bgr(bgr_list,bits,hsteq=hsteq,
+                                       split_every=4),
+        threshold_bgrn=lambda bgrn_list,bits,method,hsteq:
+            sc.global_thresholding_bgrn(bgrn_list,bits,method,hsteq=hsteq,
+                                        split_every=4),
+        mask_bgr=lambda bgr,th,bits,hsteq:
+            sc.shadow_mask_bgr(sc.as_chunked(bgr,chunks=129),th,bits,
+                               hsteq=hsteq).compute(),
+        mask_bgrn=lambda bgrn,th,bits,method,hsteq:
+            sc.shadow_mask_bgrn(sc.as_chunked(bgrn,chunks=129),th,bits,
+                                method,hsteq=hsteq).compute())
+
+def _cached_mask(img,th,bits,method,hsteq):
+    '''mask of index_cache.cached_mask, the indices of img are written in
+    a temporary cache'''
+    bands = 4 if img.shape[2]>=4 else 3
+    keys = ic.index_keys([(method,hsteq)],bands=bands)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        ic.write_indices(cache_dir,'img',img,bits,keys)
+        return ic.cached_mask(cache_dir,'img',th,bits,method=method,
+                              hsteq=hsteq,bands=bands)
+
+register_engine('index_cache',
+    mask_bgr=lambda bgr,th,bits,hsteq:
+        _cached_mask(bgr,th,bits,'tsai',hsteq),
+    mask_bgrn=lambda bgrn,th,bits,method,hsteq:
+        _cached_mask(bgrn,th,bits,method,hsteq))
+
+if sk.HAS_NUMBA:
+    register_engine('numba_fast_hue',approximate=True,
+        mask_bgr=lambda bgr,th,bits,hsteq:
+            sm.shadow_mask_bgr(bgr,th,bits,hsteq=hsteq,backend='numba',
+                               hue='fast'))
+
+
+def load_images(src_path,pref_rgb,pref_nir,ext_rgb,ext_nir):
+    '''real images of a directory
+    returns:
+        list of (name, bgr or bgrn image array)
+    '''
+    import archive_io as aio
+    images = []
+    if len(aio.list_files(os.path.join(src_path,'RGB','*')))>0:
+        import shadow_mask_rgb_nir as rgbn
+        flist_rgb,flist_nir,names,_ = rgbn.image_pairs(src_path,pref_rgb,
+                                                       pref_nir,ext_rgb,
+                                                       ext_nir)
+        for file_rgb,file_nir,name in zip(flist_rgb,flist_nir,names):
+            bgr = aio.read_image(file_rgb)
+            nir = aio.read_image(file_nir)
+            images.append((name,np.dstack([bgr,nir])))
+    else:
+        pattern = os.path.join(src_path,pref_rgb+'*'+ext_rgb)
+        for file in sorted(aio.list_files(pattern)):
+            bgr = aio.read_image(file)
+            images.append((os.path.basename(file),bgr))
+    return images
+
+
+def _cases(images):
+    '''(method, hsteq) cases checked for a set of images'''
+    cases = [('tsai',False),('tsai',True)]
+    if all([img.shape[2]>=4 for _,img in images]):
+        cases += [('nagao',False)]
+    return cases
+
+
+def check_engine(engine,images,bits,sub=10,th_tol=0,pix_tol=0):
+    '''compare an engine with the reference functions
+    args:
+        engine: engine name in ENGINES
+        images: list of (name, bgr or bgrn array)
+        bits: color depth
+        sub: sub-sampling of the images for thresholding
+        th_tol: tolerance on the threshold absolute difference
+        pix_tol: tolerance on the proportion of different mask pixels
+    return:
+        rows: list of dict, one per compared output
+              {'engine','function','case','image','delta','ok'}
+    '''
+    funcs = ENGINES[engine]
+    rows = []
+    for method,hsteq in _cases(images):
+        case = method+(' hsteq' if hsteq else '')
+        bgrn_mode = method=='nagao' or images[0][1].shape[2]>=4
+        sub_list = [img[0::sub,0::sub] for _,img in images]
+        #thresholds
+        if bgrn_mode:
+            key = 'threshold_bgrn'
+            th_ref = REFERENCE[key](sub_list,bits,method,hsteq)
+        else:
+            key = 'threshold_bgr'
+            sub_list = [img[:,:,0:3] for img in sub_list]
+            th_ref = REFERENCE[key](sub_list,bits,hsteq)
+        if key in funcs:
+            th = funcs[key](sub_list,bits,*([method] if bgrn_mode else []),
+                            hsteq)
+            delta = float(np.max(np.abs(np.subtract(th,th_ref))))
+            rows.append({'engine':engine,'function':key,'case':case,
+                         'image':'all','delta':delta,'ok':delta<=th_tol})
+        #masks, computed with the reference thresholds
+        key = 'mask_bgrn' if bgrn_mode else 'mask_bgr'
+        if key not in funcs:
+            continue
+        for name,img in images:
+            if bgrn_mode:
+                mask_ref = REFERENCE[key](img,th_ref,bits,method,hsteq)
+                mask = funcs[key](img,th_ref,bits,method,hsteq)
+            else:
+                mask_ref = REFERENCE[key](img,th_ref,bits,hsteq)
+                mask = funcs[key](img,th_ref,bits,hsteq)
+            ndiff = int(np.sum(np.asarray(mask,dtype=bool)!=
+                               np.asarray(mask_ref,dtype=bool)))
+            delta = ndiff/mask_ref.size
+            rows.append({'engine':engine,'function':key,'case':case,
+                         'image':name,'delta':delta,'ndiff':ndiff,
+                         'ok':delta<=pix_tol})
+    return rows
+
+
+def check_pyramid_fallback():
+    '''thresholds of uniform histograms (no Otsu split) in the pyramid, 
+    they must be the threshold of the parent level
+    return:
+        rows: list of dict, as check_engine
+    '''
+    x = np.arange(360)+0.5
+    uniform = np.zeros(360,dtype=np.int64)
+    uniform[200] = 50000
+    mixed = np.zeros(360,dtype=np.int64)
+    mixed[5:20] = 1000
+    mixed[100:150] = 800
+    #image 0: one uniform tile, image 1: a uniform and a mixed tile
+    pyramid = sm.hist_pyramid([uniform[None,None,:],
+                               np.stack([uniform,mixed])[None,:,:]],block=1)
+    th = sm.hist_pyramid_thresholds(pyramid,x,min_count=100)
+    checks = [('block',th['block'][0],th['chantier']),
+              ('image',th['image'][0],th['block'][0]),
+              ('tile',th['tile'][0][0,0],th['image'][0]),
+              ('tile',th['tile'][1][0,0],th['image'][1])]
+    rows = []
+    for level,th_level,th_parent in checks:
+        delta = abs(float(th_level)-float(th_parent))
+        rows.append({'engine':'pyramid','function':'fallback_'+level,
+                     'case':'uniform','image':'synthetic','delta':delta,
+                     'ok':delta==0})
+    return rows
+
+
+def print_rows(rows):
+    for row in rows:
+        if 'ndiff' in row:
+            value = '{} pixels ({:.2e})'.format(row['ndiff'],row['delta'])
+        else:
+            value = 'threshold delta {:.6g}'.format(row['delta'])
+        print('{:<4s} {:<8s} {:<15s} {:<11s} {:<20s} {}'.format(
+            'OK' if row['ok'] else 'FAIL',row['engine'],row['function'],
+            row['case'],row['image'],value))
+
+
+def main(**kwargs):
+    '''
+        Description
+    args:
+        Description
+    returns:
+        Description
+    '''
+    src_path = kwargs.get('input','')
+    pref_rgb = kwargs.get('pref_rgb','')
+    pref_nir = kwargs.get('pref_nir','')
+    ext_rgb = kwargs.get('ext_rgb','.*')
+    ext_nir = kwargs.get('ext_nir','.*')
+    bits = int(kwargs.get('bits',8))
+    sub = int(kwargs.get('sub',10))
+    size = int(kwargs.get('size',1000))
+    th_tol = float(kwargs.get('th_tol',0))
+    pix_tol = float(kwargs.get('pix_tol',0))
+    if 'engines' in kwargs:
+        engines = kwargs.get('engines').split(',')
+    else:
+        engines = [e for e in ENGINES if e not in APPROXIMATE]
+    print('engines = ',engines)
+    print('threshold tolerance = ',th_tol)
+    print('pixel tolerance = ',pix_tol)
+
+    image_sets = []
+    if size>0:
+        synthetic = [('synthetic_'+str(k),bm.synthetic_bgrn(size,bits,seed=k))
+                     for k in range(2)]
+        image_sets.append(('synthetic rgb',
+                           [(name,img[:,:,0:3]) for name,img in synthetic]))
+        image_sets.append(('synthetic rgb+nir',synthetic))
+    if src_path!='':
+        images = load_images(src_path,pref_rgb,pref_nir,ext_rgb,ext_nir)
+        if len(images)==0:
+            print('no image found in',src_path)
+        else:
+            image_sets.append((src_path,images))
+    rows = []
+    if 'pyramid' in engines:
+        print('--- pyramid fallback ---')
+        rows += check_pyramid_fallback()
+        print_rows(rows)
+    for set_name,images in image_sets:
+        print('---',set_name,'---')
+        for engine in engines:
+            if engine not in ENGINES:
+                print('engine not available:',engine)
+                continue
+            engine_rows = check_engine(engine,images,bits,sub=sub,
+                                       th_tol=th_tol,pix_tol=pix_tol)
+            print_rows(engine_rows)
+            rows += engine_rows
+    failed = [row for row in rows if not row['ok']]
+    print(len(rows),'comparisons,',len(failed),'out of tolerance')
+    if failed:
+        os.sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(**dict([arg.split('=') for arg in os.sys.argv[1:]]))
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    footprints
+    ------------
+    Échantillonnage du seuillage global selon l'emprise au sol des images.
+    Les images aériennes voisines se recouvrent fortement (60%/30%), le
+    seuillage global décode et compte plusieurs fois le même terrain, ce qui
+    donne plus de poids aux zones de recouvrement.
+    A partir du géoréférencement des images, le terrain est découpé en
+    cellules; chaque cellule est attribuée à l'image dont le centre est le
+    plus proche (partie la plus proche du nadir). Une cellule du bord dont
+    le centre n'est dans aucune image est attribuée à l'image la plus
+    proche parmi celles qui la recoupent. Le seuillage ne lit que
+    la fenêtre des cellules attribuées à chaque image et ne compte que les
+    pixels de ces cellules: chaque zone du chantier est comptée une fois.
+
+    Les images doivent être orientées nord (geo_tsf[2]==geo_tsf[4]==0) avec
+    un géoréférencement; sinon l'image entière est échantillonnée.
+
+    Les fonctions utiles sont:
+        image_geometry: géoréférencement et dimensions d'une image
+        geo_footprint: emprise au sol d'une image
+        footprint_plan: attribution des cellules de terrain aux images
+        owned_window: fenêtre de lecture et pixels attribués d'une image
+        print_sampling: proportion de pixels lus par le seuillage
+"""
+
+import numpy as np
+import chantier_catalog as cat
+
+
+#geotransform of a raster without georeferencing
+_NO_GEOREF = (0.0,1.0,0.0,0.0,0.0,1.0)
+
+
+def image_geometry(file):
+    '''(geo_tsf,nx,ny) of an image, from its header'''
+    info = cat.raster_info(file)
+    if info is None:
+        return None
+    geo_tsf = tuple(float(v) for v in info['geo_tsf'].split(','))
+    return geo_tsf,info['nx'],info['ny']
+
+
+def geo_footprint(geo_tsf,nx,ny):
+    '''ground footprint of a north-up image
+    return:
+        (xmin,ymin,xmax,ymax), None if the image is rotated or has no
+        georeferencing
+    '''
+    if geo_tsf is None or tuple(geo_tsf)==_NO_GEOREF or \
+            geo_tsf[2]!=0 or geo_tsf[4]!=0:
+        return None
+    x0,y0 = geo_tsf[0],geo_tsf[3]
+    x1,y1 = x0+nx*geo_tsf[1],y0+ny*geo_tsf[5]
+    return min(x0,x1),min(y0,y1),max(x0,x1),max(y0,y1)
+
+
+def footprint_plan(geometries,cell=256):
+    '''ground cells of a set of images, each cell owned by one image
+    args:
+        geometries: list of (geo_tsf,nx,ny), see image_geometry
+        cell: cell size in pixels of the first image
+    return:
+        plan: dict, None if an image has no usable footprint (unreadable,
+              not georeferenced or rotated)
+            'geometries': geometries
+            'origin': (xmin,ymax) of the grid
+            'size': ground size of a cell
+            'owner': 2d array, index of the image owning each cell, -1 for
+                     cells out of all images. A cell is owned by the image
+                     of nearest center among the images holding the cell
+                     center, or else among the images overlapping the cell
+    '''
+    if any([g is None for g in geometries]):
+        return None
+    boxes = [geo_footprint(*g) for g in geometries]
+    if len(boxes)==0 or any([b is None for b in boxes]):
+        return None
+    size = cell*abs(geometries[0][0][1])
+    xmin = min([b[0] for b in boxes])
+    ymax = max([b[3] for b in boxes])
+    ncx = int(np.ceil((max([b[2] for b in boxes])-xmin)/size))
+    ncy = int(np.ceil((ymax-min([b[1] for b in boxes]))/size))
+    #nearest image holding the cell center, and nearest image overlapping
+    #the cell for the border cells whose center is in no image
+    owner = np.full((ncy,ncx),-1,dtype=np.int32)
+    best = np.full((ncy,ncx),np.inf)
+    owner_edge = np.full((ncy,ncx),-1,dtype=np.int32)
+    best_edge = np.full((ncy,ncx),np.inf)
+    for k,(bx0,by0,bx1,by1) in enumerate(boxes):
+        for sub_owner,sub_best,cx0,cx1,cy0,cy1 in [
+                #cells whose center is in the footprint
+                (owner,best,
+                 int(np.ceil((bx0-xmin)/size-0.5)),
+                 int(np.floor((bx1-xmin)/size-0.5)),
+                 int(np.ceil((ymax-by1)/size-0.5)),
+                 int(np.floor((ymax-by0)/size-0.5))),
+                #cells overlapping the footprint
+                (owner_edge,best_edge,
+                 int(np.floor((bx0-xmin)/size)),
+                 min(int(np.ceil((bx1-xmin)/size))-1,ncx-1),
+                 int(np.floor((ymax-by1)/size)),
+                 min(int(np.ceil((ymax-by0)/size))-1,ncy-1))]:
+            if cx1<cx0 or cy1<cy0:
+                continue
+            gx = xmin+(np.arange(cx0,cx1+1)+0.5)*size
+            gy = ymax-(np.arange(cy0,cy1+1)+0.5)*size
+            d = (gx[np.newaxis,:]-(bx0+bx1)/2)**2+\
+                (gy[:,np.newaxis]-(by0+by1)/2)**2
+            cells_best = sub_best[cy0:cy1+1,cx0:cx1+1]
+            closer = d<cells_best
+            cells_best[closer] = d[closer]
+            sub_owner[cy0:cy1+1,cx0:cx1+1][closer] = k
+    orphan = owner<0
+    owner[orphan] = owner_edge[orphan]
+    return {'geometries':geometries,'origin':(xmin,ymax),'size':size,
+            'owner':owner}
+
+
+def owned_window(plan,k,sub=1,within=None):
+    '''pixels of image k to read for the thresholding
+    args:
+        plan: footprint_plan() output, None to read the whole image
+        k: image index in the plan
+        sub: sub-sampling interval of the thresholding
+        within: (xoff,yoff,xsize,ysize), only the owned pixels in this
+                window are read (area of interest), None for no limit
+    return:
+        window: (xoff,yoff,xsize,ysize) in pixels, None if the image owns
+                no cell
+        owned: boolean array of the sub-sampled window, pixels of the cells
+               owned by the image, None for the whole image
+    '''
+    if plan is None:
+        return None,None
+    geo_tsf,nx,ny = plan['geometries'][k]
+    xmin,ymax = plan['origin']
+    size = plan['size']
+    #cell of each pixel center along columns and rows
+    px = geo_tsf[0]+(np.arange(nx)+0.5)*geo_tsf[1]
+    py = geo_tsf[3]+(np.arange(ny)+0.5)*geo_tsf[5]
+    ci = np.clip(((px-xmin)//size).astype(int),0,plan['owner'].shape[1]-1)
+    cj = np.clip(((ymax-py)//size).astype(int),0,plan['owner'].shape[0]-1)
+    own_cols = np.any(plan['owner'][:,ci]==k,axis=0)
+    own_rows = np.any(plan['owner'][cj,:]==k,axis=1)
+    if within is not None:
+        xoff,yoff,xsize,ysize = within
+        own_cols[0:xoff] = False
+        own_cols[xoff+xsize:] = False
+        own_rows[0:yoff] = False
+        own_rows[yoff+ysize:] = False
+    if not np.any(own_cols) or not np.any(own_rows):
+        return None,None
+    cols = np.flatnonzero(own_cols)
+    rows = np.flatnonzero(own_rows)
+    xoff,yoff = int(cols[0]),int(rows[0])
+    xsize,ysize = int(cols[-1])-xoff+1,int(rows[-1])-yoff+1
+    owned = plan['owner'][np.ix_(cj[yoff:yoff+ysize:sub],
+                                 ci[xoff:xoff+xsize:sub])]==k
+    if not np.any(owned):
+        return None,None
+    return (xoff,yoff,xsize,ysize),owned
+
+
+def print_sampling(plan,windows):
+    '''log of the decoded part of the images
+    args:
+        plan: footprint_plan() output
+        windows: owned_window() windows of the images, None for the images
+                 not read
+    '''
+    total = sum([nx*ny for _,nx,ny in plan['geometries']])
+    read = sum([w[2]*w[3] for w in windows if w is not None])
+    print('footprint sampling: {} of {} images read, {:.1f}% of the pixels '
+          'decoded'.format(len([w for w in windows if w is not None]),
+                           len(windows),100*read/total))
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    index_cache
+    ------------
+    Cache des cartes d'indice quantifiées (rapport Tsai06, Nagao79, NDWI,
+    NDVI) sur 8 ou 16 bits, un fichier .npy par indice et par image, lu en
+    projection mémoire (np.load(mmap_mode='r')).
+    Quand `threshold_input=input`, le seuillage global écrit les indices
+    pleine résolution des images qu'il décode; la création des masques
+    devient alors une comparaison des indices quantifiés avec les seuils,
+    sans décoder les images une deuxième fois. Un nouveau lancement avec
+    un seuil `th` donné n'a plus besoin des images. Le seuillage global ne
+    lit pas le cache: il décode toujours les images, sans `th` le
+    lancement suivant ne gagne que le décodage de la phase des masques.
+    Les indices sont calculés et quantifiés par bandes de lignes, écrits
+    directement dans les fichiers .npy (np.lib.format.open_memmap).
+    Les paramètres du calcul (bits, qbits, hue, nodata) sont enregistrés
+    par image dans name_index_cache.json, un cache écrit avec d'autres
+    paramètres n'est pas utilisé.
+
+    Quantification: les seuils globaux sont les centres des classes des
+    histogrammes (shadow_mask.index_bins), la grille de chaque indice
+    (_grid) place ces centres sur des niveaux entiers. Les valeurs sont
+    arrondies vers le haut pour les indices comparés avec '>' (rapport
+    Tsai06) et vers le bas pour '<' (Nagao79): avec qbits=16 la comparaison
+    avec un seuil de la grille donne exactement le masque calculé sur les
+    images. Les seuils NDWI et NDVI dépendent de l'étendue des valeurs des
+    images, ces indices sont gardés en float32 (arrondi vers le haut) avec
+    qbits=16. Avec qbits=8, ou un seuil `th` hors de la grille, un pixel
+    ne peut changer de classe que si son indice est à moins d'un pas du
+    seuil.
+
+    Les fonctions utiles sont:
+        index_keys: indices nécessaires pour une liste de méthodes
+        compute_indices: cartes d'indice pleine résolution d'une image
+        write_indices: écriture des indices quantifiés d'une image
+        has_indices: vérification de la présence des indices d'une image
+        read_index: lecture d'un indice quantifié (projection mémoire)
+        cached_mask: masque d'ombre à partir du cache
+        cached_masks_multi: masques de plusieurs méthodes à partir du cache
+"""
+
+import os
+import json
+from functools import partial
+import numpy as np
+import shadow_mask as sm
+import shadow_strips as ss
+
+
+CACHE_BITS = [8,16]
+META_NAME = 'index_cache.json'
+CACHE_VERSION = 2 #quantization of the indices, see quantize
+
+
+def index_range(key,bits):
+    '''value range of an index used for the quantization'''
+    if key in ['ratio','ratio_hsteq']:
+        #(H+1)/(I+1), H in [0,360[, I in [0,1] (slightly more for 16 bits)
+        return (0.0,362.0)
+    if key=='nagao':
+        return (0.0,float(2**bits-1))
+    if key in ['ndwi','ndvi']:
+        return (-1.0,1.0)
+    raise ValueError('unknown index '+key)
+
+
+def index_keys(runs,bands=3):
+    '''indices needed by a list of (method,hsteq) runs
+    args:
+        runs: list of (method,hsteq), see shadow_mask.method_runs
+        bands: 3 for rgb, 4 for rgb+nir (ndwi and ndvi added)
+    return:
+        list of index keys
+    '''
+    keys = []
+    for method,hsteq in runs:
+        if method=='tsai':
+            key = 'ratio_hsteq' if hsteq else 'ratio'
+        else:
+            key = 'nagao'
+        if key not in keys:
+            keys.append(key)
+    if bands>=4:
+        keys += ['ndwi','ndvi']
+    return keys
+
+
+def compute_indices(img,bits,keys,valid=None,hue='exact',i_hist=None):
+    '''full resolution index maps of an image
+    args:
+        img: bgr or bgrn image array
+        bits: color depth, 8 or 16
+        keys: index_keys() output
+        valid: valid pixels, for the hsteq equalization
+        hue: 'exact' or 'fast', see shadow_mask.hsi_ratio
+        i_hist: intensity histogram of the whole image for hsteq when img
+                is a strip, see shadow_mask.hsi_ratio
+    return:
+        dict {key:float index map}
+    '''
+    func = {'ratio':lambda: sm.hsi_ratio(img[:,:,0:3],bits,hue=hue),
+            'ratio_hsteq':lambda: sm.hsi_ratio(img[:,:,0:3],bits,hsteq=True,
+                                               valid=valid,hue=hue,
+                                               i_hist=i_hist),
+            'nagao':lambda: sm.nagao(img),
+            'ndwi':lambda: sm.ndwi(img),
+            'ndvi':lambda: sm.ndvi(img)}
+    return {key:func[key]() for key in keys}
+
+
+def _grid(key,bits,qbits):
+    '''quantization grid (offset,step,scale) of an index: value v is
+    quantized to scale*(v-offset)/step. The global thresholds (centers of
+    the histogram bins of shadow_mask.index_bins) are offset+step*k, with
+    an integer scale they fall on integer levels'''
+    vmin,vmax = index_range(key,bits)
+    if key in ['ratio','ratio_hsteq','nagao']:
+        bins_range,step = sm.index_bins('tsai' if key!='nagao' else 'nagao',
+                                        bits)
+        offset = bins_range[0]-step/2
+    else:
+        offset,step = vmin,1.0
+    scale = (2**qbits-1)/((vmax-offset)/step)
+    if scale>=1:
+        scale = np.floor(scale)
+    return offset,step,scale
+
+
+def _operator(key):
+    '''comparison of the shadow mask with the threshold of an index'''
+    return '<' if key=='nagao' else '>'
+
+
+def _dtype(key,qbits):
+    '''dtype of a cached index: ndwi and ndvi thresholds depend on the
+    value range of the images and are not on the quantization levels, they
+    are kept in float32 with qbits=16'''
+    if qbits==8:
+        return np.uint8
+    return np.float32 if key in ['ndwi','ndvi'] else np.uint16
+
+
+def quantize(v,key,bits,qbits=16):
+    '''index values to the dtype of the cache, rounded up for the indices
+    compared with '>' and down for '<' so that a value on the level of the
+    threshold is classified as in the image computation'''
+    up = _operator(key)=='>'
+    v = np.asarray(v,dtype=float)
+    if _dtype(key,qbits)==np.float32:
+        q = v.astype(np.float32)
+        inf = np.float32(np.inf if up else -np.inf)
+        return np.where(q<v if up else q>v,np.nextafter(q,inf),q)
+    offset,step,scale = _grid(key,bits,qbits)
+    q = (v-offset)/step*scale
+    q = np.ceil(q) if up else np.floor(q)
+    return np.clip(q,0,2**qbits-1).astype(_dtype(key,qbits))
+
+
+def _qthreshold(th,key,bits,qbits):
+    '''threshold in the quantized domain'''
+    offset,step,scale = _grid(key,bits,qbits)
+    return (np.asarray(th,dtype=float)-offset)/step*scale
+
+
+def _file(cache_dir,name,key):
+    return os.path.join(cache_dir,name+'_'+key+'.npy')
+
+
+def _meta_file(cache_dir,name):
+    return os.path.join(cache_dir,name+'_'+META_NAME)
+
+
+def _meta(bits,qbits,hue,nodata):
+    '''parameters of the cached indices of an image'''
+    return {'version':CACHE_VERSION,'bits':bits,'qbits':qbits,'hue':hue,
+            'nodata':None if nodata is None else float(nodata)}
+
+
+def _read_meta(cache_dir,name):
+    meta_file = _meta_file(cache_dir,name)
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+def _intensity(bgr,hue='exact'):
+    '''light intensity of hsi_ratio (hue='exact') or hsi_ratio_fast
+    (hue='fast'), same operations so that the hsteq histogram is the same'''
+    if hue=='fast':
+        I = bgr[:,:,0].astype(np.float32)+bgr[:,:,1].astype(np.float32)
+        I += bgr[:,:,2].astype(np.float32)
+        I *= np.float32(1/3)
+        return I
+    return bgr[:,:,0].astype(float)/3+bgr[:,:,1].astype(float)/3+\
+        bgr[:,:,2].astype(float)/3
+
+
+def write_indices(cache_dir,name,img,bits,keys,valid=None,qbits=16,
+                  hue='exact',nodata=None,strip=None):
+    '''compute and save the quantized indices of an image, strip by strip
+    args:
+        cache_dir: cache directory
+        name: image name
+        img: bgr or bgrn image array
+        bits: color depth of the image
+        keys: index_keys() output
+        valid: valid pixels (shadow_mask.valid_mask), saved with the indices
+        qbits: quantization, 8 or 16 bits
+        hue: 'exact' or 'fast', see shadow_mask.hsi_ratio
+        nodata: nodata value of valid, saved in the cache parameters
+        strip: number of rows of a strip, see shadow_strips.strip_slices
+    '''
+    if qbits not in CACHE_BITS:
+        print('cache bits must be 8 or 16!')
+        return
+    os.makedirs(cache_dir,exist_ok=True)
+    #the parameters are removed first, an interrupted write is not reused
+    meta_file = _meta_file(cache_dir,name)
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+    ny,nx = img.shape[0:2]
+    i_hist = None
+    if 'ratio_hsteq' in keys:
+        #the strips are equalized with the histogram of the whole image
+        i_hist = ss.hist_strips(partial(_intensity,hue=hue),img,
+                                [0,sm._pmax(bits)],workers=1,strip=strip,
+                                valid=valid)[1]
+    q = {key:np.lib.format.open_memmap(_file(cache_dir,name,key),mode='w+',
+                                       dtype=_dtype(key,qbits),
+                                       shape=(ny,nx))
+         for key in keys}
+    for s in ss.strip_slices(ny,1,strip):
+        v = compute_indices(img[s],bits,keys,
+                            valid=None if valid is None else valid[s],
+                            hue=hue,i_hist=i_hist)
+        for key in keys:
+            q[key][s] = quantize(v[key],key,bits,qbits)
+        v = None
+    for key in keys:
+        q[key].flush()
+    q = None
+    valid_file = _file(cache_dir,name,'valid')
+    if valid is not None:
+        np.save(valid_file,np.packbits(valid,axis=1))
+    elif os.path.exists(valid_file):
+        os.remove(valid_file)
+    with open(meta_file,'w') as f:
+        json.dump(_meta(bits,qbits,hue,nodata),f)
+
+
+def has_indices(cache_dir,name,keys,bits,qbits=16,hue='exact',nodata=None):
+    '''True if all the indices of an image are in the cache, written with
+    the same bits, qbits, hue and nodata (see write_indices)'''
+    if _read_meta(cache_dir,name)!=_meta(bits,qbits,hue,nodata):
+        return False
+    return all([os.path.exists(_file(cache_dir,name,key)) for key in keys])
+
+
+def read_index(cache_dir,name,key):
+    '''quantized index of an image, memory-mapped'''
+    return np.load(_file(cache_dir,name,key),mmap_mode='r')
+
+
+def _read_valid(cache_dir,name,shape):
+    valid_file = _file(cache_dir,name,'valid')
+    if not os.path.exists(valid_file):
+        return None
+    return np.unpackbits(np.load(valid_file),axis=1,
+                         count=shape[1]).astype(bool)
+
+
+def _compare(cache_dir,name,key,bits,th):
+    '''index>th (ndwi, ndvi, ratio) or index<th (nagao) on the quantized
+    index'''
+    q = read_index(cache_dir,name,key)
+    if q.dtype==np.float32:
+        #value rounded up (down) to float32, compared in float64
+        return q>th if _operator(key)=='>' else q<th
+    qth = _qthreshold(th,key,bits,8 if q.dtype==np.uint8 else 16)
+    #q rounded up: value>th <=> q>qth (exact for an integer qth)
+    if _operator(key)=='>':
+        return q>np.floor(qth)
+    #q rounded down: value<th <=> q<qth
+    return q<np.ceil(qth)
+
+
+def cached_mask(cache_dir,name,th,bits,method='tsai',hsteq=False,bands=3,
+                stats=None):
+    '''shadow mask from the cached indices, as shadow_mask_bgr (bands=3)
+    or shadow_mask_bgrn (bands=4)
+    args:
+        cache_dir: cache directory
+        name: image name
+        th: threshold (scalar or map) for bgr, [th1,th_wat,th_veg] for bgrn
+        bits: color depth of the image
+        method: 'tsai' or 'nagao'
+        hsteq: option of the tsai index
+        bands: 3 for rgb, 4 for rgb+nir
+        stats: dict updated with the pixel counts of the mask, see 
+               cached_masks_multi
+    return:
+        mask: boolean shadow mask
+    '''
+    th = {(method,hsteq and method=='tsai'):th}
+    run_stats = None if stats is None else {}
+    mask = cached_masks_multi(cache_dir,name,th,bits,bands=bands,
+                              stats=run_stats)[list(th)[0]]
+    if stats is not None:
+        sm.merge_stats(stats,run_stats[list(th)[0]])
+    return mask
+
+
+def cached_masks_multi(cache_dir,name,th,bits,bands=4,stats=None):
+    '''shadow masks of several runs from the cached indices, as
+    shadow_mask.shadow_mask_bgrn_multi
+    args:
+        th: dict {(method,hsteq):threshold}, see cached_mask
+        stats: dict updated with the statistics of each run, 
+               {(method,hsteq):stats}. Pixel counts only, the quantized
+               indices are not histogrammed
+    return:
+        masks: dict {(method,hsteq):boolean mask}
+    '''
+    if not th:
+        print('no method to run, no shadow mask')
+        return {}
+    keep = None
+    if bands>=4:
+        th_wat,th_veg = list(th.values())[0][1:3]
+        mask_wat = _compare(cache_dir,name,'ndwi',bits,th_wat)
+        mask_veg = _compare(cache_dir,name,'ndvi',bits,th_veg)
+        keep = ~(mask_wat|mask_veg)
+    masks = {}
+    for (method,hsteq),th_run in th.items():
+        th1 = th_run[0] if bands>=4 else th_run
+        if method=='tsai':
+            key = 'ratio_hsteq' if hsteq else 'ratio'
+            mask = _compare(cache_dir,name,key,bits,th1)
+        elif method=='nagao':
+            mask = _compare(cache_dir,name,'nagao',bits,th1)
+        else:
+            print("The available methods are:'bgr','nagao'")
+            continue
+        mask1 = mask.copy() if stats is not None else None
+        if keep is not None:
+            mask &= keep
+        valid = _read_valid(cache_dir,name,mask.shape)
+        if valid is not None:
+            mask &= valid
+        masks[(method,hsteq)] = mask
+        if stats is not None and keep is not None:
+            sm.mask_stats(stats.setdefault((method,hsteq),{}),mask,
+                          valid=valid,mask1=mask1,mask_wat=mask_wat,
+                          mask_veg=mask_veg)
+        elif stats is not None:
+            sm.mask_stats(stats.setdefault((method,hsteq),{}),mask,
+                          valid=valid)
+    return masks
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    mask_io
+    ------------
+    Écriture des masques d'ombre produits par shadow_mask_rgb.py et
+    shadow_mask_rgb_nir.py.
+
+    Les fonctions utiles sont:
+        source_georef: géoréférencement de l'image source
+        write_mask: enregistre un masque en tif 8 bits géoréférencé
+                    (ombre=0, reste=255) et/ou au format compact
+                    (compact_mask)
+        overview_levels: niveaux d'aperçus d'une image
+        write_vrt: mosaïque VRT des masques, écrite à partir des dimensions
+                   et du géoréférencement connus, sans relire les masques
+        write_mosaic: mosaïque VRT de tous les masques tif d'un répertoire,
+                      écrite une fois à la fin de la création des masques
+
+    Avec overviews=True, les aperçus sont calculés en mémoire avant
+    l'écriture du tif (tuilé, compressé), ce qui évite une passe gdaladdo
+    qui relit tous les masques.
+"""
+
+import os
+import glob
+from xml.sax.saxutils import escape
+import cv2
+import numpy as np
+import compact_mask as cm
+import archive_io as aio
+from osgeo import gdal
+
+
+MASK_FORMATS = ['tif','packed','both']
+MOSAIC_NAME = 'mask_mosaic.vrt'
+#value of the areas without mask in the mosaic, masks are 0 or 255
+MOSAIC_NODATA = 1
+
+
+def source_georef(src_file):
+    '''geotransform and projection of the source image'''
+    georef_src = gdal.Open(aio.to_vsi(src_file))
+    return georef_src.GetGeoTransform(),georef_src.GetProjection()
+
+
+def overview_levels(nx,ny,min_size=256):
+    '''overview factors 2,4,8... until the overview fits in min_size'''
+    levels = []
+    factor = 2
+    while max(nx,ny)/factor>=min_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def _write_tif_overviews(maskfile,mask8,geo_tsf,geo_proj,resampling):
+    '''write a tiled tif with overviews computed in memory'''
+    ny,nx = mask8.shape
+    mem = gdal.GetDriverByName('MEM').Create('',nx,ny,1,gdal.GDT_Byte)
+    mem.SetGeoTransform(geo_tsf)
+    mem.SetProjection(geo_proj)
+    mem.GetRasterBand(1).WriteArray(mask8)
+    levels = overview_levels(nx,ny)
+    if levels:
+        mem.BuildOverviews(resampling,levels)
+    gdal.GetDriverByName('GTiff').CreateCopy(maskfile,mem,
+                                             options=['TILED=YES',
+                                                      'COMPRESS=DEFLATE',
+                                                      'COPY_SRC_OVERVIEWS=YES'])
+
+
+def write_vrt(vrt_file,mosaic):
+    '''VRT mosaic of the masks
+    args:
+        vrt_file: output VRT file
+        mosaic: list of dict {'file','nx','ny','geo_tsf','geo_proj'}, 
+                masks must be north-up with the same pixel size
+    return:
+        True if the VRT is written
+    '''
+    if len(mosaic)==0:
+        return False
+    gt0 = mosaic[0]['geo_tsf']
+    for m in mosaic:
+        gt = m['geo_tsf']
+        if gt[2]!=0 or gt[4]!=0 or gt[1]!=gt0[1] or gt[5]!=gt0[5]:
+            print('mosaic VRT needs north-up masks with the same pixel size')
+            return False
+    xmin = min([m['geo_tsf'][0] for m in mosaic])
+    ymax = max([m['geo_tsf'][3] for m in mosaic])
+    xmax = max([m['geo_tsf'][0]+m['nx']*gt0[1] for m in mosaic])
+    ymin = min([m['geo_tsf'][3]+m['ny']*gt0[5] for m in mosaic])
+    nx = int(round((xmax-xmin)/gt0[1]))
+    ny = int(round((ymin-ymax)/gt0[5]))
+    vrt_dir = os.path.dirname(os.path.abspath(vrt_file))
+    lines = ['<VRTDataset rasterXSize="%d" rasterYSize="%d">'%(nx,ny),
+             '  <SRS>%s</SRS>'%escape(mosaic[0]['geo_proj']),
+             '  <GeoTransform>%s</GeoTransform>'%', '.join(
+                 [repr(float(v)) for v in (xmin,gt0[1],0,ymax,0,gt0[5])]),
+             '  <VRTRasterBand dataType="Byte" band="1">',
+             '    <NoDataValue>%d</NoDataValue>'%MOSAIC_NODATA]
+    for m in mosaic:
+        xoff = int(round((m['geo_tsf'][0]-xmin)/gt0[1]))
+        yoff = int(round((m['geo_tsf'][3]-ymax)/gt0[5]))
+        rel = os.path.relpath(os.path.abspath(m['file']),vrt_dir)
+        lines += ['    <SimpleSource>',
+                  '      <SourceFilename relativeToVRT="1">%s</SourceFilename>'
+                  %escape(rel.replace("\\","/")),
+                  '      <SourceBand>1</SourceBand>',
+                  '      <SrcRect xOff="0" yOff="0" xSize="%d" ySize="%d"/>'
+                  %(m['nx'],m['ny']),
+                  '      <DstRect xOff="%d" yOff="%d" xSize="%d" ySize="%d"/>'
+                  %(xoff,yoff,m['nx'],m['ny']),
+                  '    </SimpleSource>']
+    lines += ['  </VRTRasterBand>','</VRTDataset>']
+    #write then rename, the VRT stays readable while it is updated
+    tmp_file = vrt_file+'.tmp'
+    with open(tmp_file,'w') as f:
+        f.write('\n'.join(lines)+'\n')
+    os.replace(tmp_file,vrt_file)
+    return True
+
+
+def write_mask(mask,name,dst_path,georef,mask_format='tif',overviews=False,
+               mosaic=None,resampling='NEAREST'):
+    '''save a shadow mask
+    args:
+        mask: shadow mask, shadow pixels are 1
+        name: image name, files are mask_name.tif and mask_name.npz
+        dst_path: output directory
+        georef: (geo_tsf,geo_proj) of the source image
+        mask_format: 'tif' 8bits mask, 'packed' compact mask, or 'both'
+        overviews: build the tif overviews in memory
+        mosaic: list of the masks written by the run, the tif mask is 
+                added for write_mosaic. None for no mosaic
+        resampling: overviews resampling method, see gdal BuildOverviews
+    return:
+        list of the written files
+    '''
+    if mask_format not in MASK_FORMATS:
+        print("The available mask formats are:'tif','packed','both'")
+        mask_format = 'tif'
+    geo_tsf,geo_proj = georef
+    files = []
+    if mask_format in ['tif','both']:
+        maskfile = os.path.join(dst_path,'mask_'+name+'.tif')
+        mask8 = ((1-mask)*255).astype(np.uint8)
+        if overviews:
+            _write_tif_overviews(maskfile,mask8,geo_tsf,geo_proj,resampling)
+        else:
+            cv2.imwrite(maskfile,mask8)
+            #add georef from original image to mask
+            georef_dst = gdal.OpenShared(maskfile,gdal.GA_Update)
+            georef_dst.SetGeoTransform(geo_tsf)
+            georef_dst.SetProjection(geo_proj)
+            georef_dst = None
+        files.append(maskfile)
+        if mosaic is not None:
+            mosaic[:] = [m for m in mosaic if m['file']!=maskfile]
+            mosaic.append({'file':maskfile,'nx':mask8.shape[1],
+                           'ny':mask8.shape[0],'geo_tsf':tuple(geo_tsf),
+                           'geo_proj':geo_proj})
+    if mask_format in ['packed','both']:
+        maskfile = os.path.join(dst_path,'mask_'+name+'.npz')
+        cm.save_mask(maskfile,mask,geo_tsf,geo_proj)
+        files.append(maskfile)
+    return files
+
+
+def write_mosaic(dst_path,mosaic=None):
+    '''VRT mosaic dst_path/mask_mosaic.vrt of all the tif masks present in
+    dst_path, masks of previous runs included
+    args:
+        dst_path: output directory of the masks
+        mosaic: list of the masks written by the run (write_mask), their
+                header is not read again
+    return:
+        True if the VRT is written
+    '''
+    known = {os.path.abspath(m['file']):m for m in mosaic or []}
+    entries = []
+    for file in sorted(glob.glob(os.path.join(dst_path,'mask_*.tif'))):
+        m = known.get(os.path.abspath(file))
+        if m is None:
+            ds = gdal.Open(file)
+            if ds is None:
+                print('can not read',file)
+                continue
+            m = {'file':file,'nx':ds.RasterXSize,'ny':ds.RasterYSize,
+                 'geo_tsf':tuple(ds.GetGeoTransform()),
+                 'geo_proj':ds.GetProjection()}
+        entries.append(m)
+    return write_vrt(os.path.join(dst_path,MOSAIC_NAME),entries)
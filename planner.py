@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    planner
+    ------------
+    Plan d'exécution sous contrainte de mémoire. A partir d'un budget
+    mémoire (par exemple `max_mem=8G`), de la taille des images, du nombre
+    de bandes, de la profondeur de couleur et de la méthode, le planificateur
+    choisit la hauteur des bandes de lignes et le nombre de threads de
+    shadow_strips, pour le débit maximal sans dépasser le budget.
+
+    Les tableaux temporaires en float64 de hsi_ratio, nagao, ndwi et ndvi
+    représentent 10 à 20 fois la taille de l'image d'entrée; le
+    découpage en bandes limite ces temporaires à la bande en cours de chaque
+    thread, seuls l'image décodée et le masque restent en pleine taille.
+    Si le budget ne permet pas des bandes d'au moins _MIN_ROWS lignes, le
+    plan n'est pas réalisable (fits=False) et donne le budget minimal; les
+    scripts s'arrêtent alors au lieu de traiter des bandes d'une ligne.
+
+    Les fonctions utiles sont:
+        parse_mem: '8G' -> nombre d'octets
+        plan_mask: plan pour la création des masques
+        plan_thresholding: plan pour le seuillage global
+        print_plan: affichage du plan
+"""
+
+import os
+import numpy as np
+
+
+#float64 temporaries per pixel alive at the peak of each index computation
+_TEMP_FLOATS = {'tsai':10,'nagao':6}
+#ndwi + ndvi maps and their temporaries in shadow_mask_bgrn
+_TEMP_FLOATS_WAT_VEG = 4
+#extra float64 temporaries of the histogram equalization of hsteq
+_TEMP_FLOATS_HSTEQ = 3
+#part of the budget left for the interpreter, libraries and decoders
+_MARGIN = 0.85
+#minimal number of rows of a strip, smaller strips loose throughput
+_MIN_ROWS = 64
+
+_UNITS = {'':1,'K':1024,'M':1024**2,'G':1024**3,'T':1024**4}
+
+
+def parse_mem(mem):
+    '''memory size in bytes
+    args:
+        mem: int, or str like '8G', '512M', '2.5G'
+    return:
+        number of bytes
+    '''
+    if isinstance(mem,(int,float)):
+        return int(mem)
+    mem = mem.strip().upper().rstrip('B')
+    unit = mem[-1] if mem[-1] in _UNITS else ''
+    value = float(mem[0:len(mem)-len(unit)])
+    return int(value*_UNITS[unit])
+
+
+def _format_mem(nbytes):
+    for unit in ['T','G','M','K']:
+        if nbytes>=_UNITS[unit]:
+            return '{:.1f}{}'.format(nbytes/_UNITS[unit],unit)
+    return str(int(nbytes))
+
+
+def temp_bytes_per_pixel(bands,method,hsteq=False):
+    '''bytes of float64 temporaries per pixel of a strip
+    method may be a list of (method,hsteq) runs (shadow_mask.method_runs),
+    the index maps of the runs are then kept together until the masks'''
+    if isinstance(method,list):
+        n = max([temp_bytes_per_pixel(3,m,h)//8 for m,h in method])
+        n += len(method)
+        if bands>=4:
+            n += _TEMP_FLOATS_WAT_VEG
+        return 8*n
+    n = _TEMP_FLOATS[method]
+    if bands>=4:
+        n += _TEMP_FLOATS_WAT_VEG
+    if hsteq and method=='tsai':
+        n += _TEMP_FLOATS_HSTEQ
+    return 8*n
+
+
+def plan_mask(max_mem,nx,ny,bands,bits,method='tsai',hsteq=False,
+              max_workers=None,masked_image=False):
+    '''strip height and worker count for the mask of one image
+    args:
+        max_mem: memory budget, see parse_mem
+        nx,ny: image size
+        bands: 3 for rgb, 4 for rgb+nir
+        bits: color depth, 8 or 16
+        method: 'tsai' or 'nagao', or a list of (method,hsteq) runs
+        hsteq: the equalization of tsai needs the whole image, no strips
+        max_workers: maximal number of threads, default is the cpu count
+        masked_image: a 8bits copy of the image is saved with the mask
+    return:
+        plan: dict
+            'workers': number of threads
+            'strip': rows of a strip, None for the whole image
+            'fixed': bytes of the full size arrays
+            'peak': estimated peak bytes
+            'budget': max_mem in bytes
+            'fits': False if the budget can't hold strips of _MIN_ROWS 
+                    rows, the plan must not be run
+            'min_budget': smallest budget of a plan that fits
+    '''
+    budget = max(0,parse_mem(max_mem))
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    npix = nx*ny
+    sample = 1 if bits==8 else 2
+    #decoded image, plus rgb and nir read separately before assembly
+    fixed = npix*bands*sample*(2 if bands>=4 else 1)
+    #boolean mask and 8bits mask to save
+    fixed += 2*npix
+    if masked_image:
+        fixed += npix*3
+    per_pixel = temp_bytes_per_pixel(bands,method,hsteq)
+    available = budget*_MARGIN-fixed
+    plan = {'fixed':fixed,'budget':budget}
+    if hsteq and method!='nagao':
+        plan.update({'workers':1,'strip':None,'peak':fixed+npix*per_pixel})
+        plan['fits'] = plan['peak']<=budget*_MARGIN
+        plan['min_budget'] = int(np.ceil(plan['peak']/_MARGIN))
+        return plan
+    per_row = nx*per_pixel
+    min_rows = min(ny,_MIN_ROWS)
+    rows = int(available//per_row) if available>0 else 0
+    if rows>=ny:
+        #the whole image fits, one strip per thread at most
+        workers = max_workers
+        strip = int(-(-ny//workers))
+        if strip<_MIN_ROWS:
+            workers = max(1,ny//_MIN_ROWS)
+            strip = int(-(-ny//workers))
+    else:
+        workers = max(1,min(max_workers,rows//_MIN_ROWS))
+        strip = max(1,rows//workers)
+    plan.update({'workers':workers,'strip':strip,
+                 'peak':fixed+workers*strip*per_row,
+                 'fits':rows>=min_rows,
+                 'min_budget':int(np.ceil((fixed+min_rows*per_row)/_MARGIN))})
+    return plan
+
+
+def plan_thresholding(max_mem,nx,ny,bands,bits,n_images,sub,method='tsai',
+                      hsteq=False,max_workers=None):
+    '''worker count and strip height for the global thresholding
+    The sub-sampled images of the list are all kept in memory, their index
+    is computed strip by strip.
+    args:
+        see plan_mask
+        n_images: number of images used for the thresholding
+        sub: sub-sampling interval
+    return:
+        plan: dict, see plan_mask
+    '''
+    nx_sub = -(-nx//sub)
+    ny_sub = -(-ny//sub)
+    sample = 1 if bits==8 else 2
+    #one full image decoded at a time, the sub-sampled list kept
+    fixed = nx*ny*bands*sample+n_images*nx_sub*ny_sub*bands*sample
+    if bands>=4:
+        #ndwi and ndvi values of all images for their min/max
+        fixed += n_images*nx_sub*ny_sub*8
+    #budget left for the strips, the fixed arrays may exceed it
+    plan = plan_mask(max(0,parse_mem(max_mem)-fixed),nx_sub,ny_sub,bands,
+                     bits,method=method,hsteq=hsteq,max_workers=max_workers)
+    plan['fixed'] += fixed
+    plan['peak'] += fixed
+    plan['min_budget'] += fixed
+    plan['budget'] = parse_mem(max_mem)
+    return plan
+
+
+def print_plan(plan,phase):
+    '''log of the chosen plan, only the budget shortfall if nothing fits'''
+    if not plan['fits']:
+        print('error: the '+phase+' memory budget is too small for this '
+              'image size,',_format_mem(plan['budget']),'given, '
+              'max_mem must be at least',_format_mem(plan['min_budget']))
+        return
+    strip = 'whole image' if plan['strip'] is None else \
+        str(plan['strip'])+' rows'
+    print(phase+' plan: workers =',plan['workers'],', strip =',strip,
+          ', estimated peak =',_format_mem(plan['peak']),
+          '/ budget',_format_mem(plan['budget']))
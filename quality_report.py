@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    quality_report
+    ------------
+    Rapport de contrôle qualité des masques d'un chantier, une ligne par
+    image (et par méthode): fractions d'ombre, d'eau et de végétation,
+    histogramme de l'indice d'ombre, seuil propre à l'image et écart au
+    seuil global. Les statistiques sont collectées par les fonctions de
+    masque (shadow_mask.mask_stats) sur les tableaux déjà calculés, le
+    rapport ne relit ni les images ni les masques.
+    Un écart important entre le seuil propre à une image et le seuil
+    global, ou une forte proportion de pixels proches du seuil, signale
+    une image à vérifier.
+
+    Le rapport est écrit en CSV, ou en Parquet si le fichier a
+    l'extension .parquet et si pandas et pyarrow sont installés.
+
+    Les fonctions utiles sont:
+        report_row: ligne du rapport d'une image
+        write_report: écriture du rapport du chantier
+"""
+
+import os
+import csv
+import numpy as np
+import shadow_mask as sm
+
+try:
+    import pandas as pd
+    HAS_PANDAS = True
+except ImportError:
+    HAS_PANDAS = False
+
+
+#number of bins of the index histogram written in the report
+REPORT_BINS = 32
+#pixels closer to the threshold than NEAR_BINS histogram bins are counted
+#as near the threshold
+NEAR_BINS = 2
+#method of the image threshold, as the global thresholding
+_TH_METHODS = {'tsai':'otsu','nagao':'first_valley','ndwi':'last_valley',
+               'ndvi':'last_valley'}
+
+
+def _fraction(stats,key):
+    if key not in stats or stats.get('pixels',0)==0:
+        return np.nan
+    return stats[key]/stats['pixels']
+
+
+def _image_threshold(hist,x,method):
+    '''threshold of the image histogram, nan if the histogram is empty'''
+    if hist is None or np.sum(hist)==0:
+        return np.nan
+    return float(sm.hist_threshold(hist,x,method=_TH_METHODS[method]))
+
+
+def _near_fraction(hist,x,th):
+    '''part of the histogram within NEAR_BINS bins of the threshold'''
+    if hist is None or np.sum(hist)==0:
+        return np.nan
+    step = x[1]-x[0]
+    near = np.abs(x-th)<=NEAR_BINS*step
+    return float(np.sum(hist[near])/np.sum(hist))
+
+
+def report_row(name,stats,th,method,run=None):
+    '''report row of an image
+    args:
+        name: image name
+        stats: statistics of the mask, see shadow_mask.mask_stats
+        th: threshold of the shadow index (value or map), or
+            [th1,th_wat,th_veg] for rgb+nir
+        method: 'tsai' or 'nagao'
+        run: run name for a multi-method processing, default method
+    return:
+        row: dict of the report columns
+    '''
+    if np.ndim(th)==1 and len(th)==3:
+        th1,th_wat,th_veg = th
+    else:
+        th1,th_wat,th_veg = th,None,None
+    #mean of a threshold map (tile thresholds)
+    th1 = float(np.mean(th1))
+    row = {'name':name,'method':run or method,
+           'pixels':stats.get('pixels',0),
+           'shadow_fraction':_fraction(stats,'shadow'),
+           'water_fraction':_fraction(stats,'water'),
+           'vegetation_fraction':_fraction(stats,'vegetation'),
+           'excluded_fraction':_fraction(stats,'excluded'),
+           'threshold':th1}
+    hist,x = stats.get('hist'),stats.get('x')
+    row['image_threshold'] = _image_threshold(hist,x,method)
+    row['threshold_margin'] = row['image_threshold']-th1
+    row['near_threshold_fraction'] = _near_fraction(hist,x,th1)
+    for key,th_k in [('ndwi',th_wat),('ndvi',th_veg)]:
+        if th_k is None:
+            continue
+        th_img = _image_threshold(stats.get('hist_'+key),
+                                  stats.get('x_'+key),key)
+        row['threshold_'+key] = float(th_k)
+        row['image_threshold_'+key] = th_img
+        row['margin_'+key] = th_img-float(th_k)
+    #coarse histogram of the shadow index
+    if hist is not None:
+        edges = np.linspace(0,len(hist),REPORT_BINS+1).astype(int)
+        #reduceat gives hist[i] for an empty bin (repeated edge), not 0
+        coarse = np.where(np.diff(edges)>0,np.add.reduceat(hist,edges[:-1]),
+                          0)
+        step = x[1]-x[0]
+        row['hist_min'] = float(x[0]-step/2)
+        row['hist_max'] = float(x[-1]+step/2)
+    else:
+        coarse = [np.nan]*REPORT_BINS
+        row['hist_min'],row['hist_max'] = np.nan,np.nan
+    for k in range(REPORT_BINS):
+        row['hist_{:02d}'.format(k)] = coarse[k]
+    return row
+
+
+def write_report(file,rows):
+    '''write the report of a chantier
+    args:
+        file: .csv or .parquet file
+        rows: list of report_row() outputs
+    return:
+        the written file
+    '''
+    columns = []
+    for row in rows:
+        columns += [c for c in row if c not in columns]
+    if os.path.splitext(file)[1].lower()=='.parquet':
+        if HAS_PANDAS:
+            try:
+                pd.DataFrame(rows,columns=columns).to_parquet(file)
+                return file
+            except ImportError:
+                pass
+        print('parquet needs pandas and pyarrow, the report is written in '
+              'csv')
+        file = os.path.splitext(file)[0]+'.csv'
+    with open(file,'w',newline='') as f:
+        writer = csv.DictWriter(f,fieldnames=columns,restval='')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    return file
@@ -0,0 +1,549 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    shadow_chunks
+    ------------
+    Evaluation paresseuse par blocs (chunks) des fonctions de shadow_mask,
+    pour les chantiers qui dépassent la mémoire d'une machine. Les images
+    sont des tableaux Dask, ouverts par fenêtres sur les rasters
+    (open_image) ou venant d'objets xarray (rioxarray.open_rasterio avec
+    chunks). Les cartes d'indice et les masques sont des graphes Dask
+    calculés bloc par bloc; les seuillages globaux additionnent les
+    histogrammes des blocs par une réduction en arbre (split_every
+    histogrammes par noeud). La mémoire est bornée par la taille des blocs,
+    le même code tourne sur un poste (ordonnanceur par défaut de Dask) ou
+    sur un cluster local multi-processus (dask.distributed.Client).
+
+    Les fonctions utiles sont:
+        open_image: image lue par fenêtres, un bloc par fenêtre
+        open_bgrn: image RVB et image PIR en un tableau [b,g,r,nir]
+        as_chunked: tableau Dask [ny,nx,bandes] d'un tableau NumPy, Dask ou
+                    d'un DataArray xarray
+        hsi_ratio, nagao, ndvi, ndwi: cartes d'indice paresseuses
+        intensity_hists: histogrammes d'intensité des images pour hsteq
+        hist_chunks: histogramme d'un indice sur des images, réduction en
+                     arbre des histogrammes des blocs
+        shadow_mask_bgr, shadow_mask_bgrn, shadow_mask_bgrn_multi: masques
+                                                              paresseux
+        global_thresholding_bgr, global_thresholding_nagao,
+        global_thresholding_bgrn, global_thresholding_bgrn_multi:
+            seuillages globaux de shadow_mask par réduction des histogrammes
+
+    Les seuils et les masques sont identiques à ceux de shadow_mask, pixels
+    nodata compris. Les seuils NDWI/NDVI demandent 2 passes (bornes puis
+    histogrammes), les histogrammes des méthodes sont calculés pendant la
+    première. Avec hsteq=True l'histogramme d'intensité de chaque image est
+    réduit sur l'image entière avant l'égalisation bloc par bloc. Les
+    cartes de seuils par tuile (tile) ne sont pas prises en charge.
+    Dask est optionnel: sans dask, les fonctions l'indiquent et renvoient
+    None.
+"""
+
+from functools import partial
+import numpy as np
+import shadow_mask as sm
+
+try:
+    import dask
+    import dask.array as da
+    HAS_DASK = True
+except ImportError:
+    HAS_DASK = False
+
+
+#default chunk size in pixels
+CHUNK = 1024
+
+
+def _no_dask():
+    '''True, with a message, if dask is not installed'''
+    if not HAS_DASK:
+        print('dask is not installed, the chunked functions are not '
+              'available')
+    return not HAS_DASK
+
+
+def open_image(file,chunks=CHUNK):
+    '''lazy image array read by windows, as archive_io.read_image
+    args:
+        file: image file, may go through an archive
+        chunks: chunk size in pixels, rounded up to a multiple of the
+                raster block size so that a block is decoded once
+    return:
+        dask array [ny,nx] or [ny,nx,bands], bands in [b,g,r(,...)] order,
+        None if the file can't be read
+    '''
+    if _no_dask():
+        return None
+    #GDAL is only needed to open rasters, not for the in-memory arrays
+    import archive_io as aio
+    import chantier_catalog as cat
+    info = cat.raster_info(file)
+    if info is None:
+        print('can not read',file)
+        return None
+    nx,ny,nb = info['nx'],info['ny'],info['bands']
+    dtype = aio.read_image(file,window=(0,0,1,1)).dtype
+    cx = -(-chunks//info['block_x'])*info['block_x']
+    cy = -(-chunks//info['block_y'])*info['block_y']
+    read = dask.delayed(aio.read_image,pure=True)
+    rows = []
+    for y in range(0,ny,cy):
+        row = []
+        for x in range(0,nx,cx):
+            w,h = min(cx,nx-x),min(cy,ny-y)
+            shape = (h,w) if nb==1 else (h,w,nb)
+            row.append(da.from_delayed(read(file,window=(x,y,w,h)),shape,
+                                       dtype=dtype))
+        rows.append(da.concatenate(row,axis=1))
+    return da.concatenate(rows,axis=0)
+
+
+def open_bgrn(file_rgb,file_nir,chunks=CHUNK):
+    '''lazy [b,g,r,nir] array of an rgb image and its nir image, as the
+    bgrn array of shadow_mask_rgb_nir
+    args:
+        file_rgb, file_nir: image files
+        chunks: chunk size in pixels, see open_image
+    return:
+        dask array [ny,nx,4], None if a file can't be read
+    '''
+    bgr = open_image(file_rgb,chunks=chunks)
+    nir = open_image(file_nir,chunks=chunks)
+    if bgr is None or nir is None:
+        return None
+    if nir.ndim==3:
+        nir = nir[:,:,0]
+    nir = nir.astype(bgr.dtype).rechunk(bgr.chunks[0:2])
+    return da.concatenate([bgr[:,:,0:3],nir[:,:,None]],axis=2).rechunk(
+        {2:-1})
+
+
+def as_chunked(img,chunks=CHUNK):
+    '''chunked [ny,nx,bands] array of an image, one chunk along the bands
+    args:
+        img: dask array or NumPy array [ny,nx,bands] in [b,g,r(,...)]
+             order, or xarray DataArray opened from a raster (dims 'band',
+             'y','x'), whose bands are reordered to [b,g,r(,...)] as
+             archive_io.read_image does
+        chunks: chunk size in pixels of a NumPy array
+    return:
+        dask array
+    '''
+    if _no_dask():
+        return None
+    if hasattr(img,'dims'):
+        if 'band' in img.dims:
+            img = img.transpose(...,'band')
+            nb = img.sizes['band']
+            order = [2,1,0]+list(range(3,nb)) if nb>=3 else list(range(nb))
+            img = img.isel(band=order)
+        img = img.data
+    if not isinstance(img,da.Array):
+        img = da.from_array(img,chunks=(chunks,chunks)+(-1,)*(img.ndim-2))
+    if img.ndim==3:
+        img = img.rechunk({2:-1})
+    return img
+
+
+def _bins_center(bins_range,step=1):
+    '''bins center of shadow_mask.hist_uniform'''
+    return sm.hist_uniform(np.empty(0),bins_range,step=step)[0]
+
+
+def _block_hist(img,func,nodata,bins_range,step):
+    '''histogram of the index of a chunk, valid pixels only'''
+    v = sm._valid_values(func(img),sm.valid_mask(img,nodata))
+    return sm.hist_uniform(v,bins_range,step=step)[1][None,None,:]
+
+
+def _block_range(img,func,nodata):
+    '''[min,max] of the valid index values of a chunk, [inf,-inf] if none'''
+    v = sm._valid_values(func(img),sm.valid_mask(img,nodata))
+    if v.size==0:
+        return np.array([np.inf,-np.inf])[None,None,:]
+    return np.array([np.min(v),np.max(v)])[None,None,:]
+
+
+def _per_chunk(block_func,img,size,dtype):
+    '''[nby,nbx,size] lazy array of the 1d results of block_func for each
+    chunk of img'''
+    nby,nbx = img.numblocks[0:2]
+    return img.map_blocks(block_func,dtype=dtype,
+                          chunks=((1,)*nby,(1,)*nbx,(size,)))
+
+
+def _tree_sum(hists,split_every=None):
+    '''sum of lazy histograms by a tree reduction'''
+    return da.stack(hists).sum(axis=0,split_every=split_every)
+
+
+def _image_hist(func,img,bins_range,step=1,nodata=None,split_every=None):
+    '''lazy histogram of the index of an image, tree reduction of the
+    histograms of its chunks'''
+    size = len(_bins_center(bins_range,step))
+    block_func = partial(_block_hist,func=func,nodata=nodata,
+                         bins_range=bins_range,step=step)
+    return _per_chunk(block_func,img,size,np.int64).sum(
+        axis=(0,1),split_every=split_every)
+
+
+def _index_range(func,imgs,nodata=None,split_every=None):
+    '''lazy (min,max) of the valid index values of a list of images'''
+    parts = [_per_chunk(partial(_block_range,func=func,nodata=nodata),img,
+                        2,float) for img in imgs]
+    vmin = da.stack([p[:,:,0].min(split_every=split_every) for p in parts])
+    vmax = da.stack([p[:,:,1].max(split_every=split_every) for p in parts])
+    return vmin.min(),vmax.max()
+
+
+def hist_chunks(func,img_list,bins_range,step=1,nodata=None,
+                split_every=None):
+    '''histogram of an index over a list of images, the histograms of the
+    chunks are summed by a tree reduction
+    args:
+        func: index function of an image array, e.g. shadow_mask.nagao
+        img_list: list of images, see as_chunked
+        bins_range, step: see shadow_mask.hist_uniform
+        nodata: nodata value, invalid pixels are not counted
+        split_every: number of histograms summed by a node of the tree,
+                     dask default if None
+    return:
+        x: bins center
+        hist: lazy histogram, computed by hist.compute() or dask.compute
+    '''
+    if _no_dask():
+        return None
+    hists = [_image_hist(func,as_chunked(img),bins_range,step=step,
+                         nodata=nodata,split_every=split_every)
+             for img in img_list]
+    return _bins_center(bins_range,step),_tree_sum(hists,split_every)
+
+
+def _intensity(bgr,hue='exact'):
+    '''light intensity of hsi_ratio (hue='exact') or hsi_ratio_fast
+    (hue='fast'), same operations so that the hsteq histograms are the
+    same'''
+    if hue=='fast':
+        I = bgr[:,:,0].astype(np.float32)+bgr[:,:,1].astype(np.float32)
+        I += bgr[:,:,2].astype(np.float32)
+        I *= np.float32(1/3)
+        return I
+    return bgr[:,:,0].astype(float)/3+bgr[:,:,1].astype(float)/3+\
+        bgr[:,:,2].astype(float)/3
+
+
+def intensity_hists(img_list,bits,nodata=None,hue='exact',split_every=None):
+    '''lazy intensity histograms of the images for hsteq, one per image as
+    the equalization of hsi_ratio is done image by image
+    args:
+        img_list: list of images, see as_chunked
+        bits: color depth, 8 or 16
+        nodata: nodata value, invalid pixels are not counted
+        hue: 'exact' or 'fast', see shadow_mask.hsi_ratio
+        split_every: see hist_chunks
+    return:
+        list of lazy histograms, i_hist of hsi_ratio
+    '''
+    if _no_dask():
+        return None
+    return [_image_hist(partial(_intensity,hue=hue),as_chunked(img),
+                        [0,sm._pmax(bits)],nodata=nodata,
+                        split_every=split_every) for img in img_list]
+
+
+def _i_hist(img,bits,hsteq,nodata,hue,i_hist):
+    '''intensity histogram of an image for hsteq as a NumPy array, reduced
+    now if not given, None without hsteq'''
+    if not hsteq:
+        return None
+    if i_hist is None:
+        i_hist = intensity_hists([img],bits,nodata=nodata,hue=hue)[0]
+    if isinstance(i_hist,da.Array):
+        i_hist = i_hist.compute()
+    return i_hist
+
+
+def _index_map(func,img,dtype=float):
+    '''lazy 2d map of func applied to each chunk of an image'''
+    return img.map_blocks(func,drop_axis=2,dtype=dtype)
+
+
+def hsi_ratio(img,bits,hsteq=False,nodata=None,hue='exact',i_hist=None):
+    '''lazy shadow_mask.hsi_ratio of an image
+    args:
+        img: image, see as_chunked
+        bits, hsteq, hue: see shadow_mask.hsi_ratio
+        nodata: nodata value, invalid pixels are not counted in the hsteq
+                histogram
+        i_hist: intensity histogram of the image for hsteq
+                (intensity_hists), reduced before the graph is built if
+                None
+    return:
+        lazy ratio map
+    '''
+    if _no_dask():
+        return None
+    img = as_chunked(img)
+    i_hist = _i_hist(img,bits,hsteq,nodata,hue,i_hist)
+    return _index_map(partial(sm.hsi_ratio,bits=bits,hsteq=hsteq,hue=hue,
+                              i_hist=i_hist),img,
+                      dtype=np.float32 if hue=='fast' else float)
+
+
+def nagao(img):
+    '''lazy shadow_mask.nagao of a bgrn image, see as_chunked'''
+    if _no_dask():
+        return None
+    return _index_map(sm.nagao,as_chunked(img))
+
+
+def ndvi(img):
+    '''lazy shadow_mask.ndvi of a bgrn image, see as_chunked'''
+    if _no_dask():
+        return None
+    return _index_map(sm.ndvi,as_chunked(img))
+
+
+def ndwi(img):
+    '''lazy shadow_mask.ndwi of a bgrn image, see as_chunked'''
+    if _no_dask():
+        return None
+    return _index_map(sm.ndwi,as_chunked(img))
+
+
+def _block_mask(img,func,nodata,**kwargs):
+    '''mask function of a chunk, the valid pixels of the chunk are given
+    by nodata'''
+    return func(img,valid=sm.valid_mask(img,nodata),**kwargs)
+
+
+def _block_masks_multi(img,nodata,th,**kwargs):
+    '''shadow_mask_bgrn_multi of a chunk, masks stacked in the th order'''
+    masks = sm.shadow_mask_bgrn_multi(img,th,valid=sm.valid_mask(img,nodata),
+                                      **kwargs)
+    return np.stack([masks[run] for run in th],axis=2)
+
+
+def shadow_mask_bgr(img,th_hi_ratio,bits,hsteq=False,backend='numpy',
+                    nodata=None,hue='exact',i_hist=None):
+    '''lazy shadow_mask.shadow_mask_bgr of an image
+    args:
+        img: image, see as_chunked
+        th_hi_ratio: threshold value of (h+1)/(i+1) ratio
+        bits, hsteq, backend, hue: see shadow_mask.shadow_mask_bgr
+        nodata: nodata value, invalid pixels are not shadow
+        i_hist: intensity histogram for hsteq, see hsi_ratio
+    return:
+        lazy boolean mask
+    '''
+    if _no_dask():
+        return None
+    if np.ndim(th_hi_ratio)>0:
+        print('threshold maps are not supported by the chunked masks')
+        return None
+    img = as_chunked(img)
+    i_hist = _i_hist(img,bits,hsteq,nodata,hue,i_hist)
+    return _index_map(partial(_block_mask,func=sm.shadow_mask_bgr,
+                              nodata=nodata,th_hi_ratio=th_hi_ratio,
+                              bits=bits,hsteq=hsteq,backend=backend,hue=hue,
+                              i_hist=i_hist),img,dtype=bool)
+
+
+def shadow_mask_bgrn(img,th,bits,method,hsteq=False,backend='numpy',
+                     nodata=None,i_hist=None):
+    '''lazy shadow_mask.shadow_mask_bgrn of a bgrn image
+    args:
+        img: bgrn image, see as_chunked
+        th: [th1,th_wat,th_veg], global_thresholding_bgrn() output
+        bits, method, hsteq, backend: see shadow_mask.shadow_mask_bgrn
+        nodata: nodata value, invalid pixels are not shadow
+        i_hist: intensity histogram for hsteq, see hsi_ratio
+    return:
+        lazy boolean mask
+    '''
+    if _no_dask():
+        return None
+    if method not in ['tsai','nagao']:
+        print("The available methods are:'bgr','nagao'")
+        return None
+    img = as_chunked(img)
+    i_hist = _i_hist(img,bits,hsteq and method=='tsai',nodata,'exact',
+                     i_hist)
+    return _index_map(partial(_block_mask,func=sm.shadow_mask_bgrn,
+                              nodata=nodata,th=th,bits=bits,method=method,
+                              hsteq=hsteq,backend=backend,i_hist=i_hist),
+                      img,dtype=bool)
+
+
+def shadow_mask_bgrn_multi(img,th,bits,nodata=None,i_hist=None):
+    '''lazy shadow_mask.shadow_mask_bgrn_multi of a bgrn image, the runs
+    share the index maps of each chunk
+    args:
+        img: bgrn image, see as_chunked
+        th: global_thresholding_bgrn_multi() output
+        bits: color depth, 8 or 16
+        nodata: nodata value, invalid pixels are not shadow
+        i_hist: intensity histogram for the hsteq runs, see hsi_ratio
+    return:
+        masks: dict {(method,hsteq):lazy boolean mask}
+    '''
+    if _no_dask():
+        return None
+    th = {run:th_run for run,th_run in th.items()
+          if run[0] in ['tsai','nagao']}
+    if len(th)==0:
+        print("The available methods are:'bgr','nagao'")
+        return {}
+    img = as_chunked(img)
+    hsteq = any([method=='tsai' and hsteq for method,hsteq in th])
+    i_hist = _i_hist(img,bits,hsteq,nodata,'exact',i_hist)
+    masks = img.map_blocks(partial(_block_masks_multi,nodata=nodata,th=th,
+                                   bits=bits,i_hist=i_hist),dtype=bool,
+                           chunks=img.chunks[0:2]+((len(th),),))
+    return {run:masks[:,:,k] for k,run in enumerate(th)}
+
+
+def global_thresholding_bgr(img_list,bits,hsteq=False,nodata=None,
+                            hue='exact',split_every=None):
+    '''
+    shadow_mask.global_thresholding_bgr of chunked images, the ratio
+    histograms of the chunks are summed by a tree reduction
+    ---------------
+    args:
+        img_list: list of bgr images, see as_chunked
+        bits, hsteq, hue: see shadow_mask.global_thresholding_bgr
+        nodata: nodata value, invalid pixels are not counted
+        split_every: see hist_chunks
+    return:
+        th: Otsu threshod of (H+1)/(Ieq+1) ratio
+    '''
+    if _no_dask():
+        return None
+    imgs = [as_chunked(img) for img in img_list]
+    i_hists = [None]*len(imgs)
+    if hsteq:
+        i_hists = dask.compute(intensity_hists(imgs,bits,nodata=nodata,
+                                               hue=hue,
+                                               split_every=split_every))[0]
+    bins_range,step = sm.index_bins('tsai',bits)
+    hist = _tree_sum([_image_hist(partial(sm.hsi_ratio,bits=bits,
+                                          hsteq=hsteq,hue=hue,i_hist=h),
+                                  img,bins_range,step=step,nodata=nodata,
+                                  split_every=split_every)
+                      for img,h in zip(imgs,i_hists)],split_every)
+    return sm.hist_threshold(hist.compute(),_bins_center(bins_range,step),
+                             method='otsu')
+
+
+def global_thresholding_nagao(img_list,bits,nodata=None,split_every=None):
+    '''
+    shadow_mask.global_thresholding_nagao of chunked images, the nagao
+    histograms of the chunks are summed by a tree reduction
+    args:
+        img_list: list of bgrn images, see as_chunked
+        bits: color depth, 8 or 16
+        nodata: nodata value, invalid pixels are not counted
+        split_every: see hist_chunks
+    returns:
+        th_nagao: shadow thresholdng from bgrn image
+    '''
+    if _no_dask():
+        return None
+    bins_range,step = sm.index_bins('nagao',bits)
+    x,hist = hist_chunks(sm.nagao,img_list,bins_range,step=step,
+                         nodata=nodata,split_every=split_every)
+    return sm.hist_threshold(hist.compute(),x,method='first_valley')
+
+
+def global_thresholding_bgrn(img_list,bits,method,hsteq=False,nodata=None,
+                             split_every=None):
+    '''
+    shadow_mask.global_thresholding_bgrn of chunked images
+    args:
+        img_list: list of bgrn images, see as_chunked
+        bits, method, hsteq: see shadow_mask.global_thresholding_bgrn
+        nodata: nodata value, invalid pixels are not counted
+        split_every: see hist_chunks
+    returns:
+        th = [th1,th_wat,th_veg]
+    '''
+    run = (method,hsteq and method=='tsai')
+    th = global_thresholding_bgrn_multi(img_list,bits,[run],nodata=nodata,
+                                        split_every=split_every)
+    return None if th is None else th.get(run)
+
+
+def global_thresholding_bgrn_multi(img_list,bits,runs,nodata=None,
+                                   split_every=None):
+    '''
+    shadow_mask.global_thresholding_bgrn_multi of chunked images, in 2
+    passes over the images: the histograms of the runs (without hsteq),
+    the hsteq intensity histograms and the NDWI/NDVI ranges, then the
+    NDWI/NDVI histograms and the histograms of the hsteq runs. The
+    histograms of the chunks are summed by a tree reduction.
+    args:
+        img_list: list of bgrn images, see as_chunked
+        bits: color depth, 8 or 16
+        runs: shadow_mask.method_runs() output
+        nodata: nodata value, invalid pixels are not counted
+        split_every: see hist_chunks
+    returns:
+        th: dict {(method,hsteq):[th1,th_wat,th_veg]}
+    '''
+    if _no_dask():
+        return None
+    imgs = [as_chunked(img) for img in img_list]
+    for run in runs:
+        if run[0] not in ['tsai','nagao']:
+            print("The available methods are:'bgr','nagao'")
+    runs = [run for run in runs if run[0] in ['tsai','nagao']]
+    hsteq_runs = [run for run in runs if run[0]=='tsai' and run[1]]
+
+    def run_hist(run,i_hists):
+        method,hsteq = run
+        if method=='tsai':
+            funcs = [partial(sm.hsi_ratio,bits=bits,hsteq=hsteq,i_hist=h)
+                     for h in i_hists]
+        else:
+            funcs = [sm.nagao]*len(imgs)
+        bins_range,step = sm.index_bins(method,bits)
+        return _tree_sum([_image_hist(func,img,bins_range,step=step,
+                                      nodata=nodata,split_every=split_every)
+                          for func,img in zip(funcs,imgs)],split_every)
+
+    #pass 1
+    first = {'ndwi':_index_range(sm.ndwi,imgs,nodata,split_every),
+             'ndvi':_index_range(sm.ndvi,imgs,nodata,split_every),
+             'i_hist':[]}
+    if len(hsteq_runs)>0:
+        first['i_hist'] = intensity_hists(imgs,bits,nodata=nodata,
+                                          split_every=split_every)
+    for run in runs:
+        if run not in hsteq_runs:
+            first[run] = run_hist(run,[None]*len(imgs))
+    first = dask.compute(first)[0]
+    #pass 2
+    second = {}
+    for key,func in [('ndwi',sm.ndwi),('ndvi',sm.ndvi)]:
+        vmin,vmax = first[key]
+        second[key] = hist_chunks(func,imgs,[vmin,vmax],
+                                  step=(vmax-vmin)/1000,nodata=nodata,
+                                  split_every=split_every)[1]
+    for run in hsteq_runs:
+        second[run] = run_hist(run,first['i_hist'])
+    second = dask.compute(second)[0]
+    #thresholds, as water_detection and vegetation_detection
+    th_wv = []
+    for key in ['ndwi','ndvi']:
+        vmin,vmax = first[key]
+        x = _bins_center([vmin,vmax],(vmax-vmin)/1000)
+        th_wv.append(sm.hist_threshold(second[key],x,method='last_valley'))
+    th = {}
+    for run in runs:
+        hist = second[run] if run in hsteq_runs else first[run]
+        x = _bins_center(*sm.index_bins(run[0],bits))
+        th1 = sm.hist_threshold(hist,x,method='otsu' if run[0]=='tsai'
+                                else 'first_valley')
+        th[run] = [th1]+th_wv
+    return th
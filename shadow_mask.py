@@ -28,15 +28,39 @@ Module name:
         
         
         hsi_ratio: calculer le rapport (H+1)/(I+1)
+        hsi_ratio_fast: rapport (H+1)/(I+1) avec une teinte approchée, en 
+                        float32
         nagao: calculer la luminosité pondérée d'image RVB-PIR
         hist_uniform: histogramme uniform
         hist_eq: histogramme egalisation
         hist_valleys: les indices des vallée dans la courbe d'histogramme
         otsu_threshoding: seuillage Otsu
+        otsu_thresholds: seuillage Otsu d'une pile d'histogrammes, 
+                         vectorisé
         linear_stretch_16bits_to_8bits: transformation 16bits en 8 bits par 
                      l'etirement lineaire
         ndwi: indice d'eau
         ndvi: indice de végétation
+        tile_histograms: histogrammes par tuile d'une carte d'indice
+        hist_pyramid: pyramide d'histogrammes tuile/image/bloc/chantier
+        hist_threshold: seuil d'un histogramme (Otsu, première ou dernière
+                        vallée)
+        hist_pyramid_thresholds: seuils par niveau de la pyramide, avec
+                                 repli sur le niveau parent
+        threshold_map: carte de seuils par pixel à partir des seuils par tuile
+        global_thresholding_bgr_pyramid: seuillage Tsai06 adaptatif par tuile
+        valid_mask: pixels valides d'une image (différents de nodata)
+        valid_bbox: emprise des pixels valides
+        valid_area_mask: masque calculé sur l'emprise des pixels valides
+        method_runs: combinaisons méthode/hsteq d'un traitement multi-méthodes
+        global_thresholding_bgrn_multi: seuillage global RVB+PIR pour 
+                                        plusieurs méthodes
+        shadow_mask_bgrn_multi: masques d'ombre RVB+PIR pour plusieurs 
+                                méthodes, indices communs calculés une fois
+        mask_stats: statistiques d'un masque (fractions d'ombre, d'eau, de 
+                    végétation, histogrammes des indices) à partir des 
+                    tableaux déjà calculés pour le masque
+        merge_stats: somme des statistiques de plusieurs bandes
     
     modification 2022-02-07: 
         correction of ndvi() and ndwi()
@@ -57,17 +81,128 @@ Module name:
         est suppérimé.
     modification 2022-02-10:
         fix the bug in vegetation_detection()
+    modification 2026-10-19:
+        add the histogram pyramid (tile_histograms, hist_pyramid,
+        hist_pyramid_thresholds, threshold_map). A single global threshold
+        misses scenes only present in 1 or 2 images; the pyramid gives a
+        threshold per tile, falling back to image, block of images and
+        chantier level when a histogram holds too few pixels.
+        shadow_mask_bgr() accepts a threshold map as well as a scalar.
+    modification 2026-10-19:
+        add backend option to shadow_mask_bgr() and shadow_mask_bgrn(),
+        backend='numba' computes the mask in one fused multithreaded loop
+        (shadow_kernels), with NumPy fallback when numba is not installed,
+        when hsteq=True or when the threshold is a map.
+    modification 2026-10-19:
+        nodata handling. valid_mask() and valid_bbox() find the valid pixels
+        and their bounding box; the global thresholding functions take a
+        valid_list and exclude invalid pixels from the histograms, the mask
+        functions take valid and set invalid pixels to non-shadow. hist_eq
+        and hsi_ratio exclude them from the equalization histogram.
+    modification 2026-10-19:
+        multi-method runs. global_thresholding_bgrn_multi() and
+        shadow_mask_bgrn_multi() give the thresholds and masks of several
+        (method,hsteq) runs from the same images; NDWI, NDVI, nagao and
+        hsi_ratio are computed once per image and shared by the runs.
+    modification 2026-10-19:
+        fast approximate hue. hsi_ratio(), global_thresholding_bgr(),
+        global_thresholding_bgr_pyramid() and shadow_mask_bgr() take
+        hue='fast': float32 atan2 on exact integer combinations, without
+        the degrees and boolean indexing passes (hsi_ratio_fast), max hue
+        error below 0.001 degree.
+    modification 2026-10-19:
+        mask statistics. shadow_mask_bgr(), shadow_mask_bgrn() and
+        shadow_mask_bgrn_multi() take stats, a dict filled by mask_stats()
+        with pixel counts and index histograms from the arrays already
+        computed for the mask (index map, mask_wat, mask_veg, ndwi, ndvi),
+        for the quality report without reading the masks again.
+    modification 2026-10-19:
+        hist_eq() takes a precomputed histogram, hsi_ratio() and the mask
+        functions take i_hist, the intensity histogram of the whole image
+        for hsteq, so that a chunk of the image is equalized as the whole
+        image (shadow_chunks).
 """
 
 import numpy as np
 from scipy.ndimage import gaussian_filter1d
 from scipy.signal import find_peaks
+import shadow_kernels as sk
 
 
 _PMAX16 = 65000 #pixel value considered as max of 16 bits raw, to avoid invalid pixel
 _PMAX8 = 255 #pixel value considered as max of 8 bits
 
-def hsi_ratio(bgr,bits,hsteq=False):
+def _pmax(bits):
+    '''pixel value considered as max for the color depth'''
+    if bits==8:
+        return _PMAX8
+    elif bits==16:
+        return _PMAX16
+    else:
+        print('color depth must be 8 or 16!')
+
+
+def valid_mask(img,nodata):
+    '''valid pixels of an image
+    args:
+        img: image array [ny,nx] or [ny,nx,bands]
+        nodata: nodata value, a pixel is invalid if all its bands are 
+                equal to nodata
+    return:
+        valid: boolean array [ny,nx], None if nodata is None
+    '''
+    if nodata is None:
+        return None
+    if img.ndim==2:
+        return img!=nodata
+    return np.any(img!=nodata,axis=2)
+
+
+def valid_bbox(valid):
+    '''bounding box of the valid pixels
+    args:
+        valid: boolean array [ny,nx]
+    return:
+        (rows,cols) slices of the bounding box, None if no valid pixel
+    '''
+    rows = np.flatnonzero(np.any(valid,axis=1))
+    if len(rows)==0:
+        return None
+    cols = np.flatnonzero(np.any(valid,axis=0))
+    return (slice(int(rows[0]),int(rows[-1])+1),
+            slice(int(cols[0]),int(cols[-1])+1))
+
+
+def valid_area_mask(func,img,valid,keys=None):
+    '''shadow mask computed only on the bounding box of the valid pixels,
+    the nodata collar is not processed
+    args:
+        func: mask function func(img_box,box,valid_box), box is the (rows,
+              cols) slices of img_box in img, for the threshold maps
+        img: image array
+        valid: valid_mask() output, None for the whole image
+        keys: keys of the dict returned by func for several masks (see 
+              shadow_mask_bgrn_multi), None if func returns one mask
+    return:
+        mask: boolean shadow mask of the image size, False out of the box,
+              dict of masks if keys is given
+    '''
+    if valid is None:
+        box = (slice(0,img.shape[0]),slice(0,img.shape[1]))
+        return func(img,box,None)
+    masks = {key:np.zeros(valid.shape,dtype=bool) 
+             for key in (keys if keys is not None else [None])}
+    box = valid_bbox(valid)
+    if box is not None:
+        res = func(img[box],box,valid[box])
+        if keys is None:
+            res = {None:res}
+        for key in masks:
+            masks[key][box] = res[key]
+    return masks if keys is not None else masks[None]
+
+
+def hsi_ratio(bgr,bits,hsteq=False,valid=None,hue='exact',i_hist=None):
     '''
     hsteq is an option for some raw 16bits images without pre-processing,
     because these images could have a very tight light intensity histogram.
@@ -78,6 +213,13 @@ def hsi_ratio(bgr,bits,hsteq=False):
         bgr: image array [blue, green, red], 8bits or 16bits
         bits: =8 for 8bits image, =16 for 16bits image
         hsteq: =False, no histogrqm equalization by default
+        valid: boolean array of valid pixels, only they are used for the 
+               histogram of hsteq. None: all pixels are valid
+        hue: 'exact' (default) or 'fast' for the approximate hue of 
+             hsi_ratio_fast
+        i_hist: histogram of the intensity for hsteq, computed on the whole
+                image when bgr is a part of it (chunk), default the 
+                histogram of bgr
     output:
         R = (H+1)/(I'+1) ratio
         H: hue 
@@ -91,6 +233,11 @@ def hsi_ratio(bgr,bits,hsteq=False):
         PMAX = _PMAX16
     else:
         print('color depth must be 8 or 16!')
+    if hue=='fast':
+        return hsi_ratio_fast(bgr,PMAX,hsteq=hsteq,valid=valid,
+                              i_hist=i_hist)
+    elif hue!='exact':
+        print("The available hue modes are:'exact','fast'")
         
     b = bgr[:,:,0].astype(float)
     g = bgr[:,:,1].astype(float)
@@ -112,12 +259,54 @@ def hsi_ratio(bgr,bits,hsteq=False):
         In = I/PMAX
         R = (H+1)/(In+1)
     else:    
-        Ieq = hist_eq(I,[0,PMAX])
+        Ieq = hist_eq(I,[0,PMAX],valid=valid,hist=i_hist)
         R = (H+1)/(Ieq+1)
     
     return R
 
 
+def hsi_ratio_fast(bgr,PMAX,hsteq=False,valid=None,i_hist=None):
+    '''(H+1)/(I'+1) ratio of hsi_ratio with an approximate hue, in float32
+    with in-place operations: about 3 times faster than hsi_ratio.
+    V1 and V2 share the 1/sqrt(6) factor, the hue is atan2(r-2g,2b-r-g)
+    computed on exact integer combinations, the octant of the hue is exact.
+    The float32 atan2 of NumPy is vectorized, the max hue error is below 
+    0.001 degree (ratio error below 0.001, 0.002 with hsteq), except for 
+    the pixels with r=2g and 2b=r+g (hue undefined, 0 here, rounding noise
+    in hsi_ratio).
+    args:
+        bgr: image array [blue, green, red], 8bits or 16bits
+        PMAX: pixel value considered as max, see _pmax
+        hsteq, valid, i_hist: see hsi_ratio
+    return:
+        R: float32 ratio
+    '''
+    b = bgr[:,:,0].astype(np.float32)
+    g = bgr[:,:,1].astype(np.float32)
+    r = bgr[:,:,2].astype(np.float32)
+    V1 = b+b
+    V1 -= r
+    V1 -= g
+    V2 = g+g
+    np.subtract(r,V2,out=V2)
+    H = np.arctan2(V2,V1)
+    H *= np.float32(180/np.pi)
+    #wrap ]-180,0[ to ]180,360[ without boolean indexing
+    H += np.float32(360)*(H<0)
+    H += 1
+    I = b
+    I += g
+    I += r
+    I *= np.float32(1/3)
+    if hsteq==False:
+        I *= np.float32(1/PMAX)
+        I += 1
+    else:
+        I = hist_eq(I,[0,PMAX],valid=valid,hist=i_hist)+1
+    H /= I
+    return H
+
+
 def nagao(bgrn):
     '''NAGAO79, weighted light indensity 
     args:
@@ -145,15 +334,22 @@ def hist_uniform(v,bins_range,step=1):
     return x,hist
 
 
-def hist_eq(i,bins_range):
+def hist_eq(i,bins_range,valid=None,hist=None):
     '''histogram equalization
     args:
         i: input 2d array
+        valid: boolean array, pixels used for the histogram, default all
+        hist: histogram of hist_uniform(.,bins_range) to equalize with, 
+              e.g. of the whole image when i is a chunk, default the
+              histogram of i
     return:
         o: result
     '''
     v = i.copy()
-    x,hist = hist_uniform(v,bins_range)            
+    if hist is None:
+        x,hist = hist_uniform(v if valid is None else v[valid],bins_range)
+    else:
+        x,_ = hist_uniform(np.empty(0),bins_range)
     hist_norm = hist.ravel()/hist.sum()
     hist_cum = hist_norm.cumsum()        
     vmin1 = x[0]
@@ -226,7 +422,49 @@ def otsu_thresholding(hist,bins):
     
     return int(ith)
 
-def global_thresholding_bgr(bgr_list,bits,hsteq=False):
+
+def otsu_thresholds(hists,bins):
+    '''otsu_thresholding of a stack of histograms, vectorized over the
+    histograms and the split index with cumulative sums
+    args:
+       hists: 2d array [histogram,bins]
+       bins: bin value
+    returns:
+        ith: 1d array of threshold index, th = bins[ith], -1 if no split
+    Note:
+        Same index as otsu_thresholding, except for splits of equal 
+        criterion (empty bins between them): the first one is taken here,
+        the loop of otsu_thresholding picks one by rounding.
+    '''
+    hist_norm = hists/hists.sum(axis=1,keepdims=True)
+    Q = hist_norm.cumsum(axis=1)
+    nb = len(bins)
+    #sums of p, p*b, p*b**2 over bins[:i] for i in [1,nb[
+    c0 = Q[:,:-1]
+    c1 = (hist_norm*bins).cumsum(axis=1)
+    c2 = (hist_norm*bins**2).cumsum(axis=1)
+    s1a,s2a = c1[:,:-1],c2[:,:-1]
+    s0b,s1b,s2b = Q[:,-1:]-c0,c1[:,-1:]-s1a,c2[:,-1:]-s2a
+    #class weights as otsu_thresholding, q1 includes the bin i
+    q1 = Q[:,1:]
+    q2 = Q[:,-1:]-q1
+    skip = (q1<1.e-6)|(q2<1.e-6)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        m1,m2 = s1a/q1,s1b/q2
+        #sum((b-m)**2*p) = s2-2*m*s1+m**2*s0
+        fn = (s2a-2*m1*s1a+m1**2*c0)+(s2b-2*m2*s1b+m2**2*s0b)
+    fn[skip|np.isnan(fn)] = np.inf
+    ith = np.argmin(fn,axis=1)+1
+    ith[np.isinf(fn[np.arange(len(fn)),ith-1])] = -1
+    return ith
+
+def _valid_values(v,valid):
+    '''flatten index map, only valid pixels'''
+    return v.flatten() if valid is None else v[valid]
+
+
+def global_thresholding_bgr(bgr_list,bits,hsteq=False,valid_list=None,
+                            hue='exact'):
     '''
     global thresholding for a set of bgr images, tsai06 method
     ---------------
@@ -234,16 +472,21 @@ def global_thresholding_bgr(bgr_list,bits,hsteq=False):
         bgr_list: list of image bgr array 
         bits: color depth, 8 or 16
         hsteq: option, must use the same option for shadow_mask 
+        valid_list: list of valid pixels arrays (valid_mask), invalid 
+                    pixels are not counted in the histogram. default None
+        hue: 'exact' or 'fast', see hsi_ratio
     return:
         th: Otsu threshod of (H+1)/(Ieq+1) ratio
     Note:
         The input bgr image could be sub-sampled to reduce the image size
     '''   
+    if valid_list is None:
+        valid_list = [None]*len(bgr_list)
     R = []
-    for bgr in bgr_list: 
+    for bgr,valid in zip(bgr_list,valid_list): 
         #tsai h-i ratio
-        r = hsi_ratio(bgr,bits,hsteq=hsteq)
-        R.append(r.flatten())         
+        r = hsi_ratio(bgr,bits,hsteq=hsteq,valid=valid,hue=hue)
+        R.append(_valid_values(r,valid))         
     R1 = [x for sub in R for x in sub]
     R = np.array(R1)   
     #otsu thresholding
@@ -251,20 +494,224 @@ def global_thresholding_bgr(bgr_list,bits,hsteq=False):
     ith = otsu_thresholding(hist, x)
     th = x[ith]       
     return th 
+
+
+def tile_histograms(v,bins_range,tile,step=1):
+    '''histograms of an index map computed tile by tile, in one pass
+    args:
+        v: 2d index map, e.g. hsi_ratio() or nagao() output
+        bins_range: [min,max] range of bins, same as hist_uniform
+        tile: tile size in pixels of v
+        step: bins step, default=1
+    return:
+        x: bins center
+        hist: 3d array [tile_row,tile_col,bins], the sum over the tiles 
+              is the histogram of hist_uniform
+    '''
+    bins = np.arange(bins_range[0],bins_range[1]+step,step)
+    nbins = len(bins)-1
+    ny,nx = v.shape
+    nty = int(np.ceil(ny/tile))
+    ntx = int(np.ceil(nx/tile))
+    #bins index, same convention as np.histogram: last bin is closed
+    idx = np.searchsorted(bins,v,side='right')-1
+    idx[v==bins[-1]] = nbins-1
+    valid = (idx>=0)&(idx<nbins)
+    #tile index of each pixel
+    tid = (np.arange(ny)//tile)[:,None]*ntx+(np.arange(nx)//tile)[None,:]
+    flat = tid[valid]*nbins+idx[valid]
+    hist = np.bincount(flat,minlength=nty*ntx*nbins)
+    hist = hist.reshape(nty,ntx,nbins)
+    x = (bins[0:-1]+bins[1:])/2
+    return x,hist
+
+
+def hist_pyramid(tile_hists,block=1):
+    '''aggregate per-tile histograms into image, block and chantier levels
+    args:
+        tile_hists: list of tile_histograms() outputs, one per image
+        block: number of consecutive images of the list in a block
+    return:
+        pyramid: dict of histograms
+            'tile': tile_hists
+            'image': 2d array [image,bins]
+            'block': 2d array [block,bins]
+            'chantier': 1d array [bins]
+            'block_size': block
+    '''
+    image = np.array([h.sum(axis=(0,1)) for h in tile_hists])
+    starts = np.arange(0,len(tile_hists),block)
+    return {'tile':tile_hists,
+            'image':image,
+            'block':np.add.reduceat(image,starts,axis=0),
+            'chantier':image.sum(axis=0),
+            'block_size':block}
+
+
+def hist_threshold(hist,x,method='otsu'):
+    '''threshold of one histogram
+    args:
+        hist: histogram
+        x: bins center
+        method: 'otsu', 'first_valley' or 'last_valley'
+    return:
+        th: threshold value in x
+    '''
+    if method=='otsu':
+        return x[otsu_thresholding(hist,x)]
+    elif method=='first_valley':
+        return x[hist_valleys(hist)[0]]
+    elif method=='last_valley':
+        return x[hist_valleys(hist)[-1]]
+    else:
+        print("The available methods are:'otsu','first_valley','last_valley'")
+        return None
+
+
+def hist_pyramid_thresholds(pyramid,x,method='otsu',min_count=10000):
+    '''thresholds at every level of the histogram pyramid
+    A histogram holding less than min_count pixels is not reliable, its 
+    threshold is replaced by the threshold of the parent level:
+    tile -> image -> block -> chantier. The parent threshold is also used
+    when the Otsu criterion has no split (uniform tile, e.g. water).
+    ---------------
+    args:
+        pyramid: hist_pyramid() output
+        x: bins center
+        method: see hist_threshold()
+        min_count: minimum number of pixels for a histogram to be used
+    return:
+        th: dict of thresholds
+            'chantier': float
+            'block': 1d array [block]
+            'image': 1d array [image]
+            'tile': list of 2d arrays [tile_row,tile_col], one per image
+    '''
+    def thresholds(hists,th_parent):
+        #histograms [n,bins], otsu vectorized over the histograms
+        th = np.array(th_parent,dtype=float)
+        use = hists.sum(axis=1)>=min_count
+        if not use.any():
+            return th
+        if method=='otsu':
+            #no split (one populated bin): threshold of the parent level
+            ith = otsu_thresholds(hists[use],x)
+            ok = ith>=0
+            th[np.flatnonzero(use)[ok]] = x[ith[ok]]
+        else:
+            th[use] = [hist_threshold(h,x,method) for h in hists[use]]
+        return th
+    th_chantier = hist_threshold(pyramid['chantier'],x,method)
+    th_block = thresholds(pyramid['block'],
+                          np.full(len(pyramid['block']),th_chantier))
+    th_image = thresholds(pyramid['image'],
+                          th_block[np.arange(len(pyramid['image']))//
+                                   pyramid['block_size']])
+    th_tile = []
+    for k,hists in enumerate(pyramid['tile']):
+        nty,ntx,nbins = hists.shape
+        th = thresholds(hists.reshape(-1,nbins),np.full(nty*ntx,th_image[k]))
+        th_tile.append(th.reshape(nty,ntx))
+    return {'chantier':th_chantier,'block':th_block,
+            'image':th_image,'tile':th_tile}
+
+
+def threshold_map(th_tile,shape,tile):
+    '''expand per-tile thresholds to a threshold map of image size
+    args:
+        th_tile: 2d array of thresholds [tile_row,tile_col]
+        shape: [ny,nx] image size
+        tile: tile size in pixels of the image
+    return:
+        th_map: 2d array [ny,nx]
+    '''
+    ny,nx = shape[0:2]
+    th_map = np.repeat(np.repeat(th_tile,tile,axis=0),tile,axis=1)
+    return th_map[0:ny,0:nx]
+
+
+def global_thresholding_bgr_pyramid(bgr_list,bits,tile,block=1,
+                                    min_count=10000,hsteq=False,
+                                    valid_list=None,hue='exact'):
+    '''
+    region-adaptive thresholding for a set of bgr images, tsai06 method
+    ---------------
+    args:
+        bgr_list: list of image bgr array 
+        bits: color depth, 8 or 16
+        tile: tile size in pixels of the bgr arrays
+        block: number of consecutive images in a block
+        min_count: minimum number of pixels for a histogram to be used
+        hsteq: option, must use the same option for shadow_mask 
+        valid_list: list of valid pixels arrays, default None
+        hue: 'exact' or 'fast', see hsi_ratio
+    return:
+        th: hist_pyramid_thresholds() output, th['chantier'] is the 
+            global threshold of global_thresholding_bgr
+    Note:
+        The input bgr image could be sub-sampled to reduce the image size,
+        tile is then given in sub-sampled pixels
+    '''
+    if valid_list is None:
+        valid_list = [None]*len(bgr_list)
+    tile_hists = []
+    for bgr,valid in zip(bgr_list,valid_list):
+        r = hsi_ratio(bgr,bits,hsteq=hsteq,valid=valid,hue=hue)
+        if valid is not None:
+            #nan values are out of the histograms
+            r[~valid] = np.nan
+        x,hist = tile_histograms(r,[0,360],tile)
+        tile_hists.append(hist)
+    pyramid = hist_pyramid(tile_hists,block=block)
+    return hist_pyramid_thresholds(pyramid,x,method='otsu',
+                                   min_count=min_count)
     
 
-def shadow_mask_bgr(bgr,th_hi_ratio,bits,hsteq=False):
+def _use_kernels(backend,hsteq,th):
+    '''True if the compiled kernels can be used'''
+    if backend=='numpy':
+        return False
+    if backend!='numba':
+        print("The available backends are:'numpy','numba'")
+        return False
+    if not sk.HAS_NUMBA:
+        print('numba is not installed, numpy backend is used')
+        return False
+    return hsteq==False and np.ndim(th)==0
+
+
+def shadow_mask_bgr(bgr,th_hi_ratio,bits,hsteq=False,backend='numpy',
+                    valid=None,hue='exact',stats=None,i_hist=None):
     '''shadow mask for only bgr image
     args:
         bgr: bgr 8 bits or 16bits image array
-        th_hi_ratio: threshold of (h+1)/(i+1) ratio
+        th_hi_ratio: threshold of (h+1)/(i+1) ratio, a value or a threshold
+                     map of image size (see threshold_map)
         bits: color depth, 8 or 16
         hsteq: option, use the same option as global_thresholding
+        backend: 'numpy' (default) or 'numba' for the compiled kernel
+        valid: boolean array of valid pixels, invalid pixels are not shadow
+        hue: 'exact' or 'fast', see hsi_ratio. With backend='numba' the
+             fast hue is a polynomial, see shadow_kernels
+        stats: dict updated with the statistics of the mask (mask_stats), 
+               None for no statistics. The compiled kernel does not keep 
+               the index map, only the pixel counts are filled
+        i_hist: intensity histogram for hsteq, see hsi_ratio
     return:
         mask: shadow mask
     '''       
-    R = hsi_ratio(bgr,bits,hsteq=hsteq)
-    mask = R>th_hi_ratio
+    R = None
+    if _use_kernels(backend,hsteq,th_hi_ratio):
+        mask = sk.mask_bgr(bgr,th_hi_ratio,_pmax(bits),hue=hue)
+    else:
+        R = hsi_ratio(bgr,bits,hsteq=hsteq,valid=valid,hue=hue,
+                      i_hist=i_hist)
+        mask = R>th_hi_ratio
+    if valid is not None:
+        mask &= valid
+    if stats is not None:
+        mask_stats(stats,mask,valid=valid,index=R,
+                   bins=index_bins('tsai',bits))
     return mask
 
 def ndvi(bgrn):
@@ -342,12 +789,13 @@ def hist_valleys(hist):
             valleys = np.array([int(len(hist1)/2)])
     return valleys
     
-def global_thresholding_nagao(bgrn_list,bits):
+def global_thresholding_nagao(bgrn_list,bits,valid_list=None):
     '''
     global thresholding from a set of bgrn images, nagao79 method for
     weighted light indensity shresholding.
     args:
         bgrn_list: list of bgrn images, band order is [blue,green,red,nir]
+        valid_list: list of valid pixels arrays, default None
     returns:
         th_nagao: shadow thresholdng from bgrn image
     modification 2022-02-08
@@ -362,10 +810,12 @@ def global_thresholding_nagao(bgrn_list,bits):
     else:
         print('color depth must be 8 or 16!')
     
+    if valid_list is None:
+        valid_list = [None]*len(bgrn_list)
     NG = []
-    for bgrn in bgrn_list:
+    for bgrn,valid in zip(bgrn_list,valid_list):
         ng_map = nagao(bgrn)
-        NG.append(ng_map.flatten())            
+        NG.append(_valid_values(ng_map,valid))            
     NG1 = [x for sub in NG for x in sub]
     NG = np.array(NG1)      
     #first valley thresoding for NG   
@@ -376,11 +826,13 @@ def global_thresholding_nagao(bgrn_list,bits):
     th_nagao = x[ith_first]    
     return th_nagao
     
-def water_detection(bgrn_list):
+def water_detection(bgrn_list,valid_list=None):
+    if valid_list is None:
+        valid_list = [None]*len(bgrn_list)
     NDWI = []
-    for bgrn in bgrn_list:
+    for bgrn,valid in zip(bgrn_list,valid_list):
         ndwi_map = ndwi(bgrn)
-        NDWI.append(ndwi_map.flatten())            
+        NDWI.append(_valid_values(ndwi_map,valid))            
     NDWI1 = [x for sub in NDWI for x in sub]
     NDWI = np.array(NDWI1)       
     #histogram of NDWI
@@ -396,11 +848,13 @@ def water_detection(bgrn_list):
     return th_ndwi
 
 
-def vegetation_detection(bgrn_list):
+def vegetation_detection(bgrn_list,valid_list=None):
+    if valid_list is None:
+        valid_list = [None]*len(bgrn_list)
     NDVI = []
-    for bgrn in bgrn_list:
+    for bgrn,valid in zip(bgrn_list,valid_list):
         ndvi_map = ndvi(bgrn)
-        NDVI.append(ndvi_map.flatten())            
+        NDVI.append(_valid_values(ndvi_map,valid))            
     NDVI1 = [x for sub in NDVI for x in sub]
     NDVI = np.array(NDVI1)
     #histogram of NDVI
@@ -427,7 +881,8 @@ def shadow_mask_nagao(bgrn,th_nagao):
     return mask
 
 
-def global_thresholding_bgrn(bgrn_list,bits,method,hsteq=False):
+def global_thresholding_bgrn(bgrn_list,bits,method,hsteq=False,
+                             valid_list=None):
     '''
     global thresholding from a set of bgrn images,
     args:
@@ -437,6 +892,7 @@ def global_thresholding_bgrn(bgrn_list,bits,method,hsteq=False):
             'tsai':   tsai06 method
             'nagao': nagao79 method
         hsteq: boolean, option for tsai method 
+        valid_list: list of valid pixels arrays, default None
     returns:
         th = [th1,th_wat,th_veg]
         th1: shadow thresholdng from selected method
@@ -447,32 +903,54 @@ def global_thresholding_bgrn(bgrn_list,bits,method,hsteq=False):
         bgr_list = []
         for bgrn in bgrn_list:
             bgr_list.append(bgrn[:,:,0:3])
-        th1 = global_thresholding_bgr(bgr_list,bits,hsteq=hsteq)
+        th1 = global_thresholding_bgr(bgr_list,bits,hsteq=hsteq,
+                                      valid_list=valid_list)
     elif method=='nagao':
-        th1 = global_thresholding_nagao(bgrn_list,bits)
+        th1 = global_thresholding_nagao(bgrn_list,bits,valid_list=valid_list)
     else:
         print("The available methods are:'bgr','nagao'")
 
-    th_wat = water_detection(bgrn_list)
-    th_veg = vegetation_detection(bgrn_list)
+    th_wat = water_detection(bgrn_list,valid_list=valid_list)
+    th_veg = vegetation_detection(bgrn_list,valid_list=valid_list)
     return [th1,th_wat,th_veg]
 
-def shadow_mask_bgrn(bgrn,th,bits,method,hsteq=False):
+def shadow_mask_bgrn(bgrn,th,bits,method,hsteq=False,backend='numpy',
+                     valid=None,stats=None,i_hist=None):
     '''shadow mask for bgrn [b,g,r,nir] image
     
     Args:
         bgrn (TYPE): bgrn 8bits or 16bits image array
         th (TYPE): []
         bits (TYPE): DESCRIPTION.
+        backend: 'numpy' (default) or 'numba' for the compiled kernel
+        valid: boolean array of valid pixels, invalid pixels are not shadow
+        stats: dict updated with the statistics of the mask (mask_stats), 
+               None for no statistics. With the compiled kernel, only the
+               valid and shadow pixel counts are filled
+        i_hist: intensity histogram for hsteq, see hsi_ratio
 
     Returns:
         mask: shadow mask
     '''
+    if _use_kernels(backend,hsteq,th[0]) and method in ['tsai','nagao']:
+        if method=='tsai':
+            mask = sk.mask_bgrn_tsai(bgrn,th,_pmax(bits))
+        else:
+            mask = sk.mask_bgrn_nagao(bgrn,th)
+        if valid is not None:
+            mask &= valid
+        if stats is not None:
+            mask_stats(stats,mask,valid=valid)
+        return mask
+    #index map kept for the statistics, as shadow_mask_bgr and 
+    #shadow_mask_nagao
     if method=='tsai':
-        bgr = bgrn[:,:,0:3]
-        mask1 = shadow_mask_bgr(bgr,th[0],bits,hsteq)
+        index = hsi_ratio(bgrn[:,:,0:3],bits,hsteq=hsteq,valid=valid,
+                          i_hist=i_hist)
+        mask1 = index>th[0]
     elif method=='nagao':
-        mask1 = shadow_mask_nagao(bgrn,th[0])
+        index = nagao(bgrn)
+        mask1 = index<th[0]
     else:
         print("The available methods are:'bgr','nagao'")
         return None
@@ -483,9 +961,193 @@ def shadow_mask_bgrn(bgrn,th,bits,method,hsteq=False):
     mask_veg = ndvi_map>th[2]
     #final shadow mask
     mask = mask1*(1-mask_wat)*(1-mask_veg)
+    if valid is not None:
+        mask = mask*valid
+    if stats is not None:
+        mask_stats(stats,mask,valid=valid,index=index,
+                   bins=index_bins(method,bits),mask1=mask1,
+                   mask_wat=mask_wat,mask_veg=mask_veg,ndwi_map=ndwi_map,
+                   ndvi_map=ndvi_map)
     return mask
 
 
+#histogram bins of ndwi and ndvi in the statistics
+WAT_VEG_BINS = ([-1,1],0.002)
+
+
+def index_bins(method,bits):
+    '''histogram bins ([min,max],step) of the shadow index of a method, as
+    in the global thresholding'''
+    if method=='tsai':
+        return [0,360],1
+    PMAX = _pmax(bits)
+    return [0,PMAX],(1 if bits==8 else PMAX/1000)
+
+
+def _add_count(stats,key,value):
+    stats[key] = stats.get(key,0)+value
+
+
+def mask_stats(stats,mask,valid=None,index=None,bins=None,mask1=None,
+               mask_wat=None,mask_veg=None,ndwi_map=None,ndvi_map=None):
+    '''add the statistics of a mask to stats, from the arrays already
+    computed for the mask. Counts and histograms are added, the stats of
+    the strips or the valid area of an image add up to the image stats.
+    args:
+        stats: dict updated in place
+            'pixels': valid pixels
+            'shadow': shadow pixels of the final mask
+            'water','vegetation': valid pixels detected as water, vegetation
+            'excluded': shadow candidates removed as water or vegetation
+            'hist','x': histogram of the shadow index and bins center
+            'hist_ndwi','x_ndwi','hist_ndvi','x_ndvi': idem for ndwi, ndvi
+        mask: final shadow mask
+        valid: valid pixels, None for all pixels
+        index: shadow index map (hsi_ratio or nagao), None if not computed
+        bins: ([min,max],step) of the index histogram, see index_bins
+        mask1: shadow mask before the water and vegetation removal
+        mask_wat, mask_veg, ndwi_map, ndvi_map: intermediates of 
+                                                shadow_mask_bgrn
+    '''
+    def count(m):
+        return int(np.count_nonzero(m if valid is None else m&valid))
+    _add_count(stats,'pixels',mask.size if valid is None 
+               else int(np.count_nonzero(valid)))
+    _add_count(stats,'shadow',int(np.count_nonzero(mask)))
+    if mask_wat is not None:
+        _add_count(stats,'water',count(mask_wat))
+        _add_count(stats,'vegetation',count(mask_veg))
+        _add_count(stats,'excluded',count(mask1&(mask_wat|mask_veg)))
+    for key,v,v_bins in [('',index,bins),('_ndwi',ndwi_map,WAT_VEG_BINS),
+                         ('_ndvi',ndvi_map,WAT_VEG_BINS)]:
+        if v is not None:
+            x,hist = hist_uniform(_valid_values(v,valid),*v_bins)
+            _add_count(stats,'hist'+key,hist)
+            stats['x'+key] = x
+
+
+def merge_stats(stats,other):
+    '''add the statistics other to stats (strips of an image), nested
+    dicts of several runs are merged run by run'''
+    for key,value in other.items():
+        if isinstance(value,dict):
+            merge_stats(stats.setdefault(key,{}),value)
+        elif key.startswith('x'):
+            stats[key] = value
+        else:
+            _add_count(stats,key,value)
+
+
+def method_runs(methods,hsteq_list=None):
+    '''(method,hsteq) runs of a multi-method processing
+    hsteq has no effect on nagao, nagao gets one run with hsteq=False
+    args:
+        methods: list of methods, 'tsai' or 'nagao'
+        hsteq_list: list of hsteq settings, default [False]
+    return:
+        runs: list of (method,hsteq), without duplicates
+    '''
+    if hsteq_list is None:
+        hsteq_list = [False]
+    runs = []
+    for method in methods:
+        for hsteq in hsteq_list:
+            run = (method,hsteq and method=='tsai')
+            if run not in runs:
+                runs.append(run)
+    return runs
+
+
+def run_name(run):
+    '''name of a (method,hsteq) run, e.g. 'tsai_hsteq', for the outputs'''
+    method,hsteq = run
+    return method+('_hsteq' if hsteq else '')
+
+
+def global_thresholding_bgrn_multi(bgrn_list,bits,runs,valid_list=None):
+    '''
+    global thresholding from a set of bgrn images for several runs, the
+    water and vegetation thresholds are computed once for all runs
+    args:
+        bgrn_list: list of bgrn images, band order is [blue,green,red,nir]
+        bits: color depth, 8 or 16
+        runs: method_runs() output
+        valid_list: list of valid pixels arrays, default None
+    returns:
+        th: dict {(method,hsteq):[th1,th_wat,th_veg]}, as 
+            global_thresholding_bgrn for each run
+    '''
+    th_wat = water_detection(bgrn_list,valid_list=valid_list)
+    th_veg = vegetation_detection(bgrn_list,valid_list=valid_list)
+    bgr_list = [bgrn[:,:,0:3] for bgrn in bgrn_list]
+    th = {}
+    for method,hsteq in runs:
+        if method=='tsai':
+            th1 = global_thresholding_bgr(bgr_list,bits,hsteq=hsteq,
+                                          valid_list=valid_list)
+        elif method=='nagao':
+            th1 = global_thresholding_nagao(bgrn_list,bits,
+                                            valid_list=valid_list)
+        else:
+            print("The available methods are:'bgr','nagao'")
+            continue
+        th[(method,hsteq)] = [th1,th_wat,th_veg]
+    return th
+
+
+def shadow_mask_bgrn_multi(bgrn,th,bits,valid=None,stats=None,i_hist=None):
+    '''shadow masks of a bgrn image for several runs
+    NDWI, NDVI and nagao maps are computed once, hsi_ratio once per hsteq
+    setting. Each mask is the same as shadow_mask_bgrn for its run.
+    args:
+        bgrn: bgrn 8bits or 16bits image array
+        th: global_thresholding_bgrn_multi() output
+        bits: color depth, 8 or 16
+        valid: boolean array of valid pixels, invalid pixels are not shadow
+        stats: dict updated with the statistics of each run, 
+               {(method,hsteq):stats} (mask_stats), None for no statistics
+        i_hist: intensity histogram for the hsteq runs, see hsi_ratio
+    returns:
+        masks: dict {(method,hsteq):mask}
+    '''
+    if not th:
+        print('no method to run, no shadow mask')
+        return {}
+    #water and vegetation, thresholds shared by the runs
+    th_wat,th_veg = list(th.values())[0][1:3]
+    ndwi_map = ndwi(bgrn)
+    ndvi_map = ndvi(bgrn)
+    mask_wat = ndwi_map>th_wat
+    mask_veg = ndvi_map>th_veg
+    not_wat_veg = (1-mask_wat)*(1-mask_veg)
+    if valid is not None:
+        not_wat_veg = not_wat_veg*valid
+    index = {}
+    masks = {}
+    for (method,hsteq),th_run in th.items():
+        if method=='tsai':
+            if hsteq not in index:
+                index[hsteq] = hsi_ratio(bgrn[:,:,0:3],bits,hsteq=hsteq,
+                                         valid=valid,i_hist=i_hist)
+            mask1 = index[hsteq]>th_run[0]
+        elif method=='nagao':
+            if 'nagao' not in index:
+                index['nagao'] = nagao(bgrn)
+            mask1 = index['nagao']<th_run[0]
+        else:
+            print("The available methods are:'bgr','nagao'")
+            continue
+        masks[(method,hsteq)] = mask1*not_wat_veg
+        if stats is not None:
+            mask_stats(stats.setdefault((method,hsteq),{}),
+                       masks[(method,hsteq)],valid=valid,
+                       index=index['nagao' if method=='nagao' else hsteq],
+                       bins=index_bins(method,bits),mask1=mask1,
+                       mask_wat=mask_wat,mask_veg=mask_veg,ndwi_map=ndwi_map,
+                       ndvi_map=ndvi_map)
+    return masks
+
+
 def main():
     '''
         Description
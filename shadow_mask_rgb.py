@@ -30,6 +30,68 @@ Module name:
                afin d'améliorer le résultat de seuillage d'histogramme. 
                défaut=False
     - `output`= nom du répertoire de sortie
+    - `backend`= calcul du masque, `numpy` ou `numba` (boucle compilée 
+                 multi-coeurs, si numba est installé), défaut=numpy
+    - `workers`= nombre de threads, chaque image est traitée par bandes de 
+                 lignes en parallèle, défaut=1
+    - `catalog`= fichier catalogue SQLite du chantier (chantier_catalog), 
+                 créé au premier lancement, lu ensuite par les 2 phases
+    - `rebuild`= True, parcourir à nouveau les répertoires du catalogue. Un
+                 répertoire dont les images ont changé est toujours 
+                 parcouru à nouveau. défaut=False
+    - `max_mem`= budget mémoire, par exemple 8G. Le nombre de threads et la 
+                 hauteur des bandes sont choisis pour ne pas le dépasser 
+                 (planner), `workers` devient le nombre maximal de threads.
+                 Le traitement s'arrête si le budget est trop petit
+    - `mask_format`= format des masques: `tif` (8 bits, défaut), `packed` 
+                     (format compact 1 bit par pixel .npz, compact_mask) 
+                     ou `both`
+    - `overviews`= True, les masques tif sont écrits tuilés avec leurs 
+                   aperçus calculés en mémoire, défaut=False
+    - `mosaic`= True, la mosaïque VRT `mask_mosaic.vrt` de tous les masques 
+                tif du répertoire de sortie est écrite à la fin de la 
+                création des masques, défaut=False
+    - `tile`= taille de tuile en pixels pour le seuillage adaptatif par 
+              région (pyramide d'histogrammes). A défaut, seuil global unique.
+    - `block`= nombre d'images consécutives par bloc dans la pyramide, 
+               défaut=10
+    - `min_count`= nombre minimal de pixels (sous-échantillonnés) d'un 
+                   histogramme, en dessous le seuil du niveau parent est 
+                   utilisé. défaut=10000
+    - `nodata`= valeur des pixels sans donnée (bords noirs des images 
+                orthorectifiées), ou `auto` pour la valeur nodata des 
+                métadonnées de chaque image. Ces pixels sont exclus des 
+                histogrammes et le masque n'est calculé que sur l'emprise 
+                des pixels valides. A défaut, tous les pixels sont valides
+    - `index_cache`= répertoire du cache des indices quantifiés 
+                     (index_cache). Si `threshold_input=input`, le seuillage 
+                     global y écrit l'indice des images qu'il décode, les 
+                     masques de ces images sont calculés à partir du cache 
+                     sans décoder les images une deuxième fois
+    - `cache_bits`= quantification des indices du cache, 8 ou 16, 
+                    défaut=16
+    - `footprint`= True, le seuillage global ne lit dans chaque image que 
+                   la partie de terrain qui n'est pas mieux vue par une 
+                   autre image (emprises calculées à partir du 
+                   géoréférencement, module footprints): les zones de 
+                   recouvrement ne sont comptées qu'une fois. Non 
+                   utilisé avec `hsteq`, l'égalisation des masques porte 
+                   sur l'image entière. défaut=False
+    - `footprint_cell`= taille des cellules de terrain en pixels, 
+                        défaut=256
+    - `aoi`= zone d'intérêt, rectangle `xmin,ymin,xmax,ymax` ou fichier 
+             GeoJSON/GeoPackage de polygones (module area_of_interest). 
+             Les images hors de la zone sont ignorées, seule la fenêtre 
+             qui recoupe la zone est lue, les histogrammes et les masques 
+             sont limités à la zone. Les masques couvrent la fenêtre lue.
+    - `hue`= calcul de la teinte de la méthode Tsai06: `exact` (défaut) 
+             ou `fast`, teinte approchée (erreur max 0.001 degré) environ 
+             3 fois plus rapide pour le seuillage et les masques
+    - `report`= fichier du rapport de contrôle qualité (quality_report), 
+                `.csv` ou `.parquet`: une ligne par image avec les 
+                fractions d'ombre, l'histogramme de l'indice et l'écart 
+                entre le seuil propre à l'image et le seuil global, 
+                calculés pendant la création des masques sans relecture
 
 Modification:
     2020-11-09: save the mask image in tif format        
@@ -37,67 +99,303 @@ Modification:
                 - add masked_image option for saving the shadow masked 8bits image,
                   default is False
                 - add th option for user defined threshold value for rgb image
+    2026-10-19: - add tile, block and min_count options for 
+                  region-adaptive thresholds from a histogram pyramid
+                - add nodata option, nodata pixels are excluded from the
+                  thresholding and are never shadow
+                - add index_cache and cache_bits options, quantized index
+                  cache written by the thresholding and read by the masks
+                - add footprint and footprint_cell options, the 
+                  thresholding reads only the non-redundant ground area of
+                  each image (whole images with hsteq)
+                - add aoi option, the thresholding and the masks are
+                  restricted to an area of interest
+                - add hue option, fast approximate hue for the 
+                  thresholding and the masks
+                - add report option, per image quality report collected 
+                  during the mask creation
 """
 
 import os
-import glob
 import numpy as np
 import cv2
 import time
 import shadow_mask as sm
-from osgeo import gdal
+import shadow_strips as ss
+import chantier_catalog as cat
+import mask_io as mio
+import planner
+import archive_io as aio
+import index_cache as ic
+import footprints as fp
+import area_of_interest as ai
+import quality_report as qr
        
 
-def global_thresholding(src_path,ext,bits,jump,sub,hsteq): 
+def global_thresholding(src_path,ext,bits,jump,sub,hsteq,tile=None,block=10,
+                        min_count=10000,workers=1,catalog=None,max_mem=None,
+                        nodata=None,index_cache=None,cache_bits=16,
+                        footprint=False,footprint_cell=256,aoi=None,
+                        hue='exact'): 
     print('-------------------------')
     print('global thresholding start.')
     start_thresholding = time.time()
-    pattern = os.path.join(src_path,'*'+ext)
-    flist = np.array([f.replace("\\","/") for f in glob.glob(pattern)])    
-    flist = flist[0::jump]
+    #nodata values of the catalog, the files are not opened for 'auto'
+    known_nodata = cat.catalog_nodata(catalog,src_path) if catalog \
+        else None
+    if catalog:
+        entries = cat.read_catalog(catalog,src_path)[0::jump]
+        flist = np.array([e['file_rgb'] for e in entries])
+        names = [e['name'] for e in entries]
+    else:
+        pattern = os.path.join(src_path,'*'+ext)
+        flist = np.array([f.replace("\\","/") for f in aio.list_files(pattern)])    
+        flist = flist[0::jump]
+        names = [file[len(src_path)+1:-len(ext)] for file in flist]
     if len(flist)==0:
         print('global thresholding failed, no image found')
         return None
+    geometries = None
+    if (footprint and not tile) or aoi is not None:
+        if catalog:
+            geometries = [(e['geo_tsf'],e['nx'],e['ny']) for e in entries]
+        else:
+            geometries = [fp.image_geometry(file) for file in flist]
+    if aoi is not None:
+        #only the images intersecting the area of interest
+        aoi_windows = [ai.aoi_window(aoi,*g) if g is not None else None 
+                       for g in geometries]
+        keep = [k for k,w in enumerate(aoi_windows) if w is not None]
+        print(len(keep),'of',len(flist),'images in the area of interest')
+        if len(keep)==0:
+            print('global thresholding failed, no image in the area of '
+                  'interest')
+            return None
+        flist = flist[keep]
+        names = [names[k] for k in keep]
+        geometries = [geometries[k] for k in keep]
+        aoi_windows = [aoi_windows[k] for k in keep]
     print(len(flist),'images used:')
-    for file in flist:     
-        print(file[len(src_path)+1:])
+    for name in names:     
+        print(name)
+    strip = None
+    if max_mem:
+        info = cat.raster_info(flist[0])
+        plan = planner.plan_thresholding(max_mem,info['nx'],info['ny'],3,bits,
+                                         len(flist),sub,hsteq=hsteq,
+                                         max_workers=workers if workers>1 
+                                         else None)
+        planner.print_plan(plan,'thresholding')
+        if not plan['fits']:
+            print('global thresholding failed, memory budget too small')
+            return None
+        workers,strip = plan['workers'],plan['strip']
+    fp_plan = None
+    if footprint and tile:
+        print('footprint sampling is not used with tile, the tile '
+              'thresholds need whole images')
+    elif footprint and hsteq:
+        #the masks are equalized with the histogram of the whole image,
+        #the thresholding must use the same pixels
+        print('footprint sampling is not used with hsteq, the equalization '
+              'histogram needs whole images')
+    elif footprint:
+        fp_plan = fp.footprint_plan(geometries,cell=footprint_cell)
+        if fp_plan is None:
+            print('footprint sampling needs north-up georeferenced images, '
+                  'whole images are used')
+        elif index_cache:
+            print('index cache is not written with footprint sampling')
+            index_cache = None
     # create bgr_list
     bgr_list = []
+    valid_list = [] if nodata is not None or fp_plan is not None or \
+        aoi is not None else None
+    windows = []
     for j in range(len(flist)):
-        bgr = cv2.imread(flist[j],cv2.IMREAD_UNCHANGED)
+        #part of the image in the area of interest, whole images for the 
+        #tile thresholds
+        aoi_window = aoi_windows[j] if aoi is not None and not tile else None
+        #part of the image not seen better by another image
+        window,owned = fp.owned_window(fp_plan,j,sub,within=aoi_window)
+        if fp_plan is None:
+            window = aoi_window
+        windows.append(window)
+        if fp_plan is not None and window is None:
+            continue
+        bgr = aio.read_image(flist[j],window=window)
         bgr_sub = bgr[0::sub,0::sub,:]
         bgr_list.append(bgr_sub)
+        nodata_j = cat.file_nodata(flist[j],nodata,known_nodata)
+        if valid_list is not None:
+            valid = sm.valid_mask(bgr_sub,nodata_j)
+            inside = None
+            if aoi is not None:
+                geo_tsf,nx,ny = geometries[j]
+                inside = ai.aoi_mask(aoi,geo_tsf,window or (0,0,nx,ny),sub)
+            for m in [owned,inside]:
+                if m is not None:
+                    valid = m if valid is None else valid&m
+            valid_list.append(valid)
+        if index_cache:
+            #full resolution index for the mask phase, no second decoding
+            ic.write_indices(index_cache,names[j],bgr,bits,
+                             ic.index_keys([('tsai',hsteq)]),
+                             valid=sm.valid_mask(bgr,nodata_j),
+                             qbits=cache_bits,hue=hue,nodata=nodata_j,
+                             strip=strip)
+    if fp_plan is not None:
+        fp.print_sampling(fp_plan,windows)
     
-    th = sm.global_thresholding_bgr(bgr_list,bits,hsteq=hsteq)
-    print('global threshoding end. th =',th)
+    if tile:
+        #tile size in sub-sampled pixels
+        tile_sub = max(1,tile//sub)
+        th_pyr = sm.global_thresholding_bgr_pyramid(bgr_list,bits,tile_sub,
+                                                    block=block,
+                                                    min_count=min_count,
+                                                    hsteq=hsteq,
+                                                    valid_list=valid_list,
+                                                    hue=hue)
+        th = {'chantier':th_pyr['chantier'],
+              'tile':dict(zip(names,th_pyr['tile'])),
+              'tile_size':tile_sub*sub}
+        print('image thresholds:',th_pyr['image'])
+        th_print = th['chantier']
+    elif workers>1 or strip:
+        th = ss.global_thresholding_bgr(bgr_list,bits,hsteq=hsteq,
+                                        workers=workers,strip=strip,
+                                        valid_list=valid_list,hue=hue)
+        th_print = th
+    else:
+        th = sm.global_thresholding_bgr(bgr_list,bits,hsteq=hsteq,
+                                        valid_list=valid_list,hue=hue)
+        th_print = th
+    print('global threshoding end. th =',th_print)
     end_thresholding = time.time()
     print('temps pour le thresholding :', end_thresholding - start_thresholding)
     print('----------------------------')
     return th
 
-def shadow_mask(src_path,pref_rgb,ext,bits,hsteq,th,dst_path,masked_image):
+def shadow_mask(src_path,pref_rgb,ext,bits,hsteq,th,dst_path,masked_image,
+                backend='numpy',workers=1,catalog=None,
+                mask_format='tif',overviews=False,mosaic=False,max_mem=None,
+                nodata=None,index_cache=None,cache_bits=16,aoi=None,
+                hue='exact',report=None):
     print('-----------------------------')
     print('|rgb image shadow mask start|')
     print('-----------------------------')
     start_mask = time.time()
-    pattern = os.path.join(src_path,pref_rgb+'*'+ext)
-    flist = np.array([f.replace("\\","/") for f in glob.glob(pattern)])
+    #nodata values of the catalog, the files are not opened for 'auto'
+    known_nodata = cat.catalog_nodata(catalog,src_path) if catalog \
+        else None
+    if catalog:
+        entries = cat.read_catalog(catalog,src_path)
+        flist = np.array([e['file_rgb'] for e in entries])
+        names = [e['name'] for e in entries]
+        georefs = [(e['geo_tsf'],e['geo_proj']) for e in entries]
+    else:
+        pattern = os.path.join(src_path,pref_rgb+'*'+ext)
+        flist = np.array([f.replace("\\","/") for f in aio.list_files(pattern)])
+        names = [file[len(src_path)+1:-len(ext)] for file in flist]
+        georefs = [None]*len(flist)
+    if aoi is not None:
+        if catalog:
+            geometries = [(e['geo_tsf'],e['nx'],e['ny']) for e in entries]
+        else:
+            geometries = [fp.image_geometry(file) for file in flist]
+    mosaic_list = [] if mosaic else None
+    workers_j,strip_j = workers,None
+    last_plan = None
+    rows = []
+    keys = ic.index_keys([('tsai',hsteq)])
     for j in range(len(flist)):
-        bgr = cv2.imread(flist[j],cv2.IMREAD_UNCHANGED)
-        #call shadow_mask_bgr
-        mask = sm.shadow_mask_bgr(bgr, th, bits,hsteq=hsteq)
+        name = names[j]        
+        #only the window of the image in the area of interest is read and
+        #written
+        window = None
+        if aoi is not None:
+            if geometries[j] is not None:
+                window = ai.aoi_window(aoi,*geometries[j])
+            if window is None:
+                print(name+' out of the area of interest')
+                continue
+        #masks from the index cache, the image is only decoded for 
+        #masked_image
+        cached = index_cache is not None and not masked_image and \
+            ic.has_indices(index_cache,name,keys,bits,qbits=cache_bits,
+                           hue=hue,nodata=cat.file_nodata(flist[j],nodata,known_nodata))
+        if max_mem and not cached:
+            if window is not None:
+                nx,ny = window[2:4]
+            else:
+                info = entries[j] if catalog else cat.raster_info(flist[j])
+                nx,ny = info['nx'],info['ny']
+            plan = planner.plan_mask(max_mem,nx,ny,3,bits,
+                                     hsteq=hsteq,
+                                     max_workers=workers if workers>1 
+                                     else None,masked_image=masked_image)
+            workers_j,strip_j = plan['workers'],plan['strip']
+            if (workers_j,strip_j)!=last_plan or not plan['fits']:
+                planner.print_plan(plan,'mask')
+                last_plan = (workers_j,strip_j)
+            if not plan['fits']:
+                print(name+' shadow mask failed, memory budget too small')
+                return
+        if cached:
+            shape = ic.read_index(index_cache,name,keys[0]).shape
+        else:
+            bgr = aio.read_image(flist[j],window=window)
+            shape = bgr.shape
+        if isinstance(th,dict):
+            #region-adaptive thresholds, the chantier threshold for images 
+            #not used in the thresholding
+            if name in th['tile']:
+                if window is not None:
+                    geo_tsf,nx,ny = geometries[j]
+                    th_img = sm.threshold_map(th['tile'][name],(ny,nx),
+                                              th['tile_size'])
+                    th_img = th_img[ai.window_slices(window)]
+                else:
+                    th_img = sm.threshold_map(th['tile'][name],shape,
+                                              th['tile_size'])
+            else:
+                th_img = th['chantier']
+        else:
+            th_img = th
+        #statistics of the quality report, from the arrays of the mask
+        stats = {} if report else None
+        if cached:
+            mask = ic.cached_mask(index_cache,name,th_img,bits,hsteq=hsteq,
+                                  stats=stats)
+        else:
+            #call shadow_mask_bgr on the valid area
+            valid = sm.valid_mask(bgr,cat.file_nodata(flist[j],nodata,known_nodata))
+            #pixels inside the area of interest, as in the thresholding (also
+            #for the hsteq histogram)
+            if aoi is not None:
+                inside = ai.aoi_mask(aoi,geometries[j][0],window)
+                if inside is not None:
+                    valid = inside if valid is None else valid&inside
+            def mask_func(img,box,valid_box):
+                th_box = th_img if np.ndim(th_img)==0 else th_img[box]
+                if workers_j>1 or strip_j:
+                    return ss.shadow_mask_bgr(img, th_box, bits,hsteq=hsteq,
+                                              backend=backend,
+                                              workers=workers_j,
+                                              strip=strip_j,valid=valid_box,
+                                              hue=hue,stats=stats)
+                return sm.shadow_mask_bgr(img, th_box, bits,hsteq=hsteq,
+                                          backend=backend,valid=valid_box,
+                                          hue=hue,stats=stats)
+            mask = sm.valid_area_mask(mask_func,bgr,valid)
         #save result
-        name = flist[j][len(src_path)+1:-len(ext)]        
-        maskfile = os.path.join(dst_path,'mask_'+name+'.tif')
-        cv2.imwrite(maskfile,((1-mask)*255).astype(np.uint8))
-        #add georef from original image to mask 
-        georef_src = gdal.Open(flist[j])
-        georef_dst = gdal.OpenShared(maskfile,gdal.GA_Update)
-        geo_tsf = georef_src.GetGeoTransform()
-        geo_proj = georef_src.GetProjection()
-        georef_dst.SetGeoTransform(geo_tsf)
-        georef_dst.SetProjection(geo_proj)        
-        print(name+' shadow mask done')               
+        georef = ai.window_georef(georefs[j] or mio.source_georef(flist[j]),
+                                  window)
+        mio.write_mask(mask,name,dst_path,georef,mask_format=mask_format,
+                       overviews=overviews,mosaic=mosaic_list)
+        print(name+' shadow mask done')
+        if report:
+            rows.append(qr.report_row(name,stats,th_img,'tsai'))               
         if(masked_image):
             #save bgr_8bits with mask
             if bits==8:
@@ -115,6 +413,10 @@ def shadow_mask(src_path,pref_rgb,ext,bits,hsteq,th,dst_path,masked_image):
             imfile = os.path.join(dst_path,'masked_'+name+'.jpg')
             cv2.imwrite(imfile,bgr8)
             print(name+' shadow masked image done')
+    if mosaic_list is not None and mio.write_mosaic(dst_path,mosaic_list):
+        print('mask mosaic:',os.path.join(dst_path,mio.MOSAIC_NAME))
+    if report:
+        print('quality report:',qr.write_report(report,rows))
     end_mask = time.time()
     print('temps pour le mask :', end_mask - start_mask)       
     print('---------------------------')
@@ -170,6 +472,38 @@ def main(**kwargs):
         jump = 1
     else:
         th_path = src_path
+    if 'workers' in kwargs:
+        workers = int(kwargs.get('workers'))
+    else:
+        workers = 1
+    if 'overviews' in kwargs:
+        overviews = kwargs.get('overviews')=='True'
+    else:
+        overviews = False
+    if 'mosaic' in kwargs:
+        mosaic = kwargs.get('mosaic')=='True'
+    else:
+        mosaic = False
+    if 'max_mem' in kwargs:
+        max_mem = kwargs.get('max_mem')
+    else:
+        max_mem = None
+    if 'mask_format' in kwargs:
+        mask_format = kwargs.get('mask_format')
+    else:
+        mask_format = 'tif'
+    if 'catalog' in kwargs:
+        catalog = kwargs.get('catalog')
+    else:
+        catalog = None
+    if 'rebuild' in kwargs:
+        rebuild = kwargs.get('rebuild')=='True'
+    else:
+        rebuild = False
+    if 'backend' in kwargs:
+        backend = kwargs.get('backend')
+    else:
+        backend = 'numpy'
     if 'masked_image' in kwargs:
         masked_image = kwargs.get('masked_image')
         if masked_image == 'True':
@@ -182,6 +516,57 @@ def main(**kwargs):
         th = float(kwargs.get('th'))
     else:
         th = None
+    if 'tile' in kwargs:
+        tile = int(kwargs.get('tile'))
+    else:
+        tile = None
+    if 'block' in kwargs:
+        block = int(kwargs.get('block'))
+    else:
+        block = 10
+    if 'min_count' in kwargs:
+        min_count = int(kwargs.get('min_count'))
+    else:
+        min_count = 10000
+    if 'index_cache' in kwargs:
+        index_cache = kwargs.get('index_cache')
+    else:
+        index_cache = None
+    if 'cache_bits' in kwargs:
+        cache_bits = int(kwargs.get('cache_bits'))
+    else:
+        cache_bits = 16
+    if 'footprint' in kwargs:
+        footprint = kwargs.get('footprint')=='True'
+    else:
+        footprint = False
+    if 'footprint_cell' in kwargs:
+        footprint_cell = int(kwargs.get('footprint_cell'))
+    else:
+        footprint_cell = 256
+    if 'nodata' in kwargs:
+        nodata = kwargs.get('nodata')
+        if nodata!='auto':
+            nodata = float(nodata)
+    else:
+        nodata = None
+    if 'hue' in kwargs:
+        hue = kwargs.get('hue')
+    else:
+        hue = 'exact'
+    if 'report' in kwargs:
+        report = kwargs.get('report')
+    else:
+        report = None
+    if 'aoi' in kwargs:
+        aoi = ai.read_aoi(kwargs.get('aoi'))
+        if aoi is None:
+            return
+        if index_cache:
+            print('index cache is not used with an area of interest')
+            index_cache = None
+    else:
+        aoi = None
     
     print('input image path = ',src_path)
     print('threshold image path = ',th_path)
@@ -191,14 +576,58 @@ def main(**kwargs):
     print('jump = ',jump)
     print('sub = ',sub)
     print('hsteq = ',hsteq)
+    print('hue = ',hue)
     print('output path =',dst_path)
     print('output masked image =',masked_image)
+    print('mask format =',mask_format)
+    print('mask overviews =',overviews)
+    print('mask mosaic =',mosaic)
+    print('quality report =',report)
+    print('backend = ',backend)
+    print('workers = ',workers)
+    print('max_mem = ',max_mem)
+    print('nodata = ',nodata)
+    print('footprint sampling = ',footprint)
+    if aoi is not None:
+        print('area of interest = ',kwargs.get('aoi'))
+    if index_cache:
+        print('index cache = ',index_cache,', bits =',cache_bits)
+    if catalog:
+        print('catalog = ',catalog)
+        #scan the chantiers once, check the images before processing
+        errors = []
+        for path in set([p for p in [src_path,th_path] if p!='']):
+            n = cat.build_catalog(catalog,path,pref_rgb=pref_rgb,ext_rgb=ext,
+                                  rebuild=rebuild)
+            print(n,'images in catalog for',path)
+            errors += cat.check_catalog(cat.read_catalog(catalog,path),bits)
+        if errors:
+            print('catalog check failed:')
+            for error in errors:
+                print(error)
+            return
+    if tile:
+        print('tile = ',tile)
+        print('block = ',block)
+        print('min_count = ',min_count)
     if(th):
         print('user defined threshold =',th)
     elif th_path !='':
-        th = global_thresholding(th_path,ext,bits,jump,sub,hsteq)
+        th = global_thresholding(th_path,ext,bits,jump,sub,hsteq,tile=tile,
+                                 block=block,min_count=min_count,
+                                 workers=workers,catalog=catalog,
+                                 max_mem=max_mem,nodata=nodata,
+                                 index_cache=index_cache 
+                                 if th_path==src_path else None,
+                                 cache_bits=cache_bits,footprint=footprint,
+                                 footprint_cell=footprint_cell,aoi=aoi,
+                                 hue=hue)
     if dst_path !='' and th:
-        shadow_mask(src_path,pref_rgb,ext,bits,hsteq,th,dst_path,masked_image)
+        shadow_mask(src_path,pref_rgb,ext,bits,hsteq,th,dst_path,masked_image,
+                    backend=backend,workers=workers,catalog=catalog,
+                    mask_format=mask_format,overviews=overviews,mosaic=mosaic,
+                    max_mem=max_mem,nodata=nodata,index_cache=index_cache,
+                    cache_bits=cache_bits,aoi=aoi,hue=hue,report=report)
         
     
     
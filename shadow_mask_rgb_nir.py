@@ -44,8 +44,67 @@ Module name:
                afin d'améliorer le résultat de seuillage d'histogramme. 
                défaut=False
     - `method`= option pour sélectionner la méthode de seuillage global. 
-                Il dispose les options `nagao` et `tsai`, défaut=nagao
+                Il dispose les options `nagao` et `tsai`, défaut=nagao.
+                Plusieurs méthodes séparées par des virgules 
+                (`method=tsai,nagao`) et plusieurs valeurs de `hsteq` 
+                (`hsteq=False,True`) sont traitées en une seule lecture des 
+                images, un sous-répertoire de sortie par méthode 
+                (`tsai`, `tsai_hsteq`, `nagao`)
+    - `index_cache`= répertoire du cache des indices quantifiés 
+                     (index_cache). Si `threshold_input=input`, le seuillage 
+                     global y écrit les indices (méthodes, NDWI, NDVI) des 
+                     images qu'il décode, les masques de ces images sont 
+                     calculés à partir du cache sans décoder les images une 
+                     deuxième fois
+    - `cache_bits`= quantification des indices du cache, 8 ou 16, 
+                    défaut=16
+    - `footprint`= True, le seuillage global ne lit dans chaque image que 
+                   la partie de terrain qui n'est pas mieux vue par une 
+                   autre image (emprises calculées à partir du 
+                   géoréférencement, module footprints): les zones de 
+                   recouvrement ne sont comptées qu'une fois. Non 
+                   utilisé avec `hsteq`, l'égalisation des masques porte 
+                   sur l'image entière. défaut=False
+    - `footprint_cell`= taille des cellules de terrain en pixels, 
+                        défaut=256
+    - `aoi`= zone d'intérêt, rectangle `xmin,ymin,xmax,ymax` ou fichier 
+             GeoJSON/GeoPackage de polygones (module area_of_interest). 
+             Les images hors de la zone sont ignorées, seule la fenêtre 
+             qui recoupe la zone est lue, les histogrammes et les masques 
+             sont limités à la zone. Les masques couvrent la fenêtre lue.
+    - `report`= fichier du rapport de contrôle qualité (quality_report), 
+                `.csv` ou `.parquet`: une ligne par image et par méthode 
+                avec les fractions d'ombre, d'eau et de végétation, 
+                l'histogramme de l'indice et les écarts entre les seuils 
+                propres à l'image et les seuils globaux, calculés pendant 
+                la création des masques sans relecture
     - `output`= nom du répertoire de sortie
+    - `backend`= calcul du masque, `numpy` ou `numba` (boucle compilée 
+                 multi-coeurs, si numba est installé), défaut=numpy
+    - `workers`= nombre de threads, chaque image est traitée par bandes de 
+                 lignes en parallèle, défaut=1
+    - `catalog`= fichier catalogue SQLite du chantier (chantier_catalog), 
+                 créé au premier lancement, lu ensuite par les 2 phases
+    - `rebuild`= True, parcourir à nouveau les répertoires du catalogue. Un
+                 répertoire dont les images ont changé est toujours 
+                 parcouru à nouveau. défaut=False
+    - `max_mem`= budget mémoire, par exemple 8G. Le nombre de threads et la 
+                 hauteur des bandes sont choisis pour ne pas le dépasser 
+                 (planner), `workers` devient le nombre maximal de threads.
+                 Le traitement s'arrête si le budget est trop petit
+    - `mask_format`= format des masques: `tif` (8 bits, défaut), `packed` 
+                     (format compact 1 bit par pixel .npz, compact_mask) 
+                     ou `both`
+    - `overviews`= True, les masques tif sont écrits tuilés avec leurs 
+                   aperçus calculés en mémoire, défaut=False
+    - `mosaic`= True, la mosaïque VRT `mask_mosaic.vrt` de tous les masques 
+                tif du répertoire de sortie est écrite à la fin de la 
+                création des masques, défaut=False
+    - `nodata`= valeur des pixels sans donnée (bords noirs des images 
+                orthorectifiées), ou `auto` pour la valeur nodata des 
+                métadonnées de chaque image RVB. Ces pixels sont exclus des 
+                histogrammes et le masque n'est calculé que sur l'emprise 
+                des pixels valides. A défaut, tous les pixels sont valides
 
 Modification:
     2020-11-09: save the mask image in tif format 
@@ -56,45 +115,161 @@ Modification:
                   default is False
                 - add th option for user defined threshold value [th_shadow, 
                   th_water,th_vegetation] for rgb+nir image
+    2026-10-19: - add nodata option, nodata pixels are excluded from the
+                  thresholding and are never shadow
+                - method and hsteq accept lists, all the runs are 
+                  processed from one decoding of the images
+                - add index_cache and cache_bits options, quantized index
+                  cache written by the thresholding and read by the masks
+                - add footprint and footprint_cell options, the 
+                  thresholding reads only the non-redundant ground area of
+                  each image (whole images with hsteq)
+                - add aoi option, the thresholding and the masks are
+                  restricted to an area of interest
+                - add report option, per image quality report collected 
+                  during the mask creation
 """
 
 import os
-import glob
 import numpy as np
 import cv2
 import time
 import shadow_mask as sm
-from osgeo import gdal
+import shadow_strips as ss
+import chantier_catalog as cat
+import mask_io as mio
+import planner
+import archive_io as aio
+import index_cache as ic
+import footprints as fp
+import area_of_interest as ai
+import quality_report as qr
 
-def global_thresholding(src_path,pref_rgb,pref_nir,ext_rgb,ext_nir,bits,jump,sub,hsteq,method): 
-    print('-------------------------')
-    print('global thresholding start.')
-    start_thresholding = time.time()
+def image_pairs(src_path,pref_rgb,pref_nir,ext_rgb,ext_nir,catalog=None):
+    '''RVB/PIR image pairs of a chantier, from the catalog if given
+    returns:
+        flist_rgb, flist_nir: image files
+        names: image names used for the outputs
+        georefs: (geo_tsf,geo_proj) from the catalog, None without catalog
+    '''
+    if catalog:
+        entries = cat.read_catalog(catalog,src_path)
+        flist_rgb = np.array([e['file_rgb'] for e in entries])
+        flist_nir = np.array([e['file_nir'] for e in entries])
+        names = [e['name'] for e in entries]
+        georefs = [(e['geo_tsf'],e['geo_proj']) for e in entries]
+        return flist_rgb,flist_nir,names,georefs
     # modification M.LEI 2022-06-13
     src_path_rgb = os.path.join(src_path,'RGB')
     src_path_nir = os.path.join(src_path,'IR')
     # end modification M.LEI 2022-06-13
     pattern = os.path.join(src_path_rgb,pref_rgb+'*'+ext_rgb)
-    flist_rgb = np.array([f.replace("\\","/") for f in glob.glob(pattern)]) 
-    flist_rgb = flist_rgb[0::jump]
-    if len(flist_rgb)==0:
-        print('global thresholding failed, no image found')
-        return None
-    print(len(flist_rgb),'images used:')
+    flist_rgb = np.array([f.replace("\\","/") for f in aio.list_files(pattern)]) 
     flist_nir = []
+    names = []
     for file_rgb in flist_rgb:
         name = file_rgb[len(src_path_rgb+pref_rgb)+1:-len(ext_rgb)]
         file_nir = os.path.join(src_path_nir,pref_nir+name+ext_nir)
         file_nir =file_nir.replace("\\","/") #unix-windows problem
         flist_nir.append(file_nir)
-        print('rgb: '+file_rgb[len(src_path_rgb)+1:])
-        print('nir: '+file_nir[len(src_path_nir)+1:])
+        names.append(file_rgb[len(src_path_rgb)+1:-len(ext_rgb)])
+    return flist_rgb,np.array(flist_nir),names,[None]*len(flist_rgb)
+
+def image_geometries(src_path,flist_rgb,catalog=None):
+    '''(geo_tsf,nx,ny) of the RVB images, from the catalog if given, else
+    from the image headers (see footprints.image_geometry)'''
+    if catalog:
+        geometry = {e['file_rgb']:(e['geo_tsf'],e['nx'],e['ny'])
+                    for e in cat.read_catalog(catalog,src_path)}
+        return [geometry.get(file) for file in flist_rgb]
+    return [fp.image_geometry(file) for file in flist_rgb]
+
+def global_thresholding(src_path,pref_rgb,pref_nir,ext_rgb,ext_nir,bits,jump,sub,hsteq,method,
+                        workers=1,catalog=None,max_mem=None,nodata=None,
+                        runs=None,index_cache=None,cache_bits=16,
+                        footprint=False,footprint_cell=256,aoi=None): 
+    print('-------------------------')
+    print('global thresholding start.')
+    start_thresholding = time.time()
+    #nodata values of the catalog, the files are not opened for 'auto'
+    known_nodata = cat.catalog_nodata(catalog,src_path) if catalog \
+        else None
+    flist_rgb,flist_nir,names,georefs = image_pairs(src_path,pref_rgb,pref_nir,
+                                                    ext_rgb,ext_nir,catalog)
+    flist_rgb = flist_rgb[0::jump]
+    flist_nir = flist_nir[0::jump]
+    names = names[0::jump]
+    if len(flist_rgb)==0:
+        print('global thresholding failed, no image found')
+        return None
+    geometries = None
+    if footprint or aoi is not None:
+        geometries = image_geometries(src_path,flist_rgb,catalog)
+    if aoi is not None:
+        #only the images intersecting the area of interest
+        aoi_windows = [ai.aoi_window(aoi,*g) if g is not None else None 
+                       for g in geometries]
+        keep = [k for k,w in enumerate(aoi_windows) if w is not None]
+        print(len(keep),'of',len(flist_rgb),'images in the area of interest')
+        if len(keep)==0:
+            print('global thresholding failed, no image in the area of '
+                  'interest')
+            return None
+        flist_rgb = flist_rgb[keep]
+        flist_nir = flist_nir[keep]
+        names = [names[k] for k in keep]
+        geometries = [geometries[k] for k in keep]
+        aoi_windows = [aoi_windows[k] for k in keep]
+    print(len(flist_rgb),'images used:')
+    for j in range(len(flist_rgb)):
+        print('rgb: '+os.path.basename(flist_rgb[j]))
+        print('nir: '+os.path.basename(flist_nir[j]))
 
+    strip = None
+    if max_mem:
+        info = cat.raster_info(flist_rgb[0])
+        plan = planner.plan_thresholding(max_mem,info['nx'],info['ny'],4,bits,
+                                         len(flist_rgb),sub,
+                                         method=runs or method,hsteq=hsteq,
+                                         max_workers=workers if workers>1 
+                                         else None)
+        planner.print_plan(plan,'thresholding')
+        if not plan['fits']:
+            print('global thresholding failed, memory budget too small')
+            return None
+        workers,strip = plan['workers'],plan['strip']
+    fp_plan = None
+    if footprint and any([m=='tsai' and h 
+                          for m,h in runs or [(method,hsteq)]]):
+        #the masks are equalized with the histogram of the whole image,
+        #the thresholding must use the same pixels
+        print('footprint sampling is not used with hsteq, the equalization '
+              'histogram needs whole images')
+    elif footprint:
+        fp_plan = fp.footprint_plan(geometries,cell=footprint_cell)
+        if fp_plan is None:
+            print('footprint sampling needs north-up georeferenced images, '
+                  'whole images are used')
+        elif index_cache:
+            print('index cache is not written with footprint sampling')
+            index_cache = None
     #create bgrn_list
     bgrn_list = []                   
+    valid_list = [] if nodata is not None or fp_plan is not None or \
+        aoi is not None else None
+    windows = []
     for j in range(len(flist_rgb)):
-        bgr = cv2.imread(flist_rgb[j],cv2.IMREAD_UNCHANGED)
-        nir = cv2.imread(flist_nir[j],cv2.IMREAD_UNCHANGED)
+        #part of the image in the area of interest
+        aoi_window = aoi_windows[j] if aoi is not None else None
+        #part of the image not seen better by another image
+        window,owned = fp.owned_window(fp_plan,j,sub,within=aoi_window)
+        if fp_plan is None:
+            window = aoi_window
+        windows.append(window)
+        if fp_plan is not None and window is None:
+            continue
+        bgr = aio.read_image(flist_rgb[j],window=window)
+        nir = aio.read_image(flist_nir[j],window=window)
         bgr_sub = bgr[0::sub,0::sub,:]
         nir_sub = nir[0::sub,0::sub]
         ny,nx,nb = bgr_sub.shape        
@@ -102,74 +277,214 @@ def global_thresholding(src_path,pref_rgb,pref_nir,ext_rgb,ext_nir,bits,jump,sub
         bgrn[:,:,0:3] = bgr_sub
         bgrn[:,:,3] = nir_sub
         bgrn_list.append(bgrn)
+        nodata_j = cat.file_nodata(flist_rgb[j],nodata,known_nodata)
+        if valid_list is not None:
+            valid = sm.valid_mask(bgrn,nodata_j)
+            inside = None
+            if aoi is not None:
+                inside = ai.aoi_mask(aoi,geometries[j][0],window,sub)
+            for m in [owned,inside]:
+                if m is not None:
+                    valid = m if valid is None else valid&m
+            valid_list.append(valid)
+        if index_cache:
+            #full resolution indices for the mask phase, no second decoding
+            bgrn_full = np.dstack([bgr,nir])
+            ic.write_indices(index_cache,names[j],bgrn_full,bits,
+                             ic.index_keys(runs or [(method,hsteq)],4),
+                             valid=sm.valid_mask(bgrn_full,nodata_j),
+                             qbits=cache_bits,nodata=nodata_j,strip=strip)
+            bgrn_full = None
+    if fp_plan is not None:
+        fp.print_sampling(fp_plan,windows)
     
-    th = sm.global_thresholding_bgrn(bgrn_list,bits,method,hsteq=hsteq)
+    if runs is not None:
+        #several methods from the same images
+        if workers>1 or strip:
+            th = ss.global_thresholding_bgrn_multi(bgrn_list,bits,runs,
+                                                   workers=workers,
+                                                   strip=strip,
+                                                   valid_list=valid_list)
+        else:
+            th = sm.global_thresholding_bgrn_multi(bgrn_list,bits,runs,
+                                                   valid_list=valid_list)
+    elif workers>1 or strip:
+        th = ss.global_thresholding_bgrn(bgrn_list,bits,method,hsteq=hsteq,
+                                         workers=workers,strip=strip,
+                                         valid_list=valid_list)
+    else:
+        th = sm.global_thresholding_bgrn(bgrn_list,bits,method,hsteq=hsteq,
+                                         valid_list=valid_list)
     end_thresholding = time.time()
     print('temps pour le thresholding :', end_thresholding - start_thresholding)
     print('global threshoding end.')
     print('threshold of [shadow, water, vegetation]')
-    print(th)
+    if runs is not None:
+        for run in th:
+            print(sm.run_name(run),th[run])
+    else:
+        print(th)
     print('-------------------------')
     return th
 
 
-def shadow_mask(src_path,pref_rgb,pref_nir,ext_rgb,ext_nir,bits,hsteq,method,th,dst_path,masked_image):
+def shadow_mask(src_path,pref_rgb,pref_nir,ext_rgb,ext_nir,bits,hsteq,method,th,dst_path,masked_image,
+                backend='numpy',workers=1,catalog=None,
+                mask_format='tif',overviews=False,mosaic=False,max_mem=None,
+                nodata=None,runs=None,index_cache=None,cache_bits=16,
+                aoi=None,report=None):
     print('---------------------------------')
     print('|rgb-nir image shadow mask start|')
     print('---------------------------------')
     start_mask = time.time()
-    # modification M.LEI 2022-06-13
-    src_path_rgb = os.path.join(src_path,'RGB')
-    src_path_nir = os.path.join(src_path,'IR')
-    # end modification M.LEI 2022-06-13
-    
-    pattern = os.path.join(src_path_rgb,pref_rgb+'*'+ext_rgb)
-    flist_rgb = np.array([f.replace("\\","/") for f in glob.glob(pattern)]) 
-    flist_nir = []
-    for file_rgb in flist_rgb:
-        name = file_rgb[len(src_path_rgb+pref_rgb)+1:-len(ext_rgb)]
-        file_nir = os.path.join(src_path_nir,pref_nir+name+ext_nir)
-        file_nir =file_nir.replace("\\","/") #unix-windows problem
-        flist_nir.append(file_nir)
+    #nodata values of the catalog, the files are not opened for 'auto'
+    known_nodata = cat.catalog_nodata(catalog,src_path) if catalog \
+        else None
+    flist_rgb,flist_nir,names,georefs = image_pairs(src_path,pref_rgb,pref_nir,
+                                                    ext_rgb,ext_nir,catalog)
+    if aoi is not None:
+        geometries = image_geometries(src_path,flist_rgb,catalog)
         
+    if runs is not None:
+        #one output directory per method
+        dst_runs = {run:os.path.join(dst_path,sm.run_name(run)) for run in th}
+        for dst_run in dst_runs.values():
+            os.makedirs(dst_run,exist_ok=True)
+        mosaic_runs = {run:([] if mosaic else None) for run in th}
+        if backend!='numpy':
+            print('the masks of several methods share their indices in '
+                  'NumPy, backend',backend,'is not used')
+    else:
+        mosaic_list = [] if mosaic else None
+    workers_j,strip_j = workers,None
+    last_plan = None
+    rows = []
+    keys = ic.index_keys(runs or [(method,hsteq)],4)
     for j in range(len(flist_rgb)):       
-        bgr = cv2.imread(flist_rgb[j],cv2.IMREAD_UNCHANGED)
-        nir = cv2.imread(flist_nir[j],cv2.IMREAD_UNCHANGED)
-        ny,nx,nb = bgr.shape        
-        bgrn = np.empty([ny,nx,nb+1],dtype=bgr.dtype) 
-        bgrn[:,:,0:3] = bgr
-        bgrn[:,:,3] = nir
-        #call shadow_mask_bgrn
-        mask = sm.shadow_mask_bgrn(bgrn,th,bits,method,hsteq=hsteq)        
-        # #save result
-        name = flist_rgb[j][len(src_path_rgb)+1:-len(ext_rgb)]        
-        maskfile = os.path.join(dst_path,'mask_'+name+'.tif')
-        cv2.imwrite(maskfile,((1-mask)*255).astype(np.uint8))
-        #add georef from original image to mask 
-        georef_src = gdal.Open(flist_rgb[j])
-        georef_dst = gdal.OpenShared(maskfile,gdal.GA_Update)
-        geo_tsf = georef_src.GetGeoTransform()
-        geo_proj = georef_src.GetProjection()
-        georef_dst.SetGeoTransform(geo_tsf)
-        georef_dst.SetProjection(geo_proj)
-        print(name+' shadow mask done')
-        if(masked_image):
-            #save bgr_8bits with mask
-            if bits==8:
-                bgr8 = bgr.copy()
-            elif bits==16:
-                bgr8 = sm.linear_stretch_16bits_to_8bits(bgr,vmin=0,vmax=0.98)
+        name = names[j]        
+        #only the window of the images in the area of interest is read and
+        #written
+        window = None
+        if aoi is not None:
+            if geometries[j] is not None:
+                window = ai.aoi_window(aoi,*geometries[j])
+            if window is None:
+                print(name+' out of the area of interest')
+                continue
+        #masks from the index cache, the images are only decoded for 
+        #masked_image
+        cached = index_cache is not None and not masked_image and \
+            ic.has_indices(index_cache,name,keys,bits,qbits=cache_bits,
+                           nodata=cat.file_nodata(flist_rgb[j],nodata,known_nodata))
+        if max_mem and not cached:
+            if window is not None:
+                nx,ny = window[2:4]
             else:
-                print('bits must = 8 or 16!')
-            #Superpose mask on the original image
-            val = [0,0,255]
-            for i in range(3):
-                v = bgr8[:,:,i]
-                v[mask==1] = val[i]
-                bgr8[:,:,i] = v        
-            imfile = os.path.join(dst_path,'masked_'+name+'.jpg')
-            cv2.imwrite(imfile,bgr8)
-            print(name+' shadow masked image done')
+                info = cat.raster_info(flist_rgb[j])
+                nx,ny = info['nx'],info['ny']
+            plan = planner.plan_mask(max_mem,nx,ny,4,bits,
+                                     method=runs or method,hsteq=hsteq,
+                                     max_workers=workers if workers>1 
+                                     else None,masked_image=masked_image)
+            workers_j,strip_j = plan['workers'],plan['strip']
+            if (workers_j,strip_j)!=last_plan or not plan['fits']:
+                planner.print_plan(plan,'mask')
+                last_plan = (workers_j,strip_j)
+            if not plan['fits']:
+                print(name+' shadow mask failed, memory budget too small')
+                return
+        #statistics of the quality report, from the arrays of the masks,
+        #{run:stats} for several methods
+        stats = {} if report else None
+        if cached and runs is not None:
+            masks = ic.cached_masks_multi(index_cache,name,th,bits,
+                                          stats=stats)
+        elif cached:
+            mask = ic.cached_mask(index_cache,name,th,bits,method=method,
+                                  hsteq=hsteq,bands=4,stats=stats)
+        else:
+            bgr = aio.read_image(flist_rgb[j],window=window)
+            nir = aio.read_image(flist_nir[j],window=window)
+            ny,nx,nb = bgr.shape        
+            bgrn = np.empty([ny,nx,nb+1],dtype=bgr.dtype) 
+            bgrn[:,:,0:3] = bgr
+            bgrn[:,:,3] = nir
+            #call shadow_mask_bgrn on the valid area
+            valid = sm.valid_mask(bgrn,cat.file_nodata(flist_rgb[j],nodata,known_nodata))
+            #pixels inside the area of interest, as in the thresholding (also
+            #for the hsteq histogram)
+            if aoi is not None:
+                inside = ai.aoi_mask(aoi,geometries[j][0],window)
+                if inside is not None:
+                    valid = inside if valid is None else valid&inside
+        if runs is not None and not cached:
+            #shared indices computed once, one mask per method
+            def mask_func(img,box,valid_box):
+                if workers_j>1 or strip_j:
+                    return ss.shadow_mask_bgrn_multi(img,th,bits,
+                                                     workers=workers_j,
+                                                     strip=strip_j,
+                                                     valid=valid_box,
+                                                     stats=stats)
+                return sm.shadow_mask_bgrn_multi(img,th,bits,valid=valid_box,
+                                                 stats=stats)
+            masks = sm.valid_area_mask(mask_func,bgrn,valid,keys=list(th))
+        elif not cached:
+            def mask_func(img,box,valid_box):
+                if workers_j>1 or strip_j:
+                    return ss.shadow_mask_bgrn(img,th,bits,method,hsteq=hsteq,
+                                               backend=backend,
+                                               workers=workers_j,
+                                               strip=strip_j,
+                                               valid=valid_box,stats=stats)
+                return sm.shadow_mask_bgrn(img,th,bits,method,hsteq=hsteq,
+                                           backend=backend,valid=valid_box,
+                                           stats=stats)
+            mask = sm.valid_area_mask(mask_func,bgrn,valid)
+        if runs is not None:
+            outputs = [(masks[run],dst_runs[run],mosaic_runs[run],
+                        ' '+sm.run_name(run)) for run in th]
+            if report:
+                rows += [qr.report_row(name,stats.get(run,{}),th[run],run[0],
+                                       run=sm.run_name(run)) for run in th]
+        else:
+            outputs = [(mask,dst_path,mosaic_list,'')]
+            if report:
+                rows.append(qr.report_row(name,stats,th,method))
+        # #save result
+        georef = ai.window_georef(georefs[j] or 
+                                  mio.source_georef(flist_rgb[j]),window)
+        for mask,dst_run,mosaic_run,run_label in outputs:
+            mio.write_mask(mask,name,dst_run,georef,mask_format=mask_format,
+                           overviews=overviews,mosaic=mosaic_run)
+            print(name+run_label+' shadow mask done')
+            if(masked_image):
+                #save bgr_8bits with mask
+                if bits==8:
+                    bgr8 = bgr.copy()
+                elif bits==16:
+                    bgr8 = sm.linear_stretch_16bits_to_8bits(bgr,vmin=0,
+                                                             vmax=0.98)
+                else:
+                    print('bits must = 8 or 16!')
+                #Superpose mask on the original image
+                val = [0,0,255]
+                for i in range(3):
+                    v = bgr8[:,:,i]
+                    v[mask==1] = val[i]
+                    bgr8[:,:,i] = v        
+                imfile = os.path.join(dst_run,'masked_'+name+'.jpg')
+                cv2.imwrite(imfile,bgr8)
+                print(name+run_label+' shadow masked image done')
+    if runs is not None:
+        mosaics = [(dst_runs[run],mosaic_runs[run]) for run in th]
+    else:
+        mosaics = [(dst_path,mosaic_list)]
+    for dst_run,mosaic_run in mosaics:
+        if mosaic_run is not None and mio.write_mosaic(dst_run,mosaic_run):
+            print('mask mosaic:',os.path.join(dst_run,mio.MOSAIC_NAME))
+    if report:
+        print('quality report:',qr.write_report(report,rows))
     end_mask = time.time()
     print('temps pour le mask :', end_mask - start_mask) 
     print('---------------------------')
@@ -219,17 +534,22 @@ def main(**kwargs):
     else:
         sub = 10
     if 'hsteq' in kwargs:
-        hsteq = kwargs.get('hsteq')
-        if hsteq == 'True':
-            hsteq = True
-        else:
-            hsteq = False
+        hsteq_list = [v=='True' for v in kwargs.get('hsteq').split(',')]
     else:
-        hsteq = False
+        hsteq_list = [False]
     if 'method' in kwargs:
-        method = kwargs.get('method')
+        method_list = kwargs.get('method').split(',')
+    else:
+        method_list = ['nagao']
+    runs = sm.method_runs(method_list,hsteq_list)
+    if len(runs)>1:
+        #several methods, hsteq and method are only used by the planner
+        hsteq = any([h for m,h in runs])
+        method = ','.join([sm.run_name(run) for run in runs])
     else:
-        method = 'nagao'
+        hsteq = hsteq_list[0]
+        method = method_list[0]
+        runs = None
     if 'output' in kwargs:
         dst_path = kwargs.get('output')
     else:
@@ -239,6 +559,38 @@ def main(**kwargs):
         jump = 1
     else:
         th_path = src_path
+    if 'workers' in kwargs:
+        workers = int(kwargs.get('workers'))
+    else:
+        workers = 1
+    if 'overviews' in kwargs:
+        overviews = kwargs.get('overviews')=='True'
+    else:
+        overviews = False
+    if 'mosaic' in kwargs:
+        mosaic = kwargs.get('mosaic')=='True'
+    else:
+        mosaic = False
+    if 'max_mem' in kwargs:
+        max_mem = kwargs.get('max_mem')
+    else:
+        max_mem = None
+    if 'mask_format' in kwargs:
+        mask_format = kwargs.get('mask_format')
+    else:
+        mask_format = 'tif'
+    if 'catalog' in kwargs:
+        catalog = kwargs.get('catalog')
+    else:
+        catalog = None
+    if 'rebuild' in kwargs:
+        rebuild = kwargs.get('rebuild')=='True'
+    else:
+        rebuild = False
+    if 'backend' in kwargs:
+        backend = kwargs.get('backend')
+    else:
+        backend = 'numpy'
     if 'masked_image' in kwargs:
         masked_image = kwargs.get('masked_image')
         if masked_image == 'True':
@@ -247,11 +599,49 @@ def main(**kwargs):
             masked_image = False
     else:
         masked_image = False
+    if 'index_cache' in kwargs:
+        index_cache = kwargs.get('index_cache')
+    else:
+        index_cache = None
+    if 'cache_bits' in kwargs:
+        cache_bits = int(kwargs.get('cache_bits'))
+    else:
+        cache_bits = 16
+    if 'footprint' in kwargs:
+        footprint = kwargs.get('footprint')=='True'
+    else:
+        footprint = False
+    if 'footprint_cell' in kwargs:
+        footprint_cell = int(kwargs.get('footprint_cell'))
+    else:
+        footprint_cell = 256
+    if 'nodata' in kwargs:
+        nodata = kwargs.get('nodata')
+        if nodata!='auto':
+            nodata = float(nodata)
+    else:
+        nodata = None
+    if 'report' in kwargs:
+        report = kwargs.get('report')
+    else:
+        report = None
+    if 'aoi' in kwargs:
+        aoi = ai.read_aoi(kwargs.get('aoi'))
+        if aoi is None:
+            return
+        if index_cache:
+            print('index cache is not used with an area of interest')
+            index_cache = None
+    else:
+        aoi = None
     if 'th' in kwargs:
         th = [float(v) for v in kwargs.get('th')[1:-1].split(',')]
         if len(th)!=3:
             print('th if a list of 3 parameters [th_shadow,th_wat,th_veg]')
             th = None
+        elif runs is not None:
+            print('user defined threshold needs a single method')
+            return
     else:
         th = None
     
@@ -268,12 +658,51 @@ def main(**kwargs):
     print('method = ',method)
     print('output path =',dst_path)
     print('output masked image =',masked_image)
+    print('mask format =',mask_format)
+    print('mask overviews =',overviews)
+    print('mask mosaic =',mosaic)
+    print('quality report =',report)
+    print('backend = ',backend)
+    print('workers = ',workers)
+    print('max_mem = ',max_mem)
+    print('nodata = ',nodata)
+    print('footprint sampling = ',footprint)
+    if aoi is not None:
+        print('area of interest = ',kwargs.get('aoi'))
+    if index_cache:
+        print('index cache = ',index_cache,', bits =',cache_bits)
+    if catalog:
+        print('catalog = ',catalog)
+        #scan the chantiers once, check the image pairs before processing
+        errors = []
+        for path in set([p for p in [src_path,th_path] if p!='']):
+            n = cat.build_catalog(catalog,path,pref_rgb=pref_rgb,ext_rgb=ext_rgb,
+                                  pref_nir=pref_nir,ext_nir=ext_nir,
+                                  rebuild=rebuild)
+            print(n,'image pairs in catalog for',path)
+            errors += cat.check_catalog(cat.read_catalog(catalog,path),bits)
+        if errors:
+            print('catalog check failed:')
+            for error in errors:
+                print(error)
+            return
     if(th):
         print('user defined threshold of [shadow, water, vegetation] =',th)
     elif th_path !='':
-        th = global_thresholding(th_path,pref_rgb,pref_nir,ext_rgb,ext_nir,bits,jump,sub,hsteq,method)
+        th = global_thresholding(th_path,pref_rgb,pref_nir,ext_rgb,ext_nir,bits,jump,sub,hsteq,method,
+                                 workers=workers,catalog=catalog,
+                                 max_mem=max_mem,nodata=nodata,runs=runs,
+                                 index_cache=index_cache 
+                                 if th_path==src_path else None,
+                                 cache_bits=cache_bits,footprint=footprint,
+                                 footprint_cell=footprint_cell,aoi=aoi)
     if dst_path !='' and th:
-        shadow_mask(src_path,pref_rgb,pref_nir,ext_rgb,ext_nir,bits,hsteq,method,th,dst_path,masked_image)
+        shadow_mask(src_path,pref_rgb,pref_nir,ext_rgb,ext_nir,bits,hsteq,method,th,dst_path,masked_image,
+                    backend=backend,workers=workers,catalog=catalog,
+                    mask_format=mask_format,overviews=overviews,mosaic=mosaic,
+                    max_mem=max_mem,nodata=nodata,runs=runs,
+                    index_cache=index_cache,cache_bits=cache_bits,aoi=aoi,
+                    report=report)
 
 if __name__ == '__main__':
     main(**dict([arg.split('=') for arg in os.sys.argv[1:]]))
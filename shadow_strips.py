@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Module name:
+    shadow_strips
+    ------------
+    Exécution par bandes de lignes dans un pool de threads des fonctions de
+    shadow_mask, pour occuper tous les coeurs sur une seule grande image.
+    NumPy libère le GIL dans ses ufuncs, les threads partagent la mémoire
+    de l'image et écrivent dans un seul masque pré-alloué.
+
+    Les fonctions utiles sont:
+        strip_slices: découpage des lignes d'une image en bandes
+        run_strips: exécution d'une fonction par bande, résultat écrit dans
+                    un tableau pré-alloué
+        hist_strips: histogramme d'une carte d'indice calculé par bande
+        range_strips: min et max d'une carte d'indice calculé par bande
+        shadow_mask_bgr: shadow_mask.shadow_mask_bgr par bande
+        shadow_mask_bgrn: shadow_mask.shadow_mask_bgrn par bande
+        global_thresholding_bgr: shadow_mask.global_thresholding_bgr avec
+                                 histogrammes par bande
+        global_thresholding_nagao: idem pour la méthode Nagao79
+        water_detection, vegetation_detection: histogrammes NDWI/NDVI par
+                                               bande, en 2 passes (étendue
+                                               des valeurs, histogramme)
+        global_thresholding_bgrn: processus pour le seuillage global RVB+PIR
+        global_thresholding_bgrn_multi: seuillage global RVB+PIR pour 
+                                        plusieurs méthodes
+        shadow_mask_bgrn_multi: masques RVB+PIR de plusieurs méthodes par 
+                                bande
+
+    Les résultats sont identiques à ceux de shadow_mask, y compris avec
+    des pixels nodata et les statistiques des masques. Avec hsteq=True
+    l'égalisation d'histogramme de hsi_ratio porte sur l'image entière, le
+    calcul Tsai06 n'est alors pas découpé en bandes.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import shadow_mask as sm
+
+
+def strip_slices(ny,workers,strip=None):
+    '''row slices of the strips of an image
+    args:
+        ny: number of rows
+        workers: number of threads
+        strip: number of rows of a strip, default gives 4 strips per thread
+    return:
+        list of slice
+    '''
+    if strip is None:
+        strip = int(np.ceil(ny/(4*workers)))
+    strip = max(1,strip)
+    return [slice(i,min(i+strip,ny)) for i in range(0,ny,strip)]
+
+
+def run_strips(func,shape,workers=4,strip=None,out=None,dtype=bool):
+    '''run func on the row strips of an image in a thread pool
+    args:
+        func: function of a row slice, returns the [rows,nx] result of the
+              strip
+        shape: image shape
+        workers: number of threads
+        strip: number of rows of a strip
+        out: preallocated [ny,nx] output, allocated with dtype if None
+    return:
+        out
+    '''
+    ny,nx = shape[0:2]
+    if out is None:
+        out = np.empty((ny,nx),dtype=dtype)
+    def job(s):
+        out[s] = func(s)
+    if workers==1:
+        #no pool, the strips run in the calling thread
+        for s in strip_slices(ny,workers,strip):
+            job(s)
+        return out
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(job,strip_slices(ny,workers,strip)))
+    return out
+
+
+def hist_strips(func,img,bins_range,step=1,workers=4,strip=None,
+                valid=None):
+    '''histogram of an index map computed strip by strip
+    args:
+        func: index function of an image array, e.g. shadow_mask.nagao
+        img: image array
+        bins_range, step: see shadow_mask.hist_uniform
+        workers: number of threads
+        strip: number of rows of a strip
+        valid: boolean array, only valid pixels are counted, default all
+    return:
+        x: bins center
+        hist: histogram, sum of the strips histograms
+    '''
+    def job(s):
+        v = func(img[s])
+        if valid is not None:
+            v = v[valid[s]]
+        return sm.hist_uniform(v,bins_range,step=step)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        res = list(pool.map(job,strip_slices(img.shape[0],workers,strip)))
+    x = res[0][0]
+    hist = np.sum([r[1] for r in res],axis=0)
+    return x,hist
+
+
+def _kernel_workers(backend,hsteq,th,workers):
+    '''(backend,workers) of the strips: the compiled kernel is multithreaded
+    itself, and the default threading layer of numba hangs when it is 
+    launched from the threads of a pool. The strips of the kernel run one
+    after the other in the calling thread'''
+    if backend=='numpy':
+        return backend,workers
+    if sm._use_kernels(backend,hsteq,th):
+        return backend,1
+    return 'numpy',workers
+
+
+def shadow_mask_bgr(bgr,th_hi_ratio,bits,hsteq=False,backend='numpy',
+                    workers=4,strip=None,valid=None,hue='exact',stats=None):
+    '''shadow mask for only bgr image, computed by strips
+    args:
+        see shadow_mask.shadow_mask_bgr
+        workers: number of threads
+        strip: number of rows of a strip
+    return:
+        mask: shadow mask
+    '''
+    if hsteq:
+        return sm.shadow_mask_bgr(bgr,th_hi_ratio,bits,hsteq=hsteq,
+                                  backend=backend,valid=valid,hue=hue,
+                                  stats=stats)
+    backend,workers = _kernel_workers(backend,hsteq,th_hi_ratio,workers)
+    strip_stats = []
+    def func(s):
+        th = th_hi_ratio if np.ndim(th_hi_ratio)==0 else th_hi_ratio[s]
+        st = None if stats is None else {}
+        mask = sm.shadow_mask_bgr(bgr[s],th,bits,backend=backend,
+                                  valid=None if valid is None else valid[s],
+                                  hue=hue,stats=st)
+        if st is not None:
+            strip_stats.append(st)
+        return mask
+    mask = run_strips(func,bgr.shape,workers=workers,strip=strip)
+    for st in strip_stats:
+        sm.merge_stats(stats,st)
+    return mask
+
+
+def shadow_mask_bgrn(bgrn,th,bits,method,hsteq=False,backend='numpy',
+                     workers=4,strip=None,valid=None,stats=None):
+    '''shadow mask for bgrn [b,g,r,nir] image, computed by strips
+    args:
+        see shadow_mask.shadow_mask_bgrn
+        workers: number of threads
+        strip: number of rows of a strip
+    return:
+        mask: shadow mask
+    '''
+    if hsteq and method=='tsai':
+        return sm.shadow_mask_bgrn(bgrn,th,bits,method,hsteq=hsteq,
+                                   backend=backend,valid=valid,stats=stats)
+    if method not in ['tsai','nagao']:
+        print("The available methods are:'bgr','nagao'")
+        return None
+    backend,workers = _kernel_workers(backend,hsteq,th[0],workers)
+    strip_stats = []
+    def func(s):
+        st = None if stats is None else {}
+        mask = sm.shadow_mask_bgrn(bgrn[s],th,bits,method,backend=backend,
+                                   valid=None if valid is None else valid[s],
+                                   stats=st)
+        if st is not None:
+            strip_stats.append(st)
+        return mask
+    mask = run_strips(func,bgrn.shape,workers=workers,strip=strip)
+    for st in strip_stats:
+        sm.merge_stats(stats,st)
+    return mask
+
+
+def global_thresholding_bgr(bgr_list,bits,hsteq=False,workers=4,strip=None,
+                            valid_list=None,hue='exact'):
+    '''
+    global thresholding for a set of bgr images, tsai06 method,
+    histograms computed by strips
+    ---------------
+    args:
+        see shadow_mask.global_thresholding_bgr
+        workers: number of threads
+        strip: number of rows of a strip
+    return:
+        th: Otsu threshod of (H+1)/(Ieq+1) ratio
+    '''
+    if hsteq:
+        return sm.global_thresholding_bgr(bgr_list,bits,hsteq=hsteq,
+                                          valid_list=valid_list,hue=hue)
+    if valid_list is None:
+        valid_list = [None]*len(bgr_list)
+    hist = 0
+    for bgr,valid in zip(bgr_list,valid_list):
+        x,h = hist_strips(lambda v: sm.hsi_ratio(v,bits,hue=hue),bgr,
+                          [0,360],workers=workers,strip=strip,valid=valid)
+        hist = hist+h
+    ith = sm.otsu_thresholding(hist,x)
+    return x[ith]
+
+
+def global_thresholding_nagao(bgrn_list,bits,workers=4,strip=None,
+                              valid_list=None):
+    '''
+    global thresholding from a set of bgrn images, nagao79 method,
+    histograms computed by strips
+    args:
+        see shadow_mask.global_thresholding_nagao
+        workers: number of threads
+        strip: number of rows of a strip
+    returns:
+        th_nagao: shadow thresholdng from bgrn image
+    '''
+    PMAX = sm._pmax(bits)
+    step = 1 if bits==8 else PMAX/1000
+    if valid_list is None:
+        valid_list = [None]*len(bgrn_list)
+    hist = 0
+    for bgrn,valid in zip(bgrn_list,valid_list):
+        x,h = hist_strips(sm.nagao,bgrn,[0,PMAX],step=step,
+                          workers=workers,strip=strip,valid=valid)
+        hist = hist+h
+    valleys = sm.hist_valleys(hist)
+    return x[valleys[0]]
+
+
+def range_strips(func,img,workers=4,strip=None,valid=None):
+    '''min and max of an index map computed strip by strip
+    args:
+        see hist_strips
+    return:
+        vmin,vmax: (inf,-inf) if no pixel is counted
+    '''
+    def job(s):
+        v = func(img[s])
+        if valid is not None:
+            v = v[valid[s]]
+        if v.size==0:
+            return np.inf,-np.inf
+        return np.min(v),np.max(v)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        res = list(pool.map(job,strip_slices(img.shape[0],workers,strip)))
+    return min([r[0] for r in res]),max([r[1] for r in res])
+
+
+def _last_valley(func,bgrn_list,workers,strip,valid_list=None):
+    '''last valley threshold of an index, as water/vegetation_detection.
+    The index maps are computed twice by strips, for the value range of
+    all the images then for the sum of their histograms on this range'''
+    if valid_list is None:
+        valid_list = [None]*len(bgrn_list)
+    vrange = [range_strips(func,bgrn,workers=workers,strip=strip,
+                           valid=valid)
+              for bgrn,valid in zip(bgrn_list,valid_list)]
+    vmin = min([r[0] for r in vrange])
+    vmax = max([r[1] for r in vrange])
+    step = (vmax-vmin)/1000
+    hist = 0
+    for bgrn,valid in zip(bgrn_list,valid_list):
+        x,h = hist_strips(func,bgrn,[vmin,vmax],step=step,workers=workers,
+                          strip=strip,valid=valid)
+        hist = hist+h
+    valleys = sm.hist_valleys(hist)
+    return x[valleys[-1]]
+
+
+def water_detection(bgrn_list,workers=4,strip=None,valid_list=None):
+    '''shadow_mask.water_detection with ndwi maps computed by strips'''
+    return _last_valley(sm.ndwi,bgrn_list,workers,strip,valid_list)
+
+
+def vegetation_detection(bgrn_list,workers=4,strip=None,valid_list=None):
+    '''shadow_mask.vegetation_detection with ndvi maps computed by strips'''
+    return _last_valley(sm.ndvi,bgrn_list,workers,strip,valid_list)
+
+
+def global_thresholding_bgrn(bgrn_list,bits,method,hsteq=False,workers=4,
+                             strip=None,valid_list=None):
+    '''
+    global thresholding from a set of bgrn images, computed by strips
+    args:
+        see shadow_mask.global_thresholding_bgrn
+        workers: number of threads
+        strip: number of rows of a strip
+    returns:
+        th = [th1,th_wat,th_veg]
+    '''
+    if method=='tsai':
+        bgr_list = [bgrn[:,:,0:3] for bgrn in bgrn_list]
+        th1 = global_thresholding_bgr(bgr_list,bits,hsteq=hsteq,
+                                      workers=workers,strip=strip,
+                                      valid_list=valid_list)
+    elif method=='nagao':
+        th1 = global_thresholding_nagao(bgrn_list,bits,workers=workers,
+                                        strip=strip,valid_list=valid_list)
+    else:
+        print("The available methods are:'bgr','nagao'")
+    th_wat = water_detection(bgrn_list,workers=workers,strip=strip,
+                             valid_list=valid_list)
+    th_veg = vegetation_detection(bgrn_list,workers=workers,strip=strip,
+                                  valid_list=valid_list)
+    return [th1,th_wat,th_veg]
+
+
+def global_thresholding_bgrn_multi(bgrn_list,bits,runs,workers=4,strip=None,
+                                   valid_list=None):
+    '''
+    global thresholding from a set of bgrn images for several runs,
+    computed by strips
+    args:
+        see shadow_mask.global_thresholding_bgrn_multi
+        workers: number of threads
+        strip: number of rows of a strip
+    returns:
+        th: dict {(method,hsteq):[th1,th_wat,th_veg]}
+    '''
+    th_wat = water_detection(bgrn_list,workers=workers,strip=strip,
+                             valid_list=valid_list)
+    th_veg = vegetation_detection(bgrn_list,workers=workers,strip=strip,
+                                  valid_list=valid_list)
+    bgr_list = [bgrn[:,:,0:3] for bgrn in bgrn_list]
+    th = {}
+    for method,hsteq in runs:
+        if method=='tsai':
+            th1 = global_thresholding_bgr(bgr_list,bits,hsteq=hsteq,
+                                          workers=workers,strip=strip,
+                                          valid_list=valid_list)
+        elif method=='nagao':
+            th1 = global_thresholding_nagao(bgrn_list,bits,workers=workers,
+                                            strip=strip,valid_list=valid_list)
+        else:
+            print("The available methods are:'bgr','nagao'")
+            continue
+        th[(method,hsteq)] = [th1,th_wat,th_veg]
+    return th
+
+
+def shadow_mask_bgrn_multi(bgrn,th,bits,workers=4,strip=None,valid=None,
+                           stats=None):
+    '''shadow masks of a bgrn image for several runs, computed by strips
+    args:
+        see shadow_mask.shadow_mask_bgrn_multi
+        workers: number of threads
+        strip: number of rows of a strip
+    returns:
+        masks: dict {(method,hsteq):mask}
+    '''
+    if not th or any([method=='tsai' and hsteq for method,hsteq in th]):
+        return sm.shadow_mask_bgrn_multi(bgrn,th,bits,valid=valid,
+                                         stats=stats)
+    ny,nx = bgrn.shape[0:2]
+    masks = {run:np.empty((ny,nx),dtype=bool) for run in th}
+    strip_stats = []
+    def job(s):
+        st = None if stats is None else {}
+        res = sm.shadow_mask_bgrn_multi(bgrn[s],th,bits,
+                                        valid=None if valid is None 
+                                        else valid[s],stats=st)
+        for run in res:
+            masks[run][s] = res[run]
+        if st is not None:
+            strip_stats.append(st)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(job,strip_slices(ny,workers,strip)))
+    for st in strip_stats:
+        sm.merge_stats(stats,st)
+    return masks